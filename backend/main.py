@@ -1,26 +1,54 @@
+import anyio
+import asyncio
 import logging
+import multiprocessing
 
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Body
-from fastapi.responses import FileResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Form, Body, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, StreamingResponse
 from pydantic import BaseModel
 from pathlib import Path
-from typing import Literal, Optional, List
+from typing import Iterator, Literal, NamedTuple, Optional, List
 from uuid import uuid4
-import requests
+import httpx
 import json
+import mimetypes
 import base64
+import concurrent.futures
+import email.utils
+import hashlib
+import hmac
+import io
+import math
 import os
 import queue
+import random
+import shutil
+import sqlite3
+import tempfile
 import threading
-from contextlib import asynccontextmanager
+import time
+import urllib.parse
+import weakref
+import xml.etree.ElementTree as ET
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from datetime import datetime
+from xml.sax.saxutils import escape as xml_escape
+from PIL import Image, ImageOps, features
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    worker = Worker(job_queue)
-    thread = threading.Thread(target=worker.run, daemon=True)
-    thread.start()
+    job_store.sweep(0)
+    worker_pool.start()
     yield
+    await run_in_threadpool(worker_pool.stop, QUEUE_DRAIN_SEC)
+    await provider_transport.aclose()
 
 # Logger setup
 logger = logging.getLogger("app")
@@ -33,11 +61,667 @@ logger.setLevel(logging.ERROR)
 # Storage setup
 STORAGE_DIR = Path("storage/images")
 STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+# Content-addressed blobs, sharded as objects/ab/cd/<sha256>
+OBJECTS_DIR = Path(os.getenv("OBJECTS_DIR", "storage/objects"))
+OBJECTS_DIR.mkdir(parents=True, exist_ok=True)
+CATALOG_DB = Path(os.getenv("CATALOG_DB", "storage/catalog.db"))
+# Extensions the catalog serves; also the formats generate/edit may save as
+IMAGE_EXTS = ("png", "jpg", "jpeg", "webp")
+DERIVATIVE_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+if features.check("avif"):
+    DERIVATIVE_FORMATS["avif"] = "image/avif"
+DERIVATIVE_MAX_DIM = 4096
+THUMBNAIL_WIDTH = int(os.getenv("THUMBNAIL_WIDTH", "256"))
+# Image names never change content, so responses can be cached forever
+IMAGE_CACHE_CONTROL = f"public, max-age={int(os.getenv('IMAGE_CACHE_MAX_AGE', '31536000'))}, immutable"
+
+def object_key(content_hash: str) -> str:
+    return f"{content_hash[:2]}/{content_hash[2:4]}/{content_hash}"
+
+def ref_key(content_hash: str, filename: str) -> str:
+    """Marker recording that ``filename`` on some node uses the blob"""
+    return f"refs/{content_hash}/{filename}"
+
+def object_path(content_hash: str) -> Path:
+    return OBJECTS_DIR / object_key(content_hash)
+
+STORAGE_CHUNK_BYTES = 256 * 1024
+
+class StorageError(Exception):
+    """An object storage request failed"""
+
+class StoredObject(NamedTuple):
+    key: str
+    size_bytes: int
+    modified: float
+
+class ObjectBody:
+    """Streamed object contents: iterate for chunks; close() releases the source early"""
+
+    def __init__(self, chunks: Iterator[bytes], close):
+        self.chunks = chunks
+        self._close = close
+
+    def __iter__(self):
+        try:
+            yield from self.chunks
+        finally:
+            self.close()
+
+    def close(self):
+        self._close()
+
+class ObjectStorage(ABC):
+    """Where the content-addressed image blobs live.
+
+    Keys are relative paths such as ``ab/cd/<sha256>``. ``put`` consumes a
+    finished local file, ``get`` streams an object back as (stat, body) and
+    raises FileNotFoundError for a missing key, and ``local_file`` yields a
+    readable path for code that needs one (Pillow). ``presign`` returns a
+    time-limited URL clients can fetch directly, or None when objects are
+    only reachable through the API.
+    """
+
+    name = "abstract"
+    # Whether other API nodes read and write the same objects
+    shared = False
+
+    @abstractmethod
+    def put(self, key: str, source: str):
+        ...
+
+    def put_bytes(self, key: str, data: bytes):
+        fd, tmp_path = tempfile.mkstemp(suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            self.put(key, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    @abstractmethod
+    def get(self, key: str) -> tuple:
+        ...
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[StoredObject]:
+        ...
+
+    @abstractmethod
+    def list(self, prefix: str = "") -> Iterator[StoredObject]:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str):
+        ...
+
+    def presign(self, key: str, expires: float) -> Optional[str]:
+        return None
+
+    def local_path(self, key: str) -> Optional[Path]:
+        """The object's file when it is on this node's disk"""
+        return None
+
+    @contextmanager
+    def local_file(self, key: str):
+        """A local path holding the object, downloaded to a temp file if need be"""
+        _, body = self.get(key)
+        fd, tmp_path = tempfile.mkstemp(suffix=".download")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in body:
+                    f.write(chunk)
+            yield Path(tmp_path)
+        finally:
+            body.close()
+            os.unlink(tmp_path)
+
+class LocalStorage(ObjectStorage):
+    """Objects as files under one directory of this node's disk"""
+
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def local_path(self, key: str) -> Path:
+        return self.root / key
+
+    def put(self, key: str, source: str):
+        target = self.root / key
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, target)
+
+    def get(self, key: str) -> tuple:
+        f = open(self.root / key, "rb")
+        try:
+            st = os.fstat(f.fileno())
+        except BaseException:
+            f.close()
+            raise
+        return (StoredObject(key, st.st_size, st.st_mtime),
+                ObjectBody(iter(lambda: f.read(STORAGE_CHUNK_BYTES), b""), f.close))
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        try:
+            st = os.stat(self.root / key)
+        except FileNotFoundError:
+            return None
+        return StoredObject(key, st.st_size, st.st_mtime)
+
+    def list(self, prefix: str = "") -> Iterator[StoredObject]:
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                key = (Path(dirpath) / name).relative_to(self.root).as_posix()
+                # Skip saves still being written
+                if key.startswith(prefix) and not name.endswith(".part"):
+                    stored = self.stat(key)
+                    if stored:
+                        yield stored
+
+    def delete(self, key: str):
+        (self.root / key).unlink(missing_ok=True)
+
+    @contextmanager
+    def local_file(self, key: str):
+        yield self.root / key
+
+class S3Storage(ObjectStorage):
+    """Objects in an S3-compatible bucket (AWS S3, MinIO, R2, ...) so every
+    API node sees the same blobs.
+
+    Requests are signed with AWS Signature Version 4 and sent with httpx.
+    Files larger than one part go up as multipart uploads, and reads are
+    streamed, so an object never has to fit in memory.
+    """
+
+    name = "s3"
+    shared = True
+
+    def __init__(self, endpoint: str, bucket: str, access_key: str, secret_key: str,
+                 region: str = "us-east-1", prefix: str = "", virtual_hosted: bool = False,
+                 part_size: int = 8 * 1024 * 1024, transport: Optional[httpx.BaseTransport] = None):
+        url = httpx.URL(endpoint)
+        self.host = f"{bucket}.{url.netloc.decode()}" if virtual_hosted else url.netloc.decode()
+        self.base = f"{url.scheme}://{self.host}"
+        self.bucket_path = "" if virtual_hosted else f"/{bucket}"
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        # S3 rejects parts under 5MB other than the last one
+        self.part_size = max(part_size, 5 * 1024 * 1024)
+        self.client = httpx.Client(transport=transport, timeout=httpx.Timeout(60.0, connect=10.0))
+
+    @classmethod
+    def from_env(cls) -> "S3Storage":
+        endpoint, bucket = os.getenv("S3_ENDPOINT"), os.getenv("S3_BUCKET")
+        if not endpoint or not bucket:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs S3_ENDPOINT and S3_BUCKET")
+        return cls(
+            endpoint, bucket,
+            os.getenv("S3_ACCESS_KEY_ID", os.getenv("AWS_ACCESS_KEY_ID", "")),
+            os.getenv("S3_SECRET_ACCESS_KEY", os.getenv("AWS_SECRET_ACCESS_KEY", "")),
+            region=os.getenv("S3_REGION", "us-east-1"),
+            prefix=os.getenv("S3_PREFIX", "objects/"),
+            virtual_hosted=os.getenv("S3_VIRTUAL_HOSTED", "0") == "1",
+            part_size=int(os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024))))
+
+    def _path(self, name: str = "") -> str:
+        return urllib.parse.quote(f"{self.bucket_path}/{name}", safe="/")
+
+    @staticmethod
+    def _query(query: dict) -> str:
+        return "&".join(f"{urllib.parse.quote(str(k), safe='')}={urllib.parse.quote(str(v), safe='')}"
+                        for k, v in sorted(query.items()))
+
+    def _scope(self, amz_date: str) -> str:
+        return f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+
+    def _signature(self, method: str, path: str, query: dict, headers: dict, amz_date: str) -> str:
+        canonical = "\n".join([
+            method, path, self._query(query),
+            "".join(f"{name}:{headers[name]}\n" for name in sorted(headers)),
+            ";".join(sorted(headers)), "UNSIGNED-PAYLOAD"])
+        to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, self._scope(amz_date),
+                             hashlib.sha256(canonical.encode()).hexdigest()])
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        return hmac.new(key, to_sign.encode(), hashlib.sha256).hexdigest()
+
+    def _request(self, method: str, key: Optional[str] = None, query: Optional[dict] = None,
+                 content: bytes = b"", stream: bool = False, missing_ok: bool = False) -> Optional[httpx.Response]:
+        path = self._path(self.prefix + key if key is not None else "")
+        query = query or {}
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        signed = {"host": self.host, "x-amz-content-sha256": "UNSIGNED-PAYLOAD", "x-amz-date": amz_date}
+        signature = self._signature(method, path, query, signed, amz_date)
+        headers = dict(signed, authorization=(
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{self._scope(amz_date)}, "
+            f"SignedHeaders={';'.join(sorted(signed))}, Signature={signature}"))
+        url = self.base + path + (f"?{self._query(query)}" if query else "")
+        try:
+            response = self.client.send(
+                self.client.build_request(method, url, headers=headers, content=content), stream=stream)
+        except httpx.HTTPError as e:
+            raise StorageError(f"S3 {method} {key or ''} failed: {e}") from e
+        if response.status_code < 300:
+            return response
+        response.read()
+        response.close()
+        if response.status_code == 404:
+            if missing_ok:
+                return None
+            raise FileNotFoundError(key)
+        raise StorageError(f"S3 {method} {key or ''} failed: {response.status_code} {response.text[:200]}")
+
+    @staticmethod
+    def _xml(response: httpx.Response) -> ET.Element:
+        root = ET.fromstring(response.content)
+        # CompleteMultipartUpload can fail after a 200
+        if root.tag.rsplit("}", 1)[-1] == "Error":
+            raise StorageError(f"S3 error: {root.findtext('{*}Code')} {root.findtext('{*}Message')}")
+        return root
+
+    def put(self, key: str, source: str):
+        with open(source, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= self.part_size:
+                self._request("PUT", key, content=f.read())
+            else:
+                self._put_multipart(key, f)
+        os.unlink(source)
+
+    def _put_multipart(self, key: str, f):
+        upload_id = self._xml(self._request("POST", key, {"uploads": ""})).findtext("{*}UploadId")
+        try:
+            parts = []
+            while chunk := f.read(self.part_size):
+                number = len(parts) + 1
+                response = self._request("PUT", key, {"partNumber": number, "uploadId": upload_id}, chunk)
+                parts.append(f"<Part><PartNumber>{number}</PartNumber>"
+                             f"<ETag>{xml_escape(response.headers['etag'])}</ETag></Part>")
+            body = f"<CompleteMultipartUpload>{''.join(parts)}</CompleteMultipartUpload>"
+            self._xml(self._request("POST", key, {"uploadId": upload_id}, body.encode()))
+        except BaseException:
+            try:
+                self._request("DELETE", key, {"uploadId": upload_id}, missing_ok=True)
+            except StorageError as e:
+                logger.warning(f"aborting multipart upload of {key} failed: {e}")
+            raise
+
+    def _stored(self, key: str, headers: httpx.Headers) -> StoredObject:
+        modified = headers.get("last-modified")
+        return StoredObject(key, int(headers.get("content-length", 0)),
+                            email.utils.parsedate_to_datetime(modified).timestamp() if modified else 0.0)
+
+    def get(self, key: str) -> tuple:
+        response = self._request("GET", key, stream=True)
+        return (self._stored(key, response.headers),
+                ObjectBody(response.iter_bytes(STORAGE_CHUNK_BYTES), response.close))
+
+    def stat(self, key: str) -> Optional[StoredObject]:
+        response = self._request("HEAD", key, missing_ok=True)
+        return self._stored(key, response.headers) if response is not None else None
+
+    def list(self, prefix: str = "") -> Iterator[StoredObject]:
+        query = {"list-type": "2", "prefix": self.prefix + prefix}
+        while True:
+            root = self._xml(self._request("GET", query=query))
+            for item in root.iterfind("{*}Contents"):
+                modified = datetime.fromisoformat(item.findtext("{*}LastModified").replace("Z", "+00:00"))
+                yield StoredObject(item.findtext("{*}Key")[len(self.prefix):],
+                                   int(item.findtext("{*}Size")), modified.timestamp())
+            token = root.findtext("{*}NextContinuationToken")
+            if root.findtext("{*}IsTruncated") != "true" or not token:
+                return
+            query["continuation-token"] = token
+
+    def delete(self, key: str):
+        self._request("DELETE", key, missing_ok=True)
+
+    def presign(self, key: str, expires: float, now: Optional[float] = None) -> str:
+        """A GET URL for ``key`` that works without credentials for ``expires`` seconds"""
+        path = self._path(self.prefix + key)
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(now))
+        query = {
+            "X-Amz-Algorithm": "AWS4-HMAC-SHA256",
+            "X-Amz-Credential": f"{self.access_key}/{self._scope(amz_date)}",
+            "X-Amz-Date": amz_date,
+            "X-Amz-Expires": str(int(expires)),
+            "X-Amz-SignedHeaders": "host",
+        }
+        signature = self._signature("GET", path, query, {"host": self.host}, amz_date)
+        return f"{self.base}{path}?{self._query(query)}&X-Amz-Signature={signature}"
+
+def storage_from_env() -> ObjectStorage:
+    backend = os.getenv("STORAGE_BACKEND", "local").lower()
+    if backend == "s3":
+        return S3Storage.from_env()
+    if backend != "local":
+        raise RuntimeError(f"Unknown STORAGE_BACKEND {backend!r}. Use 'local' or 's3'")
+    return LocalStorage(OBJECTS_DIR)
+
+object_storage = storage_from_env()
+# >0: originals in remote storage are answered with a redirect to a presigned URL
+STORAGE_REDIRECT_TTL_SEC = int(os.getenv("STORAGE_REDIRECT_TTL_SEC", "0"))
+
+class ImageCatalog:
+    """SQLite index of stored images so listing doesn't rescan the directory.
+
+    Each ``images`` row is a public filename. Images saved through the API are
+    aliases onto a content-addressed blob in ``objects``, which counts its
+    aliases so identical outputs are stored once and the blob goes away with
+    its last alias. Blobs live in ``storage``; legacy files in the flat
+    directory have no content hash and are always local. ``sync`` picks them
+    up and costs a single stat unless the directory changed.
+
+    ``lock`` only guards the database. Storage calls (possibly network round
+    trips) run outside it; a blob being uploaded or deleted is marked busy so
+    other saves and removals of the same content wait for it instead.
+
+    The refcounts here only see this node's aliases. When ``storage`` is
+    shared with other nodes, each alias also writes a ``refs/<hash>/<name>``
+    marker next to the blob, and the blob is only deleted once no node has a
+    marker left for it.
+    """
+
+    def __init__(self, db_path: Path, image_dir: Path, storage: ObjectStorage):
+        self.image_dir = image_dir
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.blob_done = threading.Condition(self.lock)
+        self.busy_blobs = set()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                filename TEXT PRIMARY KEY,
+                ext TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_images_created ON images(created_at, filename);
+            CREATE INDEX IF NOT EXISTS idx_images_ext_created ON images(ext, created_at, filename);
+            CREATE TABLE IF NOT EXISTS objects (
+                content_hash TEXT PRIMARY KEY,
+                size_bytes INTEGER NOT NULL,
+                refcount INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS catalog_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(images)")}
+        if "content_hash" not in columns:
+            self.conn.execute("ALTER TABLE images ADD COLUMN content_hash TEXT")
+            self.conn.commit()
+        # Filled in after the save by the image pipeline
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(objects)")}
+        for column, kind in (("width", "INTEGER"), ("height", "INTEGER"), ("format", "TEXT"), ("phash", "TEXT")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE objects ADD COLUMN {column} {kind}")
+        self.conn.commit()
+        row = self.conn.execute("SELECT value FROM catalog_meta WHERE key = 'dir_mtime_ns'").fetchone()
+        self.synced_mtime_ns = int(row[0]) if row else None
+
+    def _mark_synced(self, mtime_ns: int):
+        self.synced_mtime_ns = mtime_ns
+        self.conn.execute(
+            "INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('dir_mtime_ns', ?)",
+            (str(mtime_ns),))
+
+    def _claim_blob(self, content_hash: str):
+        """Wait until no other thread is storing or deleting this blob, then own it (lock held)"""
+        while content_hash in self.busy_blobs:
+            self.blob_done.wait()
+        self.busy_blobs.add(content_hash)
+
+    def _release_blob(self, content_hash: str):
+        with self.lock:
+            self.busy_blobs.discard(content_hash)
+            self.blob_done.notify_all()
+
+    def add_object(self, filename: str, content_hash: str, size_bytes: int, created_at: float, tmp_path: str):
+        """Publish a finished temp file as an alias, storing the blob only if it is new.
+
+        Concurrent saves of the same content upload it once: the second waits
+        for the first and then finds the blob already stored.
+        """
+        ext = filename.rsplit(".", 1)[-1].lower()
+        key = object_key(content_hash)
+        with self.lock:
+            self._claim_blob(content_hash)
+            known = self.conn.execute(
+                "SELECT 1 FROM objects WHERE content_hash = ?", (content_hash,)).fetchone() is not None
+        try:
+            if self.storage.shared:
+                # Before the blob check, so a node deleting its last alias sees this one
+                self.storage.put_bytes(ref_key(content_hash, filename), b"")
+            if (known or self.storage.shared) and self.storage.stat(key) is not None:
+                os.unlink(tmp_path)
+            else:
+                self.storage.put(key, tmp_path)
+            with self.lock:
+                self.conn.execute("""
+                    INSERT INTO objects (content_hash, size_bytes, refcount) VALUES (?, ?, 1)
+                    ON CONFLICT(content_hash) DO UPDATE SET refcount = refcount + 1
+                """, (content_hash, size_bytes))
+                self.conn.execute(
+                    "INSERT INTO images (filename, ext, size_bytes, created_at, content_hash) VALUES (?, ?, ?, ?, ?)",
+                    (filename, ext, size_bytes, created_at, content_hash))
+                self.conn.commit()
+        except BaseException:
+            if self.storage.shared:
+                self._drop_ref(content_hash, filename)
+            raise
+        finally:
+            self._release_blob(content_hash)
+
+    def _drop_ref(self, content_hash: str, filename: str):
+        try:
+            self.storage.delete(ref_key(content_hash, filename))
+        except (OSError, StorageError) as e:
+            logger.warning(f"could not delete the {filename} reference to blob {content_hash}: {e}")
+
+    def resolve(self, filename: str) -> Optional[tuple]:
+        """Map a public filename to (path on disk, size_bytes, content_hash or None).
+
+        The path is None for blobs in remote storage.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT size_bytes, content_hash FROM images WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return None
+        size_bytes, content_hash = row
+        path = self.storage.local_path(object_key(content_hash)) if content_hash else self.image_dir / filename
+        return path, size_bytes, content_hash
+
+    def has_metadata(self, content_hash: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT width FROM objects WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def set_metadata(self, content_hash: str, width: int, height: int, format: str, phash: str):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE objects SET width = ?, height = ?, format = ?, phash = ? WHERE content_hash = ?",
+                (width, height, format, phash, content_hash))
+            self.conn.commit()
+
+    def remove(self, filename: str) -> bool:
+        """Drop an alias; the blob is deleted when its last alias on any node goes"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content_hash FROM images WHERE filename = ?", (filename,)).fetchone()
+            if row is None:
+                return False
+            content_hash = row[0]
+            if content_hash is not None:
+                # A save of the same content may be mid-upload; let it land first
+                self._claim_blob(content_hash)
+                if self.conn.execute("SELECT 1 FROM images WHERE filename = ?", (filename,)).fetchone() is None:
+                    self.busy_blobs.discard(content_hash)
+                    self.blob_done.notify_all()
+                    return False
+            self.conn.execute("DELETE FROM images WHERE filename = ?", (filename,))
+            orphaned = False
+            if content_hash is None:
+                (self.image_dir / filename).unlink(missing_ok=True)
+            else:
+                self.conn.execute(
+                    "UPDATE objects SET refcount = refcount - 1 WHERE content_hash = ?", (content_hash,))
+                refcount = self.conn.execute(
+                    "SELECT refcount FROM objects WHERE content_hash = ?", (content_hash,)).fetchone()[0]
+                if refcount <= 0:
+                    self.conn.execute("DELETE FROM objects WHERE content_hash = ?", (content_hash,))
+                    orphaned = True
+            self.conn.commit()
+        if content_hash is None:
+            return True
+        try:
+            if self.storage.shared:
+                self._drop_ref(content_hash, filename)
+                if orphaned and next(iter(self.storage.list(f"refs/{content_hash}/")), None) is not None:
+                    orphaned = False  # another node still uses it
+            if orphaned:
+                self.storage.delete(object_key(content_hash))
+        except (OSError, StorageError) as e:
+            logger.warning(f"could not delete blob {content_hash}: {e}")
+        finally:
+            self._release_blob(content_hash)
+        return True
+
+    def sync(self):
+        """Reindex the flat directory if it was modified outside the catalog"""
+        mtime_ns = os.stat(self.image_dir).st_mtime_ns
+        if mtime_ns == self.synced_mtime_ns:
+            return
+        with self.lock:
+            on_disk = {}
+            with os.scandir(self.image_dir) as entries:
+                for entry in entries:
+                    ext = entry.name.rsplit(".", 1)[-1].lower()
+                    if ext in IMAGE_EXTS and entry.is_file():
+                        st = entry.stat()
+                        on_disk[entry.name] = (entry.name, ext, st.st_size, st.st_mtime)
+            known = {r[0] for r in self.conn.execute("SELECT filename FROM images WHERE content_hash IS NULL")}
+            self.conn.executemany("DELETE FROM images WHERE filename = ? AND content_hash IS NULL",
+                                  [(name,) for name in known - on_disk.keys()])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO images (filename, ext, size_bytes, created_at) VALUES (?, ?, ?, ?)",
+                [on_disk[name] for name in on_disk.keys() - known])
+            self._mark_synced(mtime_ns)
+            self.conn.commit()
+
+    def query(self, limit: int, cursor: Optional[tuple] = None, ext: Optional[str] = None,
+              since: Optional[float] = None, until: Optional[float] = None):
+        """Return one page newest first, plus the cursor for the next page (or None)"""
+        where, params = [], []
+        if ext:
+            where.append("i.ext = ?")
+            params.append(ext)
+        if since is not None:
+            where.append("i.created_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("i.created_at < ?")
+            params.append(until)
+        if cursor:
+            where.append("(i.created_at < ? OR (i.created_at = ? AND i.filename < ?))")
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        sql = """SELECT i.filename, i.size_bytes, i.created_at, o.width, o.height
+                 FROM images i LEFT JOIN objects o ON o.content_hash = i.content_hash"""
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY i.created_at DESC, i.filename DESC LIMIT ?"
+        params.append(limit + 1)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1][2]!r}:{rows[-1][0]}"
+        return rows, next_cursor
+
+image_catalog = ImageCatalog(CATALOG_DB, STORAGE_DIR, object_storage)
+
+class ResultCache:
+    """Saved results of earlier generate calls, keyed by the normalized request.
+
+    Lives in the catalog database so a hit can be checked against the images
+    it points to. Entries expire after ``ttl_sec`` and the least recently used
+    ones are evicted beyond ``max_entries``.
+    """
+
+    def __init__(self, db_path: Path, ttl_sec: float, max_entries: int):
+        self.ttl_sec = ttl_sec
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS result_cache (
+                key TEXT PRIMARY KEY,
+                results TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_result_cache_last_used ON result_cache(last_used);
+        """)
+
+    @staticmethod
+    def key(**request) -> str:
+        normalized = {k: " ".join(v.split()) if isinstance(v, str) else v for k, v in request.items()}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[dict]]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT results, created_at FROM result_cache WHERE key = ?", (key,)).fetchone()
+            results = json.loads(row[0]) if row else None
+            # Expired, or an image it points to has since been deleted
+            if results is not None and (now - row[1] > self.ttl_sec or
+                                        any(image_catalog.resolve(r["filename"]) is None for r in results)):
+                self.conn.execute("DELETE FROM result_cache WHERE key = ?", (key,))
+                results = None
+            if results is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.conn.execute("UPDATE result_cache SET last_used = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return results
+
+    def put(self, key: str, results: List[dict]):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO result_cache (key, results, created_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(results), now, now))
+            self.conn.execute("DELETE FROM result_cache WHERE created_at < ?", (now - self.ttl_sec,))
+            excess = self.conn.execute("SELECT COUNT(*) FROM result_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute(
+                    "DELETE FROM result_cache WHERE key IN "
+                    "(SELECT key FROM result_cache ORDER BY last_used LIMIT ?)", (excess,))
+            self.conn.commit()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM result_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+result_cache = ResultCache(
+    CATALOG_DB,
+    ttl_sec=float(os.getenv("RESULT_CACHE_TTL_SEC", "86400")),
+    max_entries=int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1000")))
 
 app = FastAPI(title="Local Images API", lifespan=lifespan)
 
-# Mount static files
-app.mount("/static/images", StaticFiles(directory=STORAGE_DIR), name="static")
 
 class JobResp(BaseModel):
     id: str
@@ -51,28 +735,608 @@ class ImageResult(BaseModel):
     url: str
 
 @app.get("/images")
-def list_images():
-    """List all images sorted by newest first"""
-    images = []
-    if STORAGE_DIR.exists():
-        for img_file in sorted(STORAGE_DIR.glob("*"), key=lambda x: x.stat().st_mtime, reverse=True):
-            if img_file.is_file() and img_file.suffix.lower() in ['.png', '.jpg', '.jpeg']:
-                images.append({
-                    "filename": img_file.name,
-                    "size_bytes": img_file.stat().st_size,
-                    "url": f"/static/images/{img_file.name}"
-                })
-    return images
-
-@app.get("/images/{file}")
-def get_image(file: str):
-    p = STORAGE_DIR / file
-    if not p.exists():
+def list_images(
+    response: Response,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    ext: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None
+):
+    """List images newest first; pass X-Next-Cursor back as ?cursor= for the next page"""
+    after = None
+    if cursor:
+        try:
+            created_at, filename = cursor.split(":", 1)
+            after = (float(created_at), filename)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    if ext:
+        ext = ext.lower().lstrip(".")
+        if ext not in IMAGE_EXTS:
+            raise HTTPException(status_code=400, detail=f"Invalid ext. Use one of {', '.join(IMAGE_EXTS)}")
+
+    image_catalog.sync()
+    rows, next_cursor = image_catalog.query(limit, after, ext, since, until)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [{
+        "filename": filename,
+        "size_bytes": size_bytes,
+        "url": f"/static/images/{filename}",
+        "thumbnail_url": f"/static/images/{filename}?w={THUMBNAIL_WIDTH}&fmt=webp",
+        "width": width,
+        "height": height,
+        "created_at": created_at
+    } for filename, size_bytes, created_at, width, height in rows]
+
+def valid_image_name(file: str) -> bool:
+    """A bare catalog name: no path separators, no hidden or relative names, an image extension"""
+    return (0 < len(file) <= 255 and not file.startswith(".") and "/" not in file and "\\" not in file
+            and "\0" not in file and file.rsplit(".", 1)[-1].lower() in IMAGE_EXTS)
+
+def output_format(fmt) -> str:
+    """Normalize a requested output format, rejecting ones the catalog won't serve"""
+    fmt = str(fmt or "png").lower()
+    if fmt not in IMAGE_EXTS:
+        raise HTTPException(status_code=422, detail=f"Invalid fmt. Use one of {', '.join(IMAGE_EXTS)}")
+    return fmt
+
+def check_output_size(width: int, height: int):
+    """Edit inputs are scaled to the output size, so it has to be a real one"""
+    for name, value in (("width", width), ("height", height)):
+        if not 1 <= value <= DERIVATIVE_MAX_DIM:
+            raise HTTPException(status_code=422, detail=f"{name} must be between 1 and {DERIVATIVE_MAX_DIM}")
+
+class ImageFileResponse(FileResponse):
+    """FileResponse streaming from an already open file.
+
+    FileResponse would stat and open the path itself; here one descriptor
+    and its fstat serve the whole request. Servers offering the pathsend
+    extension still sendfile by path.
+    """
+
+    def __init__(self, file, path: Path, stat_result: os.stat_result, **kwargs):
+        self.file = file
+        super().__init__(path, stat_result=stat_result, **kwargs)
+
+    @asynccontextmanager
+    async def _open_file(self):
+        self.file.seek(0)
+        yield anyio.wrap_file(self.file)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.file.close()
+
+def _resolve_image(file: str) -> tuple:
+    """Catalog lookup to (path, size_bytes, content_hash).
+
+    Names that can't be catalog entries are rejected before anything on
+    disk is touched, and paths only ever come from the catalog.
+    """
+    if not valid_image_name(file):
+        raise HTTPException(status_code=404, detail="image not found")
+    found = image_catalog.resolve(file)
+    if found is None:
+        # Might be a file dropped into the flat directory since the last sync
+        image_catalog.sync()
+        found = image_catalog.resolve(file)
+    if found is None:
+        raise HTTPException(status_code=404, detail="image not found")
+    return found
+
+def _open_stored(path: Path, open_file: bool) -> tuple:
+    """(stat, open file or None) with a single open+fstat, or a stat when the bytes aren't needed"""
+    try:
+        if not open_file:
+            return os.stat(path), None
+        handle = open(path, "rb")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="image not found")
+    try:
+        return os.fstat(handle.fileno()), handle
+    except BaseException:
+        handle.close()
+        raise
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def _not_modified_since(request: Request, last_modified: float) -> bool:
+    # If-None-Match takes precedence, so If-Modified-Since only counts without it
+    if_modified_since = request.headers.get("if-modified-since")
+    if not if_modified_since or "if-none-match" in request.headers:
+        return False
+    try:
+        return int(last_modified) <= email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+@app.api_route("/images/{file}", methods=["GET", "HEAD"])
+async def get_image(
+    request: Request,
+    file: str,
+    w: Optional[int] = Query(None, ge=1, le=DERIVATIVE_MAX_DIM),
+    h: Optional[int] = Query(None, ge=1, le=DERIVATIVE_MAX_DIM),
+    fmt: Optional[str] = None
+):
+    """The stored image, or with ?w=/?h=/?fmt= a resized or transcoded variant.
+
+    Responses carry a strong ETag derived from the content hash and are
+    cacheable forever. A matching If-None-Match is answered with 304 from
+    the catalog alone; otherwise the original is served from one open and
+    fstat. Range requests are handled by FileResponse. Blobs in remote
+    storage are streamed through, or redirected to a presigned URL.
+    """
+    path, size_bytes, content_hash = await run_in_threadpool(_resolve_image, file)
+    # Legacy flat-dir images have no content hash yet
+    source_key = content_hash or hashlib.sha256(f"{file}:{size_bytes}".encode()).hexdigest()
+    original = w is None and h is None and fmt is None
+    if not original:
+        fmt = (fmt or "webp").lower()
+        fmt = "jpeg" if fmt == "jpg" else fmt
+        if fmt not in DERIVATIVE_FORMATS:
+            raise HTTPException(status_code=400, detail=f"Invalid fmt. Use one of {', '.join(DERIVATIVE_FORMATS)}")
+    etag = f'"{source_key if original else DerivativeCache.key(source_key, w, h, fmt)}"'
+    headers = {"ETag": etag, "Cache-Control": IMAGE_CACHE_CONTROL}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    if path is None:
+        return await _serve_remote(request, file, content_hash, original, w, h, fmt, headers)
+
+    st, handle = await run_in_threadpool(_open_stored, path, original)
+    headers["Last-Modified"] = email.utils.formatdate(st.st_mtime, usegmt=True)
+    if _not_modified_since(request, st.st_mtime):
+        if handle:
+            handle.close()
+        return Response(status_code=304, headers=headers)
+    if original:
+        return ImageFileResponse(handle, path, st, media_type=mimetypes.guess_type(file)[0], headers=headers)
+    try:
+        variant = await derivative_for(path, source_key, w, h, fmt)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=415, detail=f"Cannot render a variant of this image: {e}")
+    return FileResponse(variant, media_type=DERIVATIVE_FORMATS[fmt], headers=headers)
+
+async def _serve_remote(request: Request, file: str, content_hash: str, original: bool,
+                        w: Optional[int], h: Optional[int], fmt: Optional[str], headers: dict) -> Response:
+    key = object_key(content_hash)
+    try:
+        if original:
+            url = STORAGE_REDIRECT_TTL_SEC > 0 and object_storage.presign(key, STORAGE_REDIRECT_TTL_SEC)
+            if url:
+                return RedirectResponse(url, status_code=307)
+            if request.method == "HEAD":
+                stored, body = await run_in_threadpool(object_storage.stat, key), None
+                if stored is None:
+                    raise FileNotFoundError(key)
+            else:
+                stored, body = await run_in_threadpool(object_storage.get, key)
+            headers["Last-Modified"] = email.utils.formatdate(stored.modified, usegmt=True)
+            if _not_modified_since(request, stored.modified):
+                if body:
+                    body.close()
+                return Response(status_code=304, headers=headers)
+            headers["Content-Length"] = str(stored.size_bytes)
+            if body is None:
+                return Response(media_type=mimetypes.guess_type(file)[0], headers=headers)
+            return StreamingResponse(body, media_type=mimetypes.guess_type(file)[0], headers=headers)
+        variant = await derivative_for(key, content_hash, w, h, fmt)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="image not found")
-    return FileResponse(p)
+    except StorageError as e:
+        logger.error(f"reading {file} from {object_storage.name} storage failed: {e}")
+        raise HTTPException(status_code=502, detail="Image storage unavailable")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=415, detail=f"Cannot render a variant of this image: {e}")
+    return FileResponse(variant, media_type=DERIVATIVE_FORMATS[fmt], headers=headers)
 
-def call_openrouter_api(prompt: str, width: int, height: int, n: int) -> dict:
-    """Call OpenRouter API for image generation"""
+# Public image URLs; content-addressed images have no file under this name
+app.add_api_route("/static/images/{file}", get_image, methods=["GET", "HEAD"], name="static")
+
+@app.delete("/images/{file}")
+def delete_image(file: str):
+    if not image_catalog.remove(file):
+        raise HTTPException(status_code=404, detail="image not found")
+    return {"deleted": file}
+
+class ProviderTransport:
+    """Shared keep-alive async HTTP client for the provider adapters.
+
+    Each upstream host gets its own pooled client so one slow provider can't
+    exhaust the connections of the other. httpx async clients are bound to the
+    event loop that created them, so pools are kept per loop: the server loop
+    and each worker thread's loop reuse their own connections.
+
+    Pool usage is tracked per host via httpcore trace events: a request that
+    never opens a TCP connection reused one, and the time before the first
+    event is time spent waiting for a free slot in the pool.
+    """
+
+    def __init__(self):
+        self.timeout = httpx.Timeout(
+            connect=float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "5")),
+            read=float(os.getenv("PROVIDER_READ_TIMEOUT", "120")),
+            write=float(os.getenv("PROVIDER_WRITE_TIMEOUT", "30")),
+            pool=float(os.getenv("PROVIDER_POOL_TIMEOUT", "10")))
+        self.limits = httpx.Limits(
+            max_connections=int(os.getenv("PROVIDER_POOL_SIZE", "10")),
+            max_keepalive_connections=int(os.getenv("PROVIDER_POOL_SIZE", "10")),
+            keepalive_expiry=float(os.getenv("PROVIDER_KEEPALIVE_SEC", "30")))
+        self.http2 = os.getenv("PROVIDER_HTTP2", "0") == "1"
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("PROVIDER_HTTP2=1 but the h2 package is not installed; using HTTP/1.1")
+                self.http2 = False
+        self.lock = threading.Lock()
+        self.clients = weakref.WeakKeyDictionary()
+        self.stats = {}
+
+    def _client(self, host: str) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            clients = self.clients.setdefault(loop, {})
+            client = clients.get(host)
+            if client is None:
+                client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, http2=self.http2)
+                clients[host] = client
+                self.stats.setdefault(host, {"requests": 0, "new_connections": 0, "errors": 0,
+                                             "wait_sec_total": 0.0, "wait_sec_max": 0.0})
+            return client
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        host = httpx.URL(url).host
+        client = self._client(host)
+        started = time.monotonic()
+        trace_state = {"waited": None, "connected": False}
+
+        async def trace(event: str, info: dict):
+            if trace_state["waited"] is None:
+                trace_state["waited"] = time.monotonic() - started
+            if event == "connection.connect_tcp.started":
+                trace_state["connected"] = True
+
+        try:
+            return await client.post(url, extensions={"trace": trace}, **kwargs)
+        except httpx.HTTPError:
+            with self.lock:
+                self.stats[host]["errors"] += 1
+            raise
+        finally:
+            waited = trace_state["waited"] if trace_state["waited"] is not None else time.monotonic() - started
+            with self.lock:
+                stats = self.stats[host]
+                stats["requests"] += 1
+                stats["new_connections"] += trace_state["connected"]
+                stats["wait_sec_total"] += waited
+                stats["wait_sec_max"] = max(stats["wait_sec_max"], waited)
+
+    def metrics(self) -> dict:
+        """Per-host pool usage for sizing PROVIDER_POOL_SIZE"""
+        out = {}
+        with self.lock:
+            connections = {host: [] for host in self.stats}
+            for clients in list(self.clients.values()):
+                for host, client in clients.items():
+                    pool = getattr(client._transport, "_pool", None)
+                    connections[host].extend(getattr(pool, "connections", []))
+            for host, stats in self.stats.items():
+                requests_made = stats["requests"]
+                out[host] = {
+                    "open_connections": len(connections[host]),
+                    "idle_connections": sum(1 for c in connections[host] if c.is_idle()),
+                    "requests": requests_made,
+                    "new_connections": stats["new_connections"],
+                    "errors": stats["errors"],
+                    "reuse_ratio": round(1 - stats["new_connections"] / requests_made, 3) if requests_made else None,
+                    "avg_wait_ms": round(stats["wait_sec_total"] / requests_made * 1000, 2) if requests_made else None,
+                    "max_wait_ms": round(stats["wait_sec_max"] * 1000, 2),
+                }
+        return out
+
+    async def aclose(self):
+        """Close the pools owned by the running event loop"""
+        with self.lock:
+            clients = self.clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.aclose()
+
+provider_transport = ProviderTransport()
+
+@app.get("/metrics")
+def get_metrics():
+    """Runtime counters for capacity planning"""
+    return {
+        "provider_pools": provider_transport.metrics(),
+        "workers": worker_pool.metrics(),
+        "result_cache": result_cache.metrics(),
+        "single_flight": provider_flights.metrics(),
+        "preprocess_cache": preprocess_cache.metrics(),
+        "provider_limits": {name: limiter.metrics() for name, limiter in provider_limiters.items()},
+        "provider_retries": provider_retry.metrics(),
+        "provider_routing": provider_router.status(),
+        "job_events": job_events.metrics(),
+        "derivatives": derivative_cache.metrics(),
+        "image_pipeline": image_pipeline.metrics()
+    }
+
+class ProviderBusy(HTTPException):
+    """The provider (or our limit for it) cannot take the call right now"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: float, upstream: bool = False):
+        super().__init__(status_code=status_code, detail=detail,
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+        self.retry_after = retry_after
+        # True when the provider itself refused, as opposed to our own limiter
+        self.upstream = upstream
+
+def parse_retry_after(value: Optional[str], default: float = 1.0) -> float:
+    """Seconds from a Retry-After header, which may be a delay or an HTTP date"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+def _provider_env(provider: str, name: str, default: str) -> str:
+    """Per-provider override (GEMINI_MAX_CONCURRENCY) falling back to PROVIDER_*"""
+    return os.getenv(f"{provider.upper()}_{name}", os.getenv(f"PROVIDER_{name}", default))
+
+class ProviderLimiter:
+    """Concurrency cap plus token bucket for one provider.
+
+    Callers over the concurrency cap queue FIFO for up to ``max_wait``
+    seconds; callers that would wait longer for a rate token, or find the
+    queue full, are refused straight away with a Retry-After hint. Queued
+    callers hold a thread-safe future, so handlers and worker threads on
+    different event loops share the same limits.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, rate: float = 0.0, burst: Optional[float] = None,
+                 max_wait: float = 30.0, max_queue: int = 100):
+        self.name = name
+        self.max_concurrency = max(1, max_concurrency)
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.paused_until = 0.0
+        self.active = 0
+        self.waiters = deque()
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_busy = 0
+        self.upstream_limited = 0
+        self.wait_total = 0.0
+
+    @classmethod
+    def from_env(cls, provider: str) -> "ProviderLimiter":
+        rate = float(_provider_env(provider, "RATE_PER_SEC", "0"))
+        burst = _provider_env(provider, "RATE_BURST", "")
+        return cls(
+            provider,
+            int(_provider_env(provider, "MAX_CONCURRENCY", "4")),
+            rate,
+            float(burst) if burst else None,
+            float(_provider_env(provider, "QUEUE_TIMEOUT_SEC", "30")),
+            int(_provider_env(provider, "MAX_QUEUE", "100")),
+        )
+
+    def _token_wait(self, now: float) -> float:
+        pause = max(0.0, self.paused_until - now)
+        if self.rate <= 0:
+            return pause
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        if self.tokens >= 1:
+            return pause
+        return max(pause, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        start = time.monotonic()
+        slot = None
+        with self.lock:
+            token_wait = self._token_wait(start)
+            if token_wait > self.max_wait:
+                self.rejected_rate += 1
+                raise ProviderBusy(429, f"{self.name} rate limit reached, retry later", token_wait)
+            if self.active >= self.max_concurrency or self.waiters:
+                if len(self.waiters) >= self.max_queue:
+                    self.rejected_busy += 1
+                    raise ProviderBusy(503, f"{self.name} is saturated, retry later", self.max_wait)
+                slot = concurrent.futures.Future()
+                self.waiters.append(slot)
+            else:
+                self.active += 1
+            if self.rate > 0:
+                # Reserve the token now; a negative balance is the queue of reservations
+                self.tokens -= 1
+        try:
+            if slot is not None:
+                await asyncio.wait({asyncio.wrap_future(slot)}, timeout=self.max_wait)
+                with self.lock:
+                    # cancel() only succeeds while the slot has not been handed over
+                    timed_out = slot.cancel()
+                    if timed_out:
+                        self.rejected_busy += 1
+                if timed_out:
+                    raise ProviderBusy(503, f"{self.name} is saturated, retry later", self.max_wait)
+            remaining = token_wait - (time.monotonic() - start)
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+        except BaseException:
+            with self.lock:
+                holding = slot is None or not slot.cancel()
+                if slot in self.waiters:
+                    self.waiters.remove(slot)
+                if self.rate > 0:
+                    # The call never went out, so hand its reserved token back
+                    self.tokens = min(self.burst, self.tokens + 1)
+            if holding:
+                self.release()
+            raise
+        with self.lock:
+            self.admitted += 1
+            self.wait_total += time.monotonic() - start
+
+    def release(self):
+        """Hand the slot to the next live waiter, or free it"""
+        with self.lock:
+            while self.waiters:
+                slot = self.waiters.popleft()
+                if slot.set_running_or_notify_cancel():
+                    slot.set_result(None)
+                    return
+            self.active -= 1
+
+    def load(self) -> int:
+        """Calls in flight plus calls queued"""
+        with self.lock:
+            return self.active + len(self.waiters)
+
+    def penalize(self, seconds: float):
+        """Hold new calls back after the provider itself says it is overloaded"""
+        with self.lock:
+            self.upstream_limited += 1
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "in_flight": self.active,
+                "queued": len(self.waiters),
+                "max_concurrency": self.max_concurrency,
+                "rate_per_sec": self.rate,
+                "admitted": self.admitted,
+                "rejected_rate_limited": self.rejected_rate,
+                "rejected_saturated": self.rejected_busy,
+                "upstream_rate_limited": self.upstream_limited,
+                "avg_wait_ms": round(self.wait_total / self.admitted * 1000, 2) if self.admitted else 0.0,
+            }
+
+provider_limiters = {name: ProviderLimiter.from_env(name) for name in ("openrouter", "gemini")}
+
+class ProviderUnavailable(HTTPException):
+    """A transient provider failure (5xx, timeout, dropped connection) worth retrying"""
+
+    def __init__(self, detail: str, reason: str, retry_after: Optional[float] = None):
+        super().__init__(status_code=500, detail=detail)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class RetryPolicy:
+    """Retries transient provider failures with capped exponential backoff.
+
+    Delays use full jitter, never undercut a provider's Retry-After, and a
+    retry is only attempted if it fits in the request's deadline budget.
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 deadline: float = 120.0):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        return cls(
+            int(os.getenv("PROVIDER_RETRY_ATTEMPTS", "3")),
+            float(os.getenv("PROVIDER_RETRY_BASE_SEC", "0.5")),
+            float(os.getenv("PROVIDER_RETRY_MAX_SEC", "8")),
+            float(os.getenv("PROVIDER_DEADLINE_SEC", "120")),
+        )
+
+    @staticmethod
+    def reason(error: Exception) -> Optional[str]:
+        """Why an error is retryable, or None when it is not"""
+        if isinstance(error, ProviderUnavailable):
+            return error.reason
+        if isinstance(error, ProviderBusy) and error.upstream:
+            return str(error.status_code)
+        return None
+
+    def backoff(self, retry: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+        return max(delay, getattr(error, "retry_after", None) or 0.0)
+
+    def _count(self, provider: str, field: str, reason: Optional[str] = None):
+        with self.lock:
+            stats = self.stats.setdefault(provider, {
+                "retries": 0, "recovered": 0, "exhausted": 0, "deadline_exceeded": 0, "reasons": {},
+            })
+            stats[field] += 1
+            if reason is not None:
+                stats["reasons"][reason] = stats["reasons"].get(reason, 0) + 1
+
+    async def run(self, provider: str, fn):
+        start = time.monotonic()
+        for attempt in range(self.attempts):
+            try:
+                result = await fn()
+            except Exception as e:
+                reason = self.reason(e)
+                if reason is None:
+                    raise
+                if attempt + 1 >= self.attempts:
+                    self._count(provider, "exhausted")
+                    raise
+                delay = self.backoff(attempt, e)
+                if time.monotonic() - start + delay > self.deadline:
+                    self._count(provider, "deadline_exceeded")
+                    raise
+                self._count(provider, "retries", reason)
+                logger.warning(f"{provider} call failed ({reason}), retrying in {delay:.2f}s")
+                await asyncio.sleep(delay)
+            else:
+                if attempt:
+                    self._count(provider, "recovered")
+                return result
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {provider: {**stats, "reasons": dict(stats["reasons"])}
+                    for provider, stats in self.stats.items()}
+
+provider_retry = RetryPolicy.from_env()
+
+def image_data_url(image: dict) -> str:
+    return f"data:{image['mime_type']};base64,{image['b64']}"
+
+async def call_openrouter_api(prompt: str, width: int, height: int, n: int,
+                              images: Optional[List[dict]] = None) -> dict:
+    """Call OpenRouter API for image generation.
+
+    Edits carry preprocessed input images, which only the chat completions
+    endpoint accepts, so they go there with image output enabled.
+    """
     api_key = os.getenv("OPENROUTER_API_KEY", "")
     
     # For tests, allow empty API key and rely on mocking
@@ -87,25 +1351,47 @@ def call_openrouter_api(prompt: str, width: int, height: int, n: int) -> dict:
         "response_format": "b64_json"
     }
     
+    url = "https://openrouter.ai/api/v1/images/generations"
+    if images:
+        url = "https://openrouter.ai/api/v1/chat/completions"
+        content = [{"type": "text", "text": f"{prompt}\n\nOutput size: {width}x{height}"}]
+        content += [{"type": "image_url", "image_url": {"url": image_data_url(image)}} for image in images]
+        payload = {
+            "model": os.getenv("OPENROUTER_EDIT_MODEL", "google/gemini-2.5-flash-image-preview"),
+            "messages": [{"role": "user", "content": content}],
+            "modalities": ["image", "text"],
+            "n": n
+        }
+    
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
     
     try:
-        response = requests.post("https://openrouter.ai/api/v1/images/generations",
-                               json=payload, headers=headers)
+        response = await provider_transport.post(url, json=payload, headers=headers)
         
+        if response.status_code in (429, 503):
+            raise ProviderBusy(response.status_code, f"OpenRouter is overloaded: {response.text}",
+                               parse_retry_after(response.headers.get("retry-after")), upstream=True)
+        if response.status_code >= 500:
+            retry_after = response.headers.get("retry-after")
+            raise ProviderUnavailable(f"OpenRouter API error: {response.text}", str(response.status_code),
+                                      parse_retry_after(retry_after) if retry_after else None)
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail=f"OpenRouter API error: {response.text}")
         
         return response.json()
-    except requests.exceptions.RequestException as e:
+    except httpx.TransportError as e:
+        logger.exception("Exception in API call")
+        raise ProviderUnavailable(f"Network error: {str(e)}", type(e).__name__)
+    except httpx.HTTPError as e:
         logger.exception("Exception in API call")
         raise HTTPException(status_code=500, detail=f"Network error: {str(e)}")
 
 
-def call_gemini(prompt: str, width: int, height: int, n: int) -> dict:
+async def call_gemini(prompt: str, width: int, height: int, n: int,
+                      images: Optional[List[dict]] = None) -> dict:
     """Call Gemini API for image generation"""
     api_key = os.getenv("GEMINI_API_KEY", "")
     
@@ -127,11 +1413,12 @@ def call_gemini(prompt: str, width: int, height: int, n: int) -> dict:
             }]
         }
     
+    parts = [{"text": prompt}]
+    for image in images or []:
+        parts.append({"inline_data": {"mime_type": image["mime_type"], "data": image["b64"]}})
     payload = {
         "contents": [{
-            "parts": [{
-                "text": prompt
-            }]
+            "parts": parts
         }],
         "generationConfig": {
             "response_mime_type": "image/png",
@@ -146,9 +1433,16 @@ def call_gemini(prompt: str, width: int, height: int, n: int) -> dict:
     }
     
     try:
-        response = requests.post(f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent?key={api_key}",
-                               json=payload, headers=headers)
+        response = await provider_transport.post(f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent?key={api_key}",
+                                           json=payload, headers=headers)
         
+        if response.status_code in (429, 503):
+            raise ProviderBusy(response.status_code, f"Gemini is overloaded: {response.text}",
+                               parse_retry_after(response.headers.get("retry-after")), upstream=True)
+        if response.status_code >= 500:
+            retry_after = response.headers.get("retry-after")
+            raise ProviderUnavailable(f"Gemini API error: {response.text}", str(response.status_code),
+                                      parse_retry_after(retry_after) if retry_after else None)
         if response.status_code != 200:
             raise HTTPException(status_code=500, detail=f"Gemini API error: {response.text}")
         
@@ -167,24 +1461,731 @@ def call_gemini(prompt: str, width: int, height: int, n: int) -> dict:
                 }
             }]
         }
-    except requests.exceptions.RequestException as e:
+    except httpx.TransportError as e:
+        logger.exception("Exception in API call")
+        raise ProviderUnavailable(f"Network error: {str(e)}", type(e).__name__)
+    except httpx.HTTPError as e:
         logger.exception("Exception in API call")
         raise HTTPException(status_code=500, detail=f"Network error: {str(e)}")
 
-def save_base64_image(b64_data: str, format: str = "png") -> str:
-    """Save base64 image data to storage and return filename"""
-    # Remove data URL prefix if present
-    if "," in b64_data:
-        b64_data = b64_data.split(",", 1)[1]
-    
-    image_data = base64.b64decode(b64_data)
+# Base64 characters decoded per step; a multiple of 4 so chunks decode independently
+B64_CHUNK_CHARS = 256 * 1024
+
+def store_base64_image(b64_data: str, format: str = "png") -> tuple:
+    """Save base64 image data and return (filename, size_bytes)
+
+    The payload is decoded in fixed-size chunks straight into a temp file while
+    it is hashed, so memory stays bounded whatever the resolution. The file then
+    becomes (or is deduplicated against) the blob for its SHA-256.
+    """
+    # Skip the data URL prefix by offset rather than splitting (which copies)
+    start = b64_data.find(",") + 1
     filename = f"{uuid4().hex}.{format}"
-    file_path = STORAGE_DIR / filename
     
-    with open(file_path, "wb") as f:
-        f.write(image_data)
+    fd, tmp_path = tempfile.mkstemp(dir=OBJECTS_DIR, suffix=".part")
+    digest = hashlib.sha256()
+    size_bytes = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            carry = ""
+            for offset in range(start, len(b64_data), B64_CHUNK_CHARS):
+                chunk = carry + "".join(b64_data[offset:offset + B64_CHUNK_CHARS].split())
+                usable = len(chunk) - len(chunk) % 4
+                carry = chunk[usable:]
+                data = base64.b64decode(chunk[:usable])
+                digest.update(data)
+                size_bytes += f.write(data)
+            if carry:
+                data = base64.b64decode(carry)
+                digest.update(data)
+                size_bytes += f.write(data)
+        image_catalog.add_object(filename, digest.hexdigest(), size_bytes, time.time(), tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
     
-    return filename
+    image_pipeline.publish(filename, digest.hexdigest())
+    return filename, size_bytes
+
+def save_base64_image(b64_data: str, format: str = "png") -> str:
+    """Save base64 image data to storage and return filename"""
+    return store_base64_image(b64_data, format)[0]
+
+PROVIDERS = ("openrouter", "gemini")
+
+class CircuitBreaker:
+    """Tracks one provider's health over its most recent calls.
+
+    Opens when the share of failed or slow calls in the window crosses
+    ``error_rate``; after ``open_sec`` a single half-open probe decides
+    whether it closes again or stays open for another cooldown. Only the
+    caller holding the probe token from ``allow()`` can settle or give
+    back the probe.
+    """
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, error_rate: float = 0.5,
+                 slow_sec: float = 30.0, open_sec: float = 30.0):
+        self.name = name
+        self.window = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_sec = slow_sec
+        self.open_sec = open_sec
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = None
+        self.trips = 0
+
+    @classmethod
+    def from_env(cls, name: str) -> "CircuitBreaker":
+        return cls(
+            name,
+            int(os.getenv("BREAKER_WINDOW", "20")),
+            int(os.getenv("BREAKER_MIN_CALLS", "5")),
+            float(os.getenv("BREAKER_ERROR_RATE", "0.5")),
+            float(os.getenv("BREAKER_SLOW_SEC", "30")),
+            float(os.getenv("BREAKER_OPEN_SEC", "30")),
+        )
+
+    def allow(self):
+        """Whether auto routing may send a call here now.
+
+        Returns False when refused, True when closed, or a probe token when
+        this call claimed the half-open probe.
+        """
+        with self.lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.open_sec:
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self.probing is not None:
+                    return False
+                self.probing = object()
+                return self.probing
+            return self.state == "closed"
+
+    def healthy(self) -> bool:
+        """Closed, so a call can go here without waiting on a probe"""
+        with self.lock:
+            return self.state == "closed"
+
+    def retry_in(self) -> float:
+        """Seconds until an open breaker will let a probe through"""
+        with self.lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.opened_at + self.open_sec - time.monotonic())
+
+    def _trip(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        logger.error(f"circuit breaker for {self.name} opened")
+
+    def record(self, ok: bool, latency: float, probe=None):
+        healthy = ok and latency < self.slow_sec
+        with self.lock:
+            if self.state == "half_open" and probe is not None and probe is self.probing:
+                self.probing = None
+                if healthy:
+                    self.state = "closed"
+                    self.window.clear()
+                else:
+                    self._trip()
+                return
+            self.window.append((healthy, latency))
+            if self.state == "closed" and len(self.window) >= self.min_calls:
+                failures = sum(1 for good, _ in self.window if not good)
+                if failures / len(self.window) >= self.error_rate:
+                    self._trip()
+
+    def release(self, probe=None):
+        """Give back a half-open probe that ended without a verdict (e.g. cancelled)"""
+        with self.lock:
+            if probe is not None and probe is self.probing:
+                self.probing = None
+
+    def status(self) -> dict:
+        with self.lock:
+            calls = len(self.window)
+            failures = sum(1 for good, _ in self.window if not good)
+            return {
+                "state": self.state,
+                "calls": calls,
+                "error_rate": round(failures / calls, 4) if calls else 0.0,
+                "avg_latency_ms": round(sum(lat for _, lat in self.window) / calls * 1000, 2) if calls else 0.0,
+                "trips": self.trips,
+                "retry_in_sec": round(max(0.0, self.opened_at + self.open_sec - time.monotonic()), 2)
+                if self.state == "open" else 0.0,
+            }
+
+provider_breakers = {name: CircuitBreaker.from_env(name) for name in PROVIDERS}
+
+def auto_order() -> List[str]:
+    """Providers auto mode tries, most preferred first"""
+    order = [name.strip().lower() for name in os.getenv("PROVIDER_AUTO_ORDER", ",".join(PROVIDERS)).split(",")]
+    return [name for name in order if name in PROVIDERS] or list(PROVIDERS)
+
+def resolve_provider(provider: Optional[str]) -> str:
+    """Apply the PROVIDER default and reject unknown providers"""
+    provider = (provider or os.getenv("PROVIDER", "openrouter")).lower()
+    if provider not in PROVIDERS + ("auto",):
+        raise HTTPException(status_code=400, detail="Invalid provider. Use 'openrouter', 'gemini' or 'auto'")
+    return provider
+
+class ProviderRouter:
+    """Ranks providers for auto mode by expected latency.
+
+    Expected latency is the EWMA of recent successful calls plus an error
+    penalty (the EWMA of the failure rate times ``error_penalty`` seconds),
+    scaled up by how full the provider's limiter is and by its cost weight.
+    Failures never feed the latency stats, so a provider that fails fast
+    doesn't look fast. Providers with no samples yet rank first so they get
+    measured.
+    """
+
+    def __init__(self, alpha: float = 0.3, samples: int = 100, hedge: bool = False,
+                 hedge_after: float = 0.0, hedge_min_samples: int = 20, error_penalty: float = 30.0):
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.hedge_min_samples = hedge_min_samples
+        self.lock = threading.Lock()
+        self.ewma = {}
+        self.error_ewma = {}
+        self.recent = {name: deque(maxlen=samples) for name in PROVIDERS}
+        self.picks = {name: 0 for name in PROVIDERS}
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls) -> "ProviderRouter":
+        return cls(
+            float(os.getenv("ROUTER_EWMA_ALPHA", "0.3")),
+            hedge=os.getenv("ROUTER_HEDGE", "0") == "1",
+            hedge_after=float(os.getenv("ROUTER_HEDGE_AFTER_SEC", "0")),
+            hedge_min_samples=int(os.getenv("ROUTER_HEDGE_MIN_SAMPLES", "20")),
+            error_penalty=float(os.getenv("ROUTER_ERROR_PENALTY_SEC", "30")),
+        )
+
+    def _update(self, averages: dict, name: str, value: float):
+        previous = averages.get(name)
+        averages[name] = value if previous is None else self.alpha * value + (1 - self.alpha) * previous
+
+    def observe(self, name: str, latency: float, ok: bool = True):
+        with self.lock:
+            self._update(self.error_ewma, name, 0.0 if ok else 1.0)
+            if ok:
+                self._update(self.ewma, name, latency)
+                self.recent[name].append(latency)
+
+    def p95(self, name: str) -> Optional[float]:
+        with self.lock:
+            samples = sorted(self.recent[name])
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def score(self, name: str) -> float:
+        limiter = provider_limiters[name]
+        with self.lock:
+            expected = self.ewma.get(name, 0.0) + self.error_ewma.get(name, 0.0) * self.error_penalty
+        return expected * (1 + limiter.load() / limiter.max_concurrency) * float(_provider_env(name, "COST_WEIGHT", "1"))
+
+    def order(self) -> List[str]:
+        preference = auto_order()
+        return sorted(preference, key=lambda name: (self.score(name), preference.index(name)))
+
+    def hedge_delay(self, name: str) -> Optional[float]:
+        """How long to give ``name`` before firing a hedge, or None to never hedge"""
+        if not self.hedge:
+            return None
+        if self.hedge_after > 0:
+            return self.hedge_after
+        with self.lock:
+            if len(self.recent[name]) < self.hedge_min_samples:
+                return None
+        return self.p95(name)
+
+    def count(self, field: str, name: Optional[str] = None):
+        with self.lock:
+            if field == "picks":
+                self.picks[name] += 1
+            else:
+                setattr(self, field, getattr(self, field) + 1)
+
+    def status(self) -> dict:
+        providers = {}
+        for name in PROVIDERS:
+            p95 = self.p95(name)
+            with self.lock:
+                ewma = self.ewma.get(name)
+                error_rate = self.error_ewma.get(name)
+                picks = self.picks[name]
+            providers[name] = {
+                "ewma_ms": round(ewma * 1000, 2) if ewma is not None else None,
+                "error_rate": round(error_rate, 3) if error_rate is not None else None,
+                "p95_ms": round(p95 * 1000, 2) if p95 is not None else None,
+                "load": provider_limiters[name].load(),
+                "score": round(self.score(name), 4),
+                "picks": picks,
+            }
+        with self.lock:
+            return {"hedging": self.hedge, "hedges": self.hedges, "hedge_wins": self.hedge_wins,
+                    "providers": providers}
+
+provider_router = ProviderRouter.from_env()
+
+async def call_auto(prompt: str, width: int, height: int, n: int, images: Optional[List[dict]]) -> dict:
+    """Send an auto-mode call to the best-ranked healthy provider.
+
+    A failure fails over to the next provider, without retrying the
+    failed one first while a healthy provider is still left to try. With
+    hedging on, a call still running past the provider's p95 gets a second
+    provider raced against it; the first success wins and the loser is
+    cancelled.
+    """
+    candidates = deque(provider_router.order())
+
+    def launch():
+        # allow() may claim a half-open probe, so ask only when about to call
+        while candidates:
+            name = candidates.popleft()
+            probe = provider_breakers[name].allow()
+            if probe:
+                provider_router.count("picks", name)
+                retry = not any(provider_breakers[other].healthy() for other in candidates)
+                call = _call_one(name, prompt, width, height, n, images, probe=probe, retry=retry)
+                return asyncio.ensure_future(call), name
+        return None, None
+
+    task, name = launch()
+    if task is None:
+        retry_in = min(provider_breakers[name].retry_in() for name in PROVIDERS)
+        raise ProviderBusy(503, "No healthy provider available, retry later", retry_in)
+    running = {task: name}
+    primary = task
+    hedge_after = provider_router.hedge_delay(name)
+    last_error = None
+    try:
+        while running:
+            done, _ = await asyncio.wait(running, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_after = None
+                task, name = launch()
+                if task is not None:
+                    provider_router.count("hedges")
+                    running[task] = name
+                continue
+            for task in done:
+                name = running.pop(task)
+                if task.exception() is None:
+                    if task is not primary:
+                        provider_router.count("hedge_wins")
+                    return task.result()
+                last_error = task.exception()
+                logger.error(f"auto provider {name} failed, trying the next one: {last_error}")
+            if not running:
+                hedge_after = None
+                task, name = launch()
+                if task is not None:
+                    running[task] = name
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+    raise last_error
+
+async def _call_one(provider: str, prompt: str, width: int, height: int, n: int,
+                    images: Optional[List[dict]], probe=None, retry: bool = True) -> dict:
+    """Call one provider within its limits, retrying transient failures.
+
+    The slot is given back between attempts, and every attempt's outcome
+    feeds the provider's circuit breaker and routing stats. An attempt that
+    ends without reaching the provider (no slot, or cancelled) gives back
+    the half-open ``probe`` from ``allow()`` if it holds one.
+    """
+    limiter = provider_limiters[provider]
+    breaker = provider_breakers[provider]
+
+    async def attempt():
+        settled = False
+        try:
+            async with limiter.slot():
+                start = time.monotonic()
+
+                def settle(ok: bool):
+                    nonlocal settled
+                    settled = True
+                    elapsed = time.monotonic() - start
+                    breaker.record(ok, elapsed, probe)
+                    provider_router.observe(provider, elapsed, ok)
+
+                try:
+                    if provider == "openrouter":
+                        result = await call_openrouter_api(prompt, width, height, n, images=images)
+                    else:
+                        result = await call_gemini(prompt, width, height, n, images=images)
+                except ProviderBusy as e:
+                    limiter.penalize(e.retry_after)
+                    settle(False)
+                    raise
+                except Exception:
+                    settle(False)
+                    raise
+                settle(True)
+                return result
+        finally:
+            if not settled:
+                breaker.release(probe)
+
+    if not retry:
+        return await attempt()
+    return await provider_retry.run(provider, attempt)
+
+async def call_provider(provider: str, prompt: str, width: int, height: int, n: int,
+                        images: Optional[List[dict]] = None) -> dict:
+    """Dispatch to the adapter for an already resolved provider"""
+    if provider != "auto":
+        return await _call_one(provider, prompt, width, height, n, images)
+    return await call_auto(prompt, width, height, n, images)
+
+@app.get("/providers/status")
+def providers_status():
+    """Circuit breaker state per provider, as seen by auto routing"""
+    return {
+        "default": os.getenv("PROVIDER", "openrouter").lower(),
+        "auto_order": auto_order(),
+        "providers": {name: breaker.status() for name, breaker in provider_breakers.items()},
+        "routing": provider_router.status(),
+    }
+
+async def save_provider_images(api_response: dict, fmt: str) -> List[dict]:
+    """Save every image in an OpenRouter-format response and describe the files"""
+    results = []
+    if "choices" in api_response:
+        for choice in api_response["choices"]:
+            if "message" in choice and "images" in choice["message"]:
+                for image in choice["message"]["images"]:
+                    if "image_url" in image and "url" in image["image_url"]:
+                        b64_data = image["image_url"]["url"]
+                        filename, size_bytes = await run_in_threadpool(store_base64_image, b64_data, fmt)
+                        results.append({
+                            "filename": filename,
+                            "size_bytes": size_bytes,
+                            "url": f"/static/images/{filename}"
+                        })
+    return results
+
+class SingleFlight:
+    """Lets identical concurrent calls share one execution.
+
+    The first caller for a key runs the work; callers arriving while it is in
+    flight wait on the same result instead of issuing their own. A thread-safe
+    future is used so API requests and worker threads (each on their own event
+    loop) coalesce with each other too.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn):
+        with self.lock:
+            future = self.inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.inflight[key] = future
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {"in_flight": len(self.inflight), "upstream_calls": self.leaders,
+                    "coalesced_waiters": self.coalesced}
+
+provider_flights = SingleFlight()
+
+# Pillow releases the GIL while decoding, resizing and encoding, so threads scale here
+derivative_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("DERIVATIVE_WORKERS", "2")), thread_name_prefix="derivative"
+)
+
+class DerivativeCache:
+    """Disk LRU of resized/transcoded image variants.
+
+    Variants are keyed by the source's content hash plus the requested
+    size and format, so aliases of one blob share them and a replaced
+    image never serves a stale variant.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.index = None
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(source_key: str, width: Optional[int], height: Optional[int], fmt: str) -> str:
+        return f"{source_key}-{width or 0}x{height or 0}.{fmt}"
+
+    def _load_index(self):
+        # Oldest first, by the mtime that hits refresh
+        self.dir.mkdir(parents=True, exist_ok=True)
+        entries = sorted((p.stat().st_mtime, p.name, p.stat().st_size)
+                         for p in self.dir.iterdir() if p.is_file() and not p.name.endswith(".part"))
+        self.index = OrderedDict((name, size) for _, name, size in entries)
+        self.used = sum(self.index.values())
+
+    def get(self, key: str, count: bool = True) -> Optional[Path]:
+        with self.lock:
+            if self.index is None:
+                self._load_index()
+            found = key in self.index
+            if found:
+                self.index.move_to_end(key)
+            if count:
+                if found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        if not found:
+            return None
+        path = self.dir / key
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.used -= self.index.pop(key, 0)
+            return None
+        return path
+
+    def temp_path(self) -> Path:
+        with self.lock:
+            if self.index is None:
+                self._load_index()
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".part")
+        os.close(fd)
+        return Path(tmp)
+
+    def put(self, key: str, tmp_path: Path) -> Path:
+        size = tmp_path.stat().st_size
+        path = self.dir / key
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.used += size - self.index.pop(key, 0)
+            self.index[key] = size
+            evict = []
+            # Never evict the variant just written
+            while self.used > self.max_bytes and len(self.index) > 1:
+                name, evicted_size = self.index.popitem(last=False)
+                self.used -= evicted_size
+                self.evictions += 1
+                evict.append(name)
+        for name in evict:
+            (self.dir / name).unlink(missing_ok=True)
+        return path
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.index or ()),
+                "bytes": self.used,
+            }
+
+derivative_cache = DerivativeCache(
+    Path(os.getenv("DERIVATIVES_DIR", "storage/derivatives")),
+    int(os.getenv("DERIVATIVES_MAX_BYTES", str(256 * 1024 * 1024))),
+)
+derivative_flights = SingleFlight()
+
+def perceptual_hash(img: Image.Image) -> str:
+    """64-bit difference hash; visually similar images differ in few bits"""
+    pixels = img.convert("L").resize((9, 8), Image.Resampling.LANCZOS).tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = bits << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+def _derivative_specs(spec: str) -> List[tuple]:
+    """Parse PRECOMPUTE_DERIVATIVES, e.g. "256:webp,1024:avif" -> [(256, "webp"), (1024, "avif")]"""
+    specs = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        width, _, fmt = item.partition(":")
+        fmt = (fmt or "webp").lower()
+        if not width.isdigit() or fmt not in DERIVATIVE_FORMATS:
+            logger.warning(f"ignoring derivative spec {item!r}")
+            continue
+        specs.append((min(int(width), DERIVATIVE_MAX_DIM), fmt))
+    return specs
+
+class ImagePipeline:
+    """Post-save work run off the request path: metadata, perceptual hash
+    and warm derivatives.
+
+    Saves publish onto a bounded queue drained by background threads. When
+    the queue is full the event is dropped; metadata is then missing and
+    derivatives are rendered lazily on first request instead.
+    """
+
+    def __init__(self, workers: int, maxsize: int, derivatives: List[tuple]):
+        self.workers = workers
+        self.derivatives = derivatives
+        self.queue = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.threads = []
+        self.pid = None
+        self.published = 0
+        self.dropped = 0
+        self.processed = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        # Started lazily, so each worker process that saves images gets its own threads
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.threads = [threading.Thread(target=self._run, name=f"image-pipeline-{i}", daemon=True)
+                            for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def publish(self, filename: str, content_hash: str):
+        """Announce a saved image; never blocks the caller"""
+        if self.workers <= 0:
+            return
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((filename, content_hash))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return
+        with self.lock:
+            self.published += 1
+
+    def _run(self):
+        while True:
+            filename, content_hash = self.queue.get()
+            try:
+                self.process(content_hash)
+                with self.lock:
+                    self.processed += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                logger.warning(f"post-save processing of {filename} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    def process(self, content_hash: str):
+        with object_storage.local_file(object_key(content_hash)) as source:
+            if not image_catalog.has_metadata(content_hash):
+                with Image.open(source) as img:
+                    fmt = img.format
+                    img = ImageOps.exif_transpose(img)
+                    image_catalog.set_metadata(content_hash, img.width, img.height, fmt, perceptual_hash(img))
+            for width, fmt in self.derivatives:
+                build_derivative(source, DerivativeCache.key(content_hash, width, None, fmt), width, None, fmt)
+
+    def join(self):
+        """Wait until everything published so far has been processed"""
+        self.queue.join()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {"queued": self.queue.qsize(), "published": self.published, "dropped": self.dropped,
+                    "processed": self.processed, "failed": self.failed}
+
+image_pipeline = ImagePipeline(
+    int(os.getenv("IMAGE_PIPELINE_WORKERS", "1")),
+    int(os.getenv("IMAGE_PIPELINE_QUEUE", "1000")),
+    _derivative_specs(os.getenv("PRECOMPUTE_DERIVATIVES", f"{THUMBNAIL_WIDTH}:webp,1024:webp")),
+)
+
+def render_derivative(source: Path, dest: Path, width: Optional[int], height: Optional[int], fmt: str):
+    """Downscale ``source`` to fit width x height (either may be omitted) and encode as ``fmt``"""
+    with Image.open(source) as img:
+        bounds = (width or img.width, height or img.height)
+        img.draft("RGB", bounds)
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail(bounds, Image.Resampling.LANCZOS)
+        if fmt == "jpeg":
+            img = img.convert("RGB")
+            img.save(dest, format="JPEG", quality=85, optimize=True, progressive=True)
+        elif fmt in ("webp", "avif"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+            if fmt == "webp":
+                img.save(dest, format="WEBP", quality=80, method=4)
+            else:
+                img.save(dest, format="AVIF", quality=60)
+        else:
+            img.save(dest, format="PNG", optimize=True)
+
+def build_derivative(source, key: str, width: Optional[int], height: Optional[int], fmt: str) -> Path:
+    """Render a variant unless cached; ``source`` is a local Path or an object storage key"""
+    path = derivative_cache.get(key, count=False)
+    if path is not None:
+        return path
+    tmp = derivative_cache.temp_path()
+    try:
+        with nullcontext(source) if isinstance(source, Path) else object_storage.local_file(source) as local:
+            render_derivative(local, tmp, width, height, fmt)
+        return derivative_cache.put(key, tmp)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+async def derivative_for(source, source_key: str, width: Optional[int], height: Optional[int],
+                         fmt: str) -> Path:
+    """Cached variant of an image, rendered once on the derivative pool on a miss"""
+    key = DerivativeCache.key(source_key, width, height, fmt)
+    path = derivative_cache.get(key)
+    if path is not None:
+        return path
+    loop = asyncio.get_running_loop()
+    return await derivative_flights.do(
+        key, lambda: loop.run_in_executor(derivative_executor, build_derivative, source, key, width, height, fmt))
+
+async def generate_images(provider: str, prompt: str, width: int, height: int, n: int, fmt: str) -> List[dict]:
+    """Call the provider and save its images, coalescing identical in-flight requests"""
+    key = json.dumps([provider, prompt, width, height, n, fmt.lower()])
+
+    async def run():
+        api_response = await call_provider(provider, prompt, width, height, n)
+        return await save_provider_images(api_response, fmt)
+
+    return await provider_flights.do(key, run)
 
 @app.post("/images/generate", status_code=201)
 async def images_generate(
@@ -208,6 +2209,7 @@ async def images_generate(
         
     if not prompt:
         raise HTTPException(status_code=422, detail="prompt is required")
+    fmt = output_format(fmt)
     
     try:
         # Accept JSON as well as form-data
@@ -223,97 +2225,489 @@ async def images_generate(
         if not prompt:
             raise HTTPException(status_code=422, detail="prompt is required")
         
-        provider = (provider or os.getenv("PROVIDER", "openrouter")).lower()
-        if provider not in ["openrouter", "gemini"]:
-            raise HTTPException(status_code=400, detail="Invalid provider. Use 'openrouter' or 'gemini'")
+        provider = resolve_provider(provider)
         
-        # Call the API (mocked in tests)
-        if provider == "openrouter":
-            api_response = call_openrouter_api(prompt, width, height, n)
-        else:
-            api_response = call_gemini(prompt, width, height, n)
+        # Opt-in: identical requests reuse the images saved the first time
+        cache_key = None
+        if os.getenv("RESULT_CACHE", "0") == "1":
+            cache_key = ResultCache.key(prompt=prompt, negative_prompt=negative_prompt or "",
+                                        provider=provider, width=width, height=height,
+                                        fmt=fmt, n=n)
+            cached = await run_in_threadpool(result_cache.get, cache_key)
+            if cached is not None:
+                return JSONResponse(content=cached, status_code=200, headers={"X-Cache": "HIT"})
         
-        results = []
-        if "choices" in api_response:
-            for choice in api_response["choices"]:
-                if "message" in choice and "images" in choice["message"]:
-                    for image in choice["message"]["images"]:
-                        if "image_url" in image and "url" in image["image_url"]:
-                            b64_data = image["image_url"]["url"]
-                            filename = save_base64_image(b64_data, fmt)
-                            file_path = STORAGE_DIR / filename
-                            results.append({
-                                "filename": filename,
-                                "size_bytes": file_path.stat().st_size,
-                                "url": f"/static/images/{filename}"
-                            })
+        # Call the API (mocked in tests)
+        results = await generate_images(provider, prompt, width, height, n, fmt)
         
-        return JSONResponse(content=results, status_code=200)
+        if cache_key is None:
+            return JSONResponse(content=results, status_code=200)
+        if results:
+            await run_in_threadpool(result_cache.put, cache_key, results)
+        return JSONResponse(content=results, status_code=200, headers={"X-Cache": "MISS"})
         
+    except ProviderBusy:
+        raise
     except Exception as e:
         logger.exception("generate_image failed")
         if "API key not configured" in str(e):
             raise HTTPException(status_code=500, detail="OpenRouter API key not configured")
         raise HTTPException(status_code=500, detail=f"Image generation failed: {str(e)}")
 
-@app.post("/images/edit", status_code=201)
-async def images_edit(
-    prompt: Optional[str] = Form(None),
-    mode: Optional[str] = Form("composite"),
-    preset: Optional[str] = Form(None),
-    provider: Optional[str] = Form(None),
-    width: int = Form(512),
-    height: int = Form(512),
-    fmt: str = Form("png"),
-    n: int = Form(1),
-    base: Optional[UploadFile] = File(None),
-    mask: Optional[UploadFile] = File(None),
-    refs: Optional[List[UploadFile]] = File(None)
-):
-    if not base:
-        raise HTTPException(status_code=422, detail="base image is required")
-    
-    # Validate number of refs if provided
-    if refs and len(refs) > 7:
-        raise HTTPException(status_code=400, detail="Too many reference images (max 7)")
-    
-    if not prompt:
-        raise HTTPException(status_code=422, detail="prompt is required")
-    
+UPLOAD_MAX_FILE_BYTES = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_MAX_TOTAL_BYTES = int(os.getenv("UPLOAD_MAX_TOTAL_BYTES", str(100 * 1024 * 1024)))
+UPLOAD_SPOOL_BYTES = 1024 * 1024
+UPLOAD_FIELD_MAX_BYTES = 64 * 1024
+UPLOAD_FILE_FIELDS = ("base", "mask", "refs")
+MAX_REFS = 7
+SNIFF_BYTES = 12
+
+def sniff_image(head: bytes) -> Optional[str]:
+    """Identify an image format from its first bytes"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+class IngestedFile:
+    """An uploaded image, size-checked, sniffed and hashed as it streamed in"""
+
+    def __init__(self, field: str, filename: str, content_type: Optional[str]):
+        self.field = field
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+        self.size = 0
+        self.kind = None
+        self.head = b""
+        self.digest = hashlib.sha256()
+
+    @property
+    def sha256(self) -> str:
+        return self.digest.hexdigest()
+
+    def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > UPLOAD_MAX_FILE_BYTES:
+            raise HTTPException(status_code=413, detail=f"{self.field} exceeds {UPLOAD_MAX_FILE_BYTES} bytes")
+        if self.kind is None:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) >= SNIFF_BYTES:
+                self._sniff()
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self):
+        if self.kind is None:
+            self._sniff()
+        self.file.seek(0)
+
+    def _sniff(self):
+        self.kind = sniff_image(self.head)
+        if self.kind is None:
+            raise HTTPException(status_code=415, detail=f"{self.field} is not a supported image")
+
+    def read(self) -> bytes:
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+def close_uploads(files: dict):
+    for uploads in files.values():
+        for upload in uploads:
+            upload.close()
+
+async def ingest_upload(request: Request) -> tuple:
+    """Stream a form body, enforcing upload limits before the whole body is read.
+
+    Returns the scalar fields and a ``{field: [IngestedFile, ...]}`` map; the
+    caller closes the files with ``close_uploads``.
+    """
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > UPLOAD_MAX_TOTAL_BYTES:
+        raise HTTPException(status_code=413, detail=f"Request body exceeds {UPLOAD_MAX_TOTAL_BYTES} bytes")
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data":
+        form = await request.form()
+        return {key: value for key, value in form.multi_items() if isinstance(value, str)}, {}
+    boundary = options.get(b"boundary")
+    if not boundary:
+        raise HTTPException(status_code=400, detail="Missing multipart boundary")
+
+    fields, files = {}, {}
+    part = {}
+
+    def on_part_begin():
+        part.clear()
+        part.update(headers={}, field=b"", value=b"", upload=None, data=b"")
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][part["field"].lower()] = part["value"]
+        part["field"], part["value"] = b"", b""
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        part["name"] = disposition.get(b"name", b"").decode("latin-1")
+        filename = disposition.get(b"filename")
+        if filename is None:
+            return
+        if part["name"] not in UPLOAD_FILE_FIELDS:
+            raise HTTPException(status_code=400, detail=f"Unexpected file field: {part['name']}")
+        if part["name"] == "refs" and len(files.get("refs", [])) >= MAX_REFS:
+            raise HTTPException(status_code=400, detail=f"Too many reference images (max {MAX_REFS})")
+        content_type = part["headers"].get(b"content-type")
+        part["upload"] = IngestedFile(
+            part["name"], filename.decode("utf-8", "replace"),
+            content_type.decode("latin-1") if content_type else None,
+        )
+
+    def on_part_data(data, start, end):
+        chunk = data[start:end]
+        if part["upload"] is not None:
+            part["upload"].write(chunk)
+            return
+        part["data"] += chunk
+        if len(part["data"]) > UPLOAD_FIELD_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Field {part['name']} is too large")
+
+    def on_part_end():
+        upload = part["upload"]
+        if upload is None:
+            fields[part["name"]] = part["data"].decode("utf-8", "replace")
+        elif upload.size == 0:
+            # Browsers send an empty part for a file input left blank
+            upload.close()
+        else:
+            upload.finish()
+            files.setdefault(upload.field, []).append(upload)
+        part["upload"] = None
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    })
+    received = 0
     try:
-        if not prompt:
-            raise HTTPException(status_code=422, detail="prompt is required")
-        
-        provider = (provider or os.getenv("PROVIDER", "openrouter")).lower()
-        if provider not in ["openrouter", "gemini"]:
-            raise HTTPException(status_code=400, detail="Invalid provider. Use 'openrouter' or 'gemini'")
-        
-        # Call the API (mocked in tests)
-        if provider == "openrouter":
-            api_response = call_openrouter_api(prompt, width, height, n)
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > UPLOAD_MAX_TOTAL_BYTES:
+                raise HTTPException(status_code=413, detail=f"Request body exceeds {UPLOAD_MAX_TOTAL_BYTES} bytes")
+            if received > UPLOAD_SPOOL_BYTES:
+                # Past the spool size uploads go to disk; keep that off the event loop
+                await run_in_threadpool(parser.write, chunk)
+            else:
+                parser.write(chunk)
+        if received > UPLOAD_SPOOL_BYTES:
+            await run_in_threadpool(parser.finalize)
         else:
-            api_response = call_gemini(prompt, width, height, n)
+            parser.finalize()
+    except BaseException:
+        if part.get("upload") is not None:
+            part["upload"].close()
+        close_uploads(files)
+        raise
+    return fields, files
+
+PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", "2"))
+PREPROCESS_JPEG_QUALITY = int(os.getenv("PREPROCESS_JPEG_QUALITY", "90"))
+# Pillow releases the GIL while decoding, resizing and encoding, so threads scale here
+preprocess_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=PREPROCESS_WORKERS, thread_name_prefix="preprocess"
+)
+
+def _open_image(data: bytes, role: str, size: tuple) -> Image.Image:
+    try:
+        img = Image.open(io.BytesIO(data))
+        # JPEG can decode straight to a reduced scale, which is much cheaper than a full decode
+        img.draft("RGB", size)
+        return ImageOps.exif_transpose(img)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=422, detail=f"{role} is not a readable image: {e}")
+
+def _encode(img: Image.Image, fmt: str, **options) -> bytes:
+    out = io.BytesIO()
+    img.save(out, format=fmt, **options)
+    return out.getvalue()
+
+def _prepared(role: str, mime_type: str, encoded: bytes, img: Image.Image) -> dict:
+    """A provider-ready input; base64 is computed once here, not per request body"""
+    return {"role": role, "mime_type": mime_type, "b64": base64.b64encode(encoded).decode("ascii"),
+            "width": img.width, "height": img.height}
+
+def preprocess_image(data: bytes, role: str, width: int, height: int) -> dict:
+    """Downscale an input to fit width x height and re-encode it once.
+
+    Opaque images become JPEG; images with real transparency stay PNG.
+    """
+    img = _open_image(data, role, (width, height))
+    img.thumbnail((width, height), Image.Resampling.LANCZOS)
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        if img.getchannel("A").getextrema()[0] < 255:
+            encoded = _encode(img, "PNG", optimize=True)
+            return _prepared(role, "image/png", encoded, img)
+    img = img.convert("RGB")
+    encoded = _encode(img, "JPEG", quality=PREPROCESS_JPEG_QUALITY, optimize=True)
+    return _prepared(role, "image/jpeg", encoded, img)
+
+def preprocess_mask(data: bytes, size: tuple) -> dict:
+    """Reduce a mask to a 1-bit PNG matching the processed base size.
+
+    The alpha channel is used when the mask has one, otherwise luminance.
+    """
+    img = _open_image(data, "mask", size)
+    if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA").getchannel("A")
+    else:
+        img = img.convert("L")
+    img = img.resize(size, Image.Resampling.NEAREST).point(lambda v: 255 if v >= 128 else 0).convert("1")
+    encoded = _encode(img, "PNG", optimize=True)
+    return _prepared("mask", "image/png", encoded, img)
+
+class PreprocessCache:
+    """LRU of prepared reference images, in memory and on disk.
+
+    Keyed by the upload's content hash and the target size, so a repeated
+    ref skips decode, resize, encode and base64 entirely.
+    """
+
+    def __init__(self, directory: Path, memory_bytes: int, disk_bytes: int):
+        self.dir = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.disk = None
+        self.disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(content_hash: str, width: int, height: int) -> str:
+        return f"{content_hash}-{width}x{height}"
+
+    def _load_disk_index(self):
+        # Oldest first, by the mtime that hits refresh
+        self.dir.mkdir(parents=True, exist_ok=True)
+        entries = sorted((p.stat().st_mtime, p.name, p.stat().st_size) for p in self.dir.iterdir() if p.is_file())
+        self.disk = OrderedDict((name, size) for _, name, size in entries)
+        self.disk_used = sum(self.disk.values())
+
+    def _remember(self, key: str, entry: dict):
+        size = len(entry["b64"])
+        if size > self.memory_bytes:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_used -= len(old["b64"])
+        self.memory[key] = entry
+        self.memory_used += size
+        while self.memory_used > self.memory_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= len(evicted["b64"])
+
+    def _read_disk(self, key: str) -> Optional[dict]:
+        path = self.dir / key
+        try:
+            with open(path, "r", encoding="ascii") as f:
+                mime_type, width, height = f.readline().split()
+                b64 = f.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return {"mime_type": mime_type, "b64": b64, "width": int(width), "height": int(height)}
+
+    def _write_disk(self, key: str, entry: dict):
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "w", encoding="ascii") as f:
+                f.write(f"{entry['mime_type']} {entry['width']} {entry['height']}\n")
+                f.write(entry["b64"])
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self.dir / key)
+        except OSError:
+            logger.exception("preprocess cache write failed")
+            Path(tmp).unlink(missing_ok=True)
+            return
+        with self.lock:
+            self.disk_used += size - self.disk.pop(key, 0)
+            self.disk[key] = size
+            evict = []
+            while self.disk_used > self.disk_bytes and self.disk:
+                name, evicted_size = self.disk.popitem(last=False)
+                self.disk_used -= evicted_size
+                evict.append(name)
+        for name in evict:
+            (self.dir / name).unlink(missing_ok=True)
+
+    def get_or_create(self, content_hash: str, size_bytes: int, width: int, height: int, create) -> dict:
+        """Return the cached entry for this upload and size, or build and store it"""
+        key = self.key(content_hash, width, height)
+        with self.lock:
+            if self.disk is None:
+                self._load_disk_index()
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += size_bytes
+                return entry
+            on_disk = key in self.disk
+        if on_disk:
+            entry = self._read_disk(key)
+            if entry is not None:
+                with self.lock:
+                    if key in self.disk:
+                        self.disk.move_to_end(key)
+                    self._remember(key, entry)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self.bytes_saved += size_bytes
+                return entry
+        entry = create()
+        with self.lock:
+            self.misses += 1
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "memory_entries": len(self.memory),
+                "memory_bytes": self.memory_used,
+                "disk_entries": len(self.disk or ()),
+                "disk_bytes": self.disk_used,
+            }
+
+preprocess_cache = PreprocessCache(
+    Path(os.getenv("PREPROCESS_CACHE_DIR", "storage/preprocessed")),
+    int(os.getenv("PREPROCESS_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024))),
+    int(os.getenv("PREPROCESS_CACHE_DISK_BYTES", str(512 * 1024 * 1024))),
+)
+
+def preprocess_uploads(base: IngestedFile, mask: Optional[IngestedFile], refs: List[IngestedFile],
+                       width: int, height: int) -> List[dict]:
+    """Prepare the base, mask and refs of an edit request for the provider"""
+    inputs = [preprocess_image(base.read(), "base", width, height)]
+    if mask is not None:
+        inputs.append(preprocess_mask(mask.read(), (inputs[0]["width"], inputs[0]["height"])))
+    for ref in refs:
+        entry = preprocess_cache.get_or_create(
+            ref.sha256, ref.size, width, height,
+            lambda: preprocess_image(ref.read(), "ref", width, height),
+        )
+        inputs.append({**entry, "role": "ref"})
+    return inputs
+
+async def prepare_edit_inputs(base: IngestedFile, mask: Optional[IngestedFile], refs: List[IngestedFile],
+                              width: int, height: int) -> List[dict]:
+    """Run preprocessing on the preprocess pool, off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(preprocess_executor, preprocess_uploads, base, mask, refs, width, height)
+
+EDIT_FORM_SCHEMA = {
+    "requestBody": {
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["base", "prompt"],
+                    "properties": {
+                        "prompt": {"type": "string"},
+                        "mode": {"type": "string", "default": "composite"},
+                        "preset": {"type": "string"},
+                        "provider": {"type": "string"},
+                        "width": {"type": "integer", "default": 512},
+                        "height": {"type": "integer", "default": 512},
+                        "fmt": {"type": "string", "default": "png"},
+                        "n": {"type": "integer", "default": 1},
+                        "base": {"type": "string", "format": "binary"},
+                        "mask": {"type": "string", "format": "binary"},
+                        "refs": {"type": "array", "items": {"type": "string", "format": "binary"}},
+                    },
+                }
+            }
+        }
+    }
+}
+
+def _form_int(fields: dict, name: str, default: int) -> int:
+    try:
+        return int(fields.get(name, default))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=422, detail=f"{name} must be an integer")
+
+@app.post("/images/edit", status_code=201, openapi_extra=EDIT_FORM_SCHEMA)
+async def images_edit(request: Request):
+    fields, files = await ingest_upload(request)
+    try:
+        prompt = fields.get("prompt")
+        provider = fields.get("provider")
+        width = _form_int(fields, "width", 512)
+        height = _form_int(fields, "height", 512)
+        n = _form_int(fields, "n", 1)
+        check_output_size(width, height)
+        fmt = output_format(fields.get("fmt"))
+        base = (files.get("base") or [None])[0]
+        mask = (files.get("mask") or [None])[0]
+        refs = files.get("refs", [])
+
+        if not base:
+            raise HTTPException(status_code=422, detail="base image is required")
         
-        results = []
-        if "choices" in api_response:
-            for choice in api_response["choices"]:
-                if "message" in choice and "images" in choice["message"]:
-                    for image in choice["message"]["images"]:
-                        if "image_url" in image and "url" in image["image_url"]:
-                            b64_data = image["image_url"]["url"]
-                            filename = save_base64_image(b64_data, fmt)
-                            file_path = STORAGE_DIR / filename
-                            results.append({
-                                "filename": filename,
-                                "size_bytes": file_path.stat().st_size,
-                                "url": f"/static/images/{filename}"
-                            })
+        # Validate number of refs if provided
+        if refs and len(refs) > MAX_REFS:
+            raise HTTPException(status_code=400, detail="Too many reference images (max 7)")
+        
+        if not prompt:
+            raise HTTPException(status_code=422, detail="prompt is required")
         
-        return JSONResponse(content=results, status_code=200)
+        inputs = await prepare_edit_inputs(base, mask, refs, width, height)
         
-    except Exception as e:
-        logger.exception("generate_image failed")
-        raise HTTPException(status_code=500, detail=f"Image editing failed: {str(e)}")
+        try:
+            provider = resolve_provider(provider)
+            
+            # Call the API (mocked in tests)
+            api_response = await call_provider(provider, prompt, width, height, n, images=inputs)
+            results = await save_provider_images(api_response, fmt)
+            
+            return JSONResponse(content=results, status_code=200)
+            
+        except ProviderBusy:
+            raise
+        except Exception as e:
+            logger.exception("generate_image failed")
+            raise HTTPException(status_code=500, detail=f"Image editing failed: {str(e)}")
+    finally:
+        close_uploads(files)
 
 @app.post("/logs/client")
 async def logs_client(data: dict = Body(...)):
@@ -327,57 +2721,813 @@ async def logs_client(data: dict = Body(...)):
         logger.error("Malformed client error log")
         return {"status": "error"}
 
+# Job store (SQLite, survives restarts)
+JOBS_DB = Path(os.getenv("JOBS_DB", "jobs.db"))
+QUEUE_POLL_SEC = float(os.getenv("QUEUE_POLL_SEC", "1.0"))
+JOB_OPS = ("generate", "edit")
+JOBS_BATCH_MAX = int(os.getenv("JOBS_BATCH_MAX", "1000"))
+JOB_MAX_PRIORITY = 9
+QUEUE_MAX_DEPTH = int(os.getenv("QUEUE_MAX_DEPTH", "10000"))
+QUEUE_MAX_PER_TENANT = int(os.getenv("QUEUE_MAX_PER_TENANT", "0"))
+QUEUE_RETRY_AFTER_SEC = 5
+# A running job's lease is renewed while it runs; one that lapses was lost with its worker
+QUEUE_LEASE_SEC = float(os.getenv("QUEUE_LEASE_SEC", "300"))
+# Finished jobs are deleted after this long (0 keeps them); lost jobs older than it are failed, not rerun
+JOBS_RETENTION_SEC = float(os.getenv("JOBS_RETENTION_SEC", str(7 * 24 * 3600)))
+JOBS_SWEEP_SEC = 60.0
+JOB_EVENTS_POLL_SEC = float(os.getenv("JOB_EVENTS_POLL_SEC", "2.0"))
+JOB_EVENTS_KEEPALIVE_SEC = 15.0
+
+class JobSubscription:
+    """One event stream's wakeup flag, settable from any thread"""
+
+    def __init__(self, events: "JobEvents", job_ids: List[str]):
+        self.events = events
+        self.job_ids = job_ids
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        try:
+            self.loop.call_soon_threadsafe(self.changed.set)
+        except RuntimeError:
+            pass  # the stream's loop is already closed
+
+    async def wait(self, timeout: float) -> bool:
+        """True if a watched job changed before the timeout"""
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.changed.clear()
+
+    def close(self):
+        self.events.unsubscribe(self)
+
+class JobEvents:
+    """Wakes event streams when a job changes state.
+
+    Publishers only announce the job id and each stream re-reads the row, so
+    a lost or duplicate wakeup is harmless. Process workers cannot reach this
+    object, which is why streams also re-check on a timer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.published = 0
+
+    def subscribe(self, job_ids: List[str]) -> JobSubscription:
+        subscription = JobSubscription(self, job_ids)
+        with self.lock:
+            for job_id in job_ids:
+                self.subscribers.setdefault(job_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: JobSubscription):
+        with self.lock:
+            for job_id in subscription.job_ids:
+                watchers = self.subscribers.get(job_id)
+                if watchers is not None:
+                    watchers.discard(subscription)
+                    if not watchers:
+                        del self.subscribers[job_id]
+
+    def publish(self, job_id: str):
+        with self.lock:
+            self.published += 1
+            watchers = list(self.subscribers.get(job_id, ()))
+        for subscription in watchers:
+            subscription.notify()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            streams = {id(s) for watchers in self.subscribers.values() for s in watchers}
+            return {"streams": len(streams), "watched_jobs": len(self.subscribers), "published": self.published}
+
+job_events = JobEvents()
+
+
+class JobStore:
+    """Durable job table shared by the API and the queue workers.
+
+    Every thread (and every worker process) gets its own connection; WAL mode
+    lets readers poll status while a worker writes, and ``claim`` flips one
+    queued row to running in a single UPDATE ... RETURNING so two workers can
+    never pick up the same job.
+
+    Claims are fair across tenants: they are served in rounds, every tenant
+    with queued work getting one claim per round (``job_tenants.served`` is
+    the round a tenant is up to). Priority orders tenants within a round and
+    a tenant's own jobs, so a client that marks all its work urgent still
+    gets only its turn and cannot starve the others.
+    """
+
+    def __init__(self, db_path: Path, events: Optional[JobEvents] = None):
+        self.db_path = db_path
+        self.events = events
+        self.local = threading.local()
+        self.sweep_lock = threading.Lock()
+        self.swept_at = None
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                op TEXT NOT NULL,
+                params TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at);
+            CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs(created_at);
+            CREATE TABLE IF NOT EXISTS job_tenants (
+                tenant TEXT PRIMARY KEY,
+                served INTEGER NOT NULL
+            );
+        """)
+        # Databases created before priorities/tenants existed
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if "priority" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "tenant" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN tenant TEXT NOT NULL DEFAULT ''")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, tenant, priority DESC, created_at)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # Connections must not cross a fork, so key them by pid as well
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA busy_timeout = 30000")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def _publish(self, job_id: str):
+        if self.events is not None:
+            self.events.publish(job_id)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        return {
+            "id": row["id"],
+            "job_id": row["id"],
+            "op": row["op"],
+            "status": row["status"],
+            "priority": row["priority"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def create(self, op: str, params: dict, priority: int = 0, tenant: str = "") -> dict:
+        return self.create_many([(op, params, priority)], tenant)[0]
+
+    def create_many(self, jobs: List[tuple], tenant: str = "") -> List[dict]:
+        """Enqueue many ``(op, params[, priority])`` jobs in one transaction: all or none"""
+        now = time.time()
+        rows = [(str(uuid4()), job[0], json.dumps(job[1]), job[2] if len(job) > 2 else 0, tenant, now, now)
+                for job in jobs]
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO jobs (id, op, params, status, priority, tenant, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                rows)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        for row in rows:
+            self._publish(row[0])
+        return [{"id": job_id, "op": op, "status": "queued", "priority": priority, "created_at": now}
+                for job_id, op, _, priority, _, _, _ in rows]
+
+    def queued(self, tenant: Optional[str] = None) -> int:
+        """Queue depth, overall or for one tenant"""
+        if tenant is None:
+            return self._conn().execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND tenant = ?", (tenant,)).fetchone()[0]
+
+    def get(self, job_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def get_many(self, job_ids: List[str]) -> dict:
+        """Batched status read: one query for many ids, missing ids are omitted"""
+        out = {}
+        # Stay well under SQLITE_MAX_VARIABLE_NUMBER
+        for start in range(0, len(job_ids), 500):
+            chunk = job_ids[start:start + 500]
+            rows = self._conn().execute(
+                f"SELECT * FROM jobs WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            out.update((row["id"], self._to_dict(row)) for row in rows)
+        return out
+
+    def params(self, job_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT op, params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return {"op": row["op"], **json.loads(row["params"])} if row else None
+
+    def recent(self, limit: int = 50, status: Optional[str] = None) -> List[dict]:
+        if status:
+            rows = self._conn().execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at DESC LIMIT ?", (status, limit))
+        else:
+            rows = self._conn().execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _current_round(conn: sqlite3.Connection) -> int:
+        # New and long-idle tenants join the current round instead of
+        # collecting the turns they missed
+        return conn.execute("SELECT COALESCE(MAX(served), 1) - 1 FROM job_tenants").fetchone()[0]
+
+    def claim(self) -> Optional[str]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = self._current_round(conn)
+            row = conn.execute("""
+                UPDATE jobs SET status = 'running', updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued' AND tenant = (
+                        SELECT q.tenant FROM jobs q LEFT JOIN job_tenants t ON t.tenant = q.tenant
+                        WHERE q.status = 'queued'
+                        GROUP BY q.tenant
+                        ORDER BY max(COALESCE(MAX(t.served), 0), ?), MAX(q.priority) DESC, MIN(q.created_at)
+                        LIMIT 1)
+                    ORDER BY priority DESC, created_at
+                    LIMIT 1)
+                  AND status = 'queued'
+                RETURNING id, tenant
+            """, (time.time(), current)).fetchone()
+            if row is not None:
+                served = conn.execute(
+                    "SELECT served FROM job_tenants WHERE tenant = ?", (row["tenant"],)).fetchone()
+                conn.execute("""
+                    INSERT INTO job_tenants (tenant, served) VALUES (?, ?)
+                    ON CONFLICT(tenant) DO UPDATE SET served = excluded.served
+                """, (row["tenant"], max(served[0] if served else 0, current) + 1))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        if row is None:
+            return None
+        self._publish(row["id"])
+        return row["id"]
+
+    def finish(self, job_id: str, result: Optional[list] = None, error: Optional[str] = None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+            ("error" if error else "done", json.dumps(result) if result is not None else None,
+             error, time.time(), job_id))
+        self._publish(job_id)
+
+    def renew(self, job_id: str):
+        """Extend a running job's lease"""
+        self._conn().execute(
+            "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    @contextmanager
+    def lease(self, job_id: str, lease_sec: float = QUEUE_LEASE_SEC):
+        """Renew the job's lease in the background for as long as it runs"""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(lease_sec / 3):
+                try:
+                    self.renew(job_id)
+                except sqlite3.Error as e:
+                    logger.warning(f"could not renew the lease of job {job_id}: {e}")
+
+        thread = threading.Thread(target=heartbeat, name=f"lease-{job_id[:8]}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+    def requeue_running(self, lease_sec: float = QUEUE_LEASE_SEC,
+                        abandon_after_sec: float = JOBS_RETENTION_SEC) -> int:
+        """Put jobs whose worker died (lease lapsed) back on the queue.
+
+        Jobs still renewed by a live worker, in this or another process, are
+        left alone. Ones lost longer ago than ``abandon_after_sec`` are failed
+        instead of being rerun, and their uploads deleted.
+        """
+        now = time.time()
+        abandoned = []
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if abandon_after_sec:
+                abandoned = conn.execute(
+                    "UPDATE jobs SET status = 'error', error = 'interrupted and not resumed', updated_at = ? "
+                    "WHERE status = 'running' AND updated_at < ? RETURNING params",
+                    (now, now - abandon_after_sec)).fetchall()
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running' AND updated_at < ?",
+                (now, now - lease_sec))
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        for row in abandoned:
+            discard_job_uploads(json.loads(row["params"]))
+        return cur.rowcount
+
+    def prune(self, retention_sec: float = JOBS_RETENTION_SEC) -> int:
+        """Delete done and failed jobs last updated more than ``retention_sec`` ago"""
+        if not retention_sec:
+            return 0
+        cur = self._conn().execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'error') AND updated_at < ?",
+            (time.time() - retention_sec,))
+        return cur.rowcount
+
+    def sweep(self, interval: float = JOBS_SWEEP_SEC):
+        """Requeue lost jobs and prune old ones, at most once per ``interval`` per process"""
+        now = time.monotonic()
+        with self.sweep_lock:
+            if self.swept_at is not None and now - self.swept_at < interval:
+                return
+            self.swept_at = now
+        try:
+            requeued = self.requeue_running()
+            if requeued:
+                logger.warning(f"requeued {requeued} jobs whose worker stopped renewing them")
+            self.prune()
+        except sqlite3.Error as e:
+            logger.warning(f"job sweep failed: {e}")
+
+job_store = JobStore(JOBS_DB, job_events)
+# Set on submit so idle workers don't wait out a full poll interval
+job_wakeup = threading.Event()
+
+async def _read_job_payload(request: Request) -> tuple:
+    """Accept a job as JSON or as form fields (the UI posts multipart).
+
+    Returns the scalar fields and the uploaded files; the caller closes the
+    files with ``close_uploads``.
+    """
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            data = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+        if not isinstance(data, dict):
+            raise HTTPException(status_code=400, detail="Job payload must be an object")
+        return data, {}
+    return await ingest_upload(request)
+
+# Storage keys of a job's uploads; never taken from the client
+JOB_UPLOAD_PARAMS = ("base_path", "mask_path", "ref_paths")
+
+class StoredUpload:
+    """An edit input persisted with a queued job, read back by the worker"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.data = None
+
+    def read(self) -> bytes:
+        if self.data is None:
+            _, body = object_storage.get(self.key)
+            self.data = b"".join(body)
+        return self.data
+
+    @property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.read()).hexdigest()
+
+    @property
+    def size(self) -> int:
+        return len(self.read())
+
+def persist_job_uploads(files: dict) -> dict:
+    """Store an edit job's uploads in object storage so any worker can run it"""
+    prefix = f"uploads/{uuid4().hex}"
+    params = {"base_path": None, "mask_path": None, "ref_paths": []}
+    try:
+        for field, uploads in files.items():
+            for index, upload in enumerate(uploads):
+                key = f"{prefix}-{field}-{index}"
+                fd, tmp_path = tempfile.mkstemp(dir=OBJECTS_DIR, suffix=".part")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        upload.file.seek(0)
+                        shutil.copyfileobj(upload.file, f)
+                    object_storage.put(key, tmp_path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                    raise
+                if field == "refs":
+                    params["ref_paths"].append(key)
+                else:
+                    params[f"{field}_path"] = key
+    except BaseException:
+        discard_job_uploads(params)
+        raise
+    return params
+
+def discard_job_uploads(params: dict):
+    keys = [params.get("base_path"), params.get("mask_path"), *(params.get("ref_paths") or [])]
+    for key in filter(None, keys):
+        try:
+            object_storage.delete(key)
+        except (OSError, StorageError) as e:
+            logger.warning(f"could not delete job upload {key}: {e}")
+
+def _job_params(op: str, data: dict, uploads: dict) -> dict:
+    """Validate a submitted job up front so workers only see runnable params"""
+    if op == "generate" and uploads:
+        raise HTTPException(status_code=400, detail="generate jobs take no images; upload a base image to edit")
+    if op == "edit" and "base" not in uploads:
+        detail = ("edit jobs need the base image uploaded as multipart/form-data" if data.get("base")
+                  else "base image is required for edit jobs")
+        raise HTTPException(status_code=400, detail=detail)
+    params = {key: value for key, value in data.items()
+              if key not in ("base", "mask", "refs", "priority", *JOB_UPLOAD_PARAMS)}
+    try:
+        for key, default in (("width", 512), ("height", 512), ("n", 1)):
+            params[key] = int(params.get(key, default))
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="width, height and n must be integers")
+    check_output_size(params["width"], params["height"])
+    params["fmt"] = output_format(params.get("fmt"))
+    if params.get("provider"):
+        params["provider"] = resolve_provider(params["provider"])
+    return params
+
+def _job_priority(data: dict) -> int:
+    try:
+        priority = int(data.get("priority") or 0)
+    except (TypeError, ValueError):
+        priority = -1
+    if not 0 <= priority <= JOB_MAX_PRIORITY:
+        raise HTTPException(status_code=400, detail=f"priority must be an integer from 0 to {JOB_MAX_PRIORITY}")
+    return priority
+
+def _job_tenant(request: Request) -> str:
+    """Fair-share key: the client's X-Client-Key, else its address.
+
+    The header is taken as-is, so it must be set by a trusted reverse proxy
+    that strips client-supplied values; otherwise a client can rotate keys
+    to claim extra turns.
+    """
+    return request.headers.get("x-client-key") or (request.client.host if request.client else "")
+
+def _admit_jobs(tenant: str, count: int):
+    """Refuse work the queue cannot take; the limits are soft under concurrent submits"""
+    if QUEUE_MAX_DEPTH and job_store.queued() + count > QUEUE_MAX_DEPTH:
+        raise HTTPException(status_code=429, detail="Job queue is full, retry later",
+                            headers={"Retry-After": str(QUEUE_RETRY_AFTER_SEC)})
+    if QUEUE_MAX_PER_TENANT and job_store.queued(tenant) + count > QUEUE_MAX_PER_TENANT:
+        raise HTTPException(status_code=429, detail="Too many queued jobs for this client, retry later",
+                            headers={"Retry-After": str(QUEUE_RETRY_AFTER_SEC)})
+
 @app.post("/jobs/submit")
-async def jobs_submit(data: dict = Body(...)):
-    job_id = str(uuid4())
-    job_payloads[job_id] = data
-    job_queue.put(job_id)
-    job_status[job_id] = "queued"
-    return {"id": job_id}
+async def jobs_submit(request: Request):
+    data, files = await _read_job_payload(request)
+    try:
+        op = data.pop("op", None) or "generate"
+        if op not in JOB_OPS:
+            raise HTTPException(status_code=400, detail="Invalid op. Use 'generate' or 'edit'")
+        priority = _job_priority(data)
+        params = _job_params(op, data, files)
+        tenant = _job_tenant(request)
+        await run_in_threadpool(_admit_jobs, tenant, 1)
+        if op == "edit":
+            params.update(await run_in_threadpool(persist_job_uploads, files))
+    finally:
+        close_uploads(files)
+    try:
+        job = await run_in_threadpool(job_store.create, op, params, priority, tenant)
+    except BaseException:
+        await run_in_threadpool(discard_job_uploads, params)
+        raise
+    job_wakeup.set()
+    return job
+
+@app.post("/jobs/batch")
+async def jobs_batch(request: Request, payload: dict | list = Body(...)):
+    """Enqueue many JSON generate jobs at once; any invalid job rejects the whole batch.
+
+    Edit jobs carry image uploads, so they go through ``/jobs/submit`` one at a time.
+    """
+    items = payload.get("jobs") if isinstance(payload, dict) else payload
+    if not isinstance(items, list) or not items:
+        raise HTTPException(status_code=400, detail="Expected a non-empty list of jobs")
+    if len(items) > JOBS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {JOBS_BATCH_MAX} jobs per batch")
+    jobs = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise HTTPException(status_code=400, detail=f"jobs[{index}]: job must be an object")
+        data = dict(item)
+        op = data.pop("op", None) or "generate"
+        try:
+            if op not in JOB_OPS:
+                raise HTTPException(status_code=400, detail="Invalid op. Use 'generate' or 'edit'")
+            if op == "edit":
+                raise HTTPException(status_code=400,
+                                    detail="edit jobs can't be batched; submit them to /jobs/submit with their images")
+            priority = _job_priority(data)
+            jobs.append((op, _job_params(op, data, {}), priority))
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"jobs[{index}]: {e.detail}")
+    tenant = _job_tenant(request)
+    await run_in_threadpool(_admit_jobs, tenant, len(jobs))
+    created = await run_in_threadpool(job_store.create_many, jobs, tenant)
+    job_wakeup.set()
+    return created
+
+def _split_ids(ids: List[str]) -> List[str]:
+    job_ids = list(dict.fromkeys(job_id for job_id in ids if job_id))
+    if len(job_ids) > JOBS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {JOBS_BATCH_MAX} ids per request")
+    return job_ids
+
+async def _jobs_by_id(job_ids: List[str]) -> List[dict]:
+    """Jobs in request order; unknown ids are left out"""
+    found = await run_in_threadpool(job_store.get_many, job_ids)
+    return [found[job_id] for job_id in job_ids if job_id in found]
+
+@app.get("/jobs")
+async def list_jobs(limit: int = Query(50, ge=1, le=500), status: Optional[str] = None,
+                    ids: Optional[str] = Query(None, description="Comma-separated job ids")):
+    if ids is not None:
+        return await _jobs_by_id(_split_ids(ids.split(",")))
+    return await run_in_threadpool(job_store.recent, limit, status)
+
+@app.post("/jobs/status")
+async def jobs_status(payload: dict = Body(...)):
+    """Bulk status lookup for id lists too long for a query string"""
+    ids = payload.get("ids")
+    if not isinstance(ids, list) or not all(isinstance(job_id, str) for job_id in ids):
+        raise HTTPException(status_code=400, detail="ids must be a list of job ids")
+    return await _jobs_by_id(_split_ids(ids))
+
+JOB_FINAL = ("done", "error")
+
+async def job_event_stream(request: Request, job_ids: List[str]):
+    """Server-sent events for each state change of the given jobs.
+
+    Every event is the job as returned by GET /jobs/{id}; the stream ends once
+    all of the jobs are done or failed.
+    """
+    subscription = job_events.subscribe(job_ids)
+    try:
+        seen = {}
+        pending = set(job_ids)
+        idle = 0.0
+        while pending:
+            jobs = await run_in_threadpool(job_store.get_many, list(pending))
+            for job_id in job_ids:
+                job = jobs.get(job_id)
+                if job_id not in pending or job is None:
+                    continue
+                state = (job["status"], job["updated_at"])
+                if seen.get(job_id) != state:
+                    seen[job_id] = state
+                    yield f"data: {json.dumps(job)}\n\n"
+                if job["status"] in JOB_FINAL:
+                    pending.discard(job_id)
+            if not pending:
+                break
+            if await subscription.wait(JOB_EVENTS_POLL_SEC):
+                idle = 0.0
+            else:
+                idle += JOB_EVENTS_POLL_SEC
+                if idle >= JOB_EVENTS_KEEPALIVE_SEC:
+                    idle = 0.0
+                    yield ": keepalive\n\n"
+            if await request.is_disconnected():
+                break
+    finally:
+        subscription.close()
+
+def _sse(stream) -> StreamingResponse:
+    return StreamingResponse(stream, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/jobs/events")
+async def jobs_events(request: Request, ids: str = Query(..., description="Comma-separated job ids")):
+    """One event stream multiplexing many jobs"""
+    job_ids = list(dict.fromkeys(job_id for job_id in ids.split(",") if job_id))
+    if not job_ids:
+        raise HTTPException(status_code=400, detail="ids is required")
+    if len(job_ids) > 500:
+        raise HTTPException(status_code=400, detail="At most 500 ids per stream")
+    found = await run_in_threadpool(job_store.get_many, job_ids)
+    missing = [job_id for job_id in job_ids if job_id not in found]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Job not found: {', '.join(missing)}")
+    return _sse(job_event_stream(request, job_ids))
+
+@app.get("/jobs/{job_id}/events")
+async def job_events_stream(request: Request, job_id: str):
+    if await run_in_threadpool(job_store.get, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _sse(job_event_stream(request, [job_id]))
 
 @app.get("/jobs/{job_id}")
-async def get_job(job_id: str):
-    if job_id not in job_status:
+def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return {
-        "job_id": job_id,
-        "status": job_status[job_id],
-        "result": None
-    }
+    return job
+
+QUEUE_WORKERS = int(os.getenv("QUEUE_WORKERS", "1"))
+QUEUE_WORKER_MODE = os.getenv("QUEUE_WORKER_MODE", "thread")
+QUEUE_DRAIN_SEC = float(os.getenv("QUEUE_DRAIN_SEC", "30"))
+_thread_loops = threading.local()
+
+def _run_async(coro):
+    """Run a coroutine on this thread's own event loop.
 
-# Job queue (in-memory for now, should be SQLite)
-job_queue = queue.Queue()
-job_status = {}
-job_payloads = {}
+    The loop is kept for the life of the thread so the provider connection
+    pools created on it are reused from one job to the next.
+    """
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        _thread_loops.loop = loop
+    return loop.run_until_complete(coro)
+
+def _close_thread_loop():
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is not None:
+        loop.run_until_complete(provider_transport.aclose())
+        loop.close()
+        _thread_loops.loop = None
 
 def _claim_one_job():
-    try:
-        return job_queue.get_nowait()
-    except queue.Empty:
-        return None
+    return job_store.claim()
+
+async def _run_job(op: str, params: dict) -> List[dict]:
+    """Same provider-and-save pipeline as /images/generate and /images/edit"""
+    prompt = params.get("prompt")
+    if not prompt:
+        raise ValueError("prompt is required")
+    provider = resolve_provider(params.get("provider"))
+    if op == "generate":
+        return await generate_images(provider, prompt, params["width"], params["height"],
+                                     params["n"], params["fmt"])
+    if not params.get("base_path"):
+        raise ValueError("edit job has no base image")
+    base = StoredUpload(params["base_path"])
+    mask = StoredUpload(params["mask_path"]) if params.get("mask_path") else None
+    refs = [StoredUpload(key) for key in params.get("ref_paths") or []]
+    inputs = await prepare_edit_inputs(base, mask, refs, params["width"], params["height"])
+    api_response = await call_provider(provider, prompt, params["width"], params["height"], params["n"],
+                                       images=inputs)
+    return await save_provider_images(api_response, params["fmt"])
 
 def _process_job(job_id):
-    # Mock processing
-    # Simulate failure by calling API (mocked in test)
+    """Run one claimed job and record its result or error on the job row.
+
+    A finished job's uploads are deleted; an interrupted one keeps them for
+    its rerun.
+    """
+    params = None
     try:
-        requests.post("https://dummy.com")
+        params = job_store.params(job_id)
+        if params is None:
+            raise ValueError("job not found")
+        op = params.pop("op")
+        results = _run_async(_run_job(op, params))
+        job_store.finish(job_id, result=results)
+        discard_job_uploads(params)
+        return True
     except Exception as e:
-        logger.error(f"job {job_id} failed: {str(e)}")
-        raise
+        error = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"job {job_id} failed: {error}")
+        job_store.finish(job_id, error=error)
+        if params:
+            discard_job_uploads(params)
+        return False
 
 class Worker:
-    def __init__(self, queue):
-        self.queue = queue
+    """Claims and processes jobs until asked to stop.
+
+    ``counters`` holds [busy_sec, done, failed, busy_since]; it is a plain list
+    for thread workers and a shared array for process workers so the pool can
+    report utilization either way.
+    """
+
+    def __init__(self, store, stop_event, counters):
+        self.store = store
+        self.stop_event = stop_event
+        self.counters = counters
 
     def run(self):
-        while True:
-            try:
-                job_id = self.queue.get()
-                job_status[job_id] = "running"
+        try:
+            while not self.stop_event.is_set():
                 try:
-                    _process_job(job_id)
-                    job_status[job_id] = "done"
-                except Exception as e:
-                    job_status[job_id] = "error"
-            except Exception as e:
-                logger.exception("Worker error")
+                    job_id = self.store.claim()
+                    if job_id is None:
+                        self.store.sweep()
+                        job_wakeup.wait(QUEUE_POLL_SEC)
+                        job_wakeup.clear()
+                        continue
+                    started = time.time()
+                    self.counters[3] = started
+                    with self.store.lease(job_id):
+                        ok = _process_job(job_id)
+                    self.counters[0] += time.time() - started
+                    self.counters[1 if ok else 2] += 1
+                    self.counters[3] = 0.0
+                except Exception:
+                    logger.exception("Worker error")
+        finally:
+            _close_thread_loop()
+
+def _run_worker_process(stop_event, counters):
+    # Runs in a spawned child, which re-imports this module and its job_store
+    Worker(job_store, stop_event, counters).run()
+
+class WorkerPool:
+    """QUEUE_WORKERS thread or process workers sharing the job store.
+
+    ``stop`` lets in-flight jobs finish (up to the drain timeout); anything
+    still running after that is requeued once its lease lapses.
+    """
+
+    def __init__(self, size: int, mode: str = "thread", store: Optional[JobStore] = None):
+        if mode not in ("thread", "process"):
+            raise ValueError("QUEUE_WORKER_MODE must be 'thread' or 'process'")
+        self.size = max(1, size)
+        self.mode = mode
+        self.store = store or job_store
+        self.workers = []
+        self.started_at = None
+
+    def start(self):
+        self.started_at = time.time()
+        self.workers = []
+        if self.mode == "process":
+            ctx = multiprocessing.get_context("spawn")
+            self.stop_event = ctx.Event()
+            for i in range(self.size):
+                counters = ctx.Array("d", 4)
+                proc = ctx.Process(target=_run_worker_process, args=(self.stop_event, counters),
+                                   name=f"worker-{i}", daemon=True)
+                proc.start()
+                self.workers.append((proc, counters))
+        else:
+            self.stop_event = threading.Event()
+            for i in range(self.size):
+                counters = [0.0, 0, 0, 0.0]
+                worker = Worker(self.store, self.stop_event, counters)
+                thread = threading.Thread(target=worker.run, name=f"worker-{i}", daemon=True)
+                thread.start()
+                self.workers.append((thread, counters))
+
+    def stop(self, timeout: float = QUEUE_DRAIN_SEC):
+        if not self.workers:
+            return
+        self.stop_event.set()
+        job_wakeup.set()
+        deadline = time.monotonic() + timeout
+        for handle, _ in self.workers:
+            handle.join(max(0.0, deadline - time.monotonic()))
+            if handle.is_alive():
+                logger.error(f"{handle.name} did not drain within {timeout}s")
+        self.workers = []
+
+    def metrics(self) -> List[dict]:
+        now = time.time()
+        uptime = now - self.started_at if self.started_at else 0.0
+        out = []
+        for handle, counters in self.workers:
+            busy_sec, done, failed, busy_since = counters[:]
+            if busy_since:
+                busy_sec += now - busy_since
+            out.append({
+                "name": handle.name,
+                "mode": self.mode,
+                "alive": handle.is_alive(),
+                "busy": bool(busy_since),
+                "jobs_done": int(done),
+                "jobs_failed": int(failed),
+                "busy_sec": round(busy_sec, 3),
+                "utilization": round(busy_sec / uptime, 3) if uptime else 0.0,
+            })
+        return out
+
+worker_pool = WorkerPool(QUEUE_WORKERS, QUEUE_WORKER_MODE)
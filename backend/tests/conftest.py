@@ -2,15 +2,48 @@ import pytest
 import tempfile
 import os
 import sys
+from pathlib import Path
 from fastapi.testclient import TestClient
 
 # Add the parent directory to the path so we can import main
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keep test jobs and images out of the checked-in jobs.db and storage/
+os.environ.setdefault("JOBS_DB", os.path.join(tempfile.mkdtemp(), "jobs.db"))
+os.environ.setdefault("CATALOG_DB", os.path.join(tempfile.mkdtemp(), "catalog.db"))
+os.environ.setdefault("OBJECTS_DIR", os.path.join(tempfile.mkdtemp(), "objects"))
+os.environ.setdefault("PREPROCESS_CACHE_DIR", tempfile.mkdtemp())
+os.environ.setdefault("DERIVATIVES_DIR", tempfile.mkdtemp())
 from main import app
 
+def pytest_configure(config):
+    config.addinivalue_line("markers", "no_workers: claim and process jobs by hand, without the app's queue workers")
+
+@pytest.fixture(autouse=True)
+def job_queue(tmp_path_factory, monkeypatch):
+    """Every test starts with an empty job queue"""
+    import main
+    store = main.JobStore(tmp_path_factory.mktemp("jobs") / "jobs.db", main.job_events)
+    monkeypatch.setattr(main, "job_store", store)
+    monkeypatch.setattr(main.worker_pool, "store", store)
+    return store
+
+@pytest.fixture(autouse=True)
+def image_catalog(temp_image_dir, monkeypatch):
+    """Every test starts with an empty image catalog over its own flat directory"""
+    import main
+    catalog = main.ImageCatalog(Path(temp_image_dir) / "catalog.db", Path(temp_image_dir) / "images",
+                                main.object_storage)
+    monkeypatch.setattr(main, "image_catalog", catalog)
+    return catalog
+
 @pytest.fixture
-def client():
-    return TestClient(app)
+def client(request):
+    if request.node.get_closest_marker("no_workers"):
+        yield TestClient(app)
+        return
+    # Run the lifespan so queue workers process submitted jobs, as in production
+    with TestClient(app) as client:
+        yield client
 
 @pytest.fixture
 def temp_image_dir():
@@ -44,7 +44,7 @@ def test_edit_image_with_base_and_refs(client, temp_image_dir):
         }]
     }
     
-    with patch('main.requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         response = client.post("/images/edit",
             data={
                 "prompt": "test prompt",
@@ -87,7 +87,7 @@ def test_edit_image_with_mask(client, temp_image_dir):
         }]
     }
     
-    with patch('main.requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         response = client.post("/images/edit",
             data={
                 "prompt": "test prompt",
@@ -152,7 +152,7 @@ def test_edit_image_with_preset(client, temp_image_dir):
         }]
     }
     
-    with patch('main.requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         response = client.post("/images/edit",
             data={
                 "prompt": "test prompt",
@@ -169,4 +169,254 @@ def test_edit_image_with_preset(client, temp_image_dir):
         )
         assert response.status_code == 200
         data = response.json()
-        assert len(data) == 1
\ No newline at end of file
+        assert len(data) == 1
+
+def png_bytes():
+    return base64.b64decode(create_test_image_data())
+
+def test_edit_rejects_oversize_file(client, monkeypatch):
+    """A file over the per-file limit is rejected with 413"""
+    monkeypatch.setattr("main.UPLOAD_MAX_FILE_BYTES", 64)
+    response = client.post("/images/edit",
+        data={"prompt": "test prompt"},
+        files={"base": ("base.png", png_bytes() + b"\0" * 1024, "image/png")}
+    )
+    assert response.status_code == 413
+
+def test_edit_rejects_oversize_body_from_content_length(client, monkeypatch):
+    """A declared body over the total limit is rejected before it is read"""
+    monkeypatch.setattr("main.UPLOAD_MAX_TOTAL_BYTES", 1024)
+    response = client.post("/images/edit",
+        data={"prompt": "test prompt"},
+        files={"base": ("base.png", png_bytes() + b"\0" * 4096, "image/png")}
+    )
+    assert response.status_code == 413
+
+def test_edit_rejects_non_image(client):
+    """Uploads are sniffed by their first bytes, not the declared type"""
+    response = client.post("/images/edit",
+        data={"prompt": "test prompt"},
+        files={"base": ("base.png", b"#!/bin/sh\necho not an image\n", "image/png")}
+    )
+    assert response.status_code == 415
+
+def test_edit_rejects_too_many_refs_while_streaming(client):
+    """The eighth ref part is rejected as soon as its headers arrive"""
+    data = png_bytes()
+    files = [("base", ("base.png", data, "image/png"))]
+    files += [("refs", (f"ref{i}.png", data, "image/png")) for i in range(8)]
+    response = client.post("/images/edit", data={"prompt": "test prompt"}, files=files)
+    assert response.status_code == 400
+    assert "max 7" in response.json()["detail"]
+
+def test_edit_stops_reading_after_rejection(monkeypatch):
+    """A bad upload is rejected without consuming the rest of the body"""
+    import asyncio
+    import httpx
+    from main import app
+
+    monkeypatch.setattr("main.UPLOAD_MAX_FILE_BYTES", 1024)
+    boundary = "testboundary"
+    sent = []
+
+    async def body():
+        head = (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="base"; filename="base.png"\r\n'
+            "Content-Type: image/png\r\n\r\n"
+        ).encode()
+        yield head + png_bytes()
+        for _ in range(100):
+            sent.append(1)
+            yield b"\0" * 4096
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await ac.post(
+                "/images/edit",
+                content=body(),
+                headers={"content-type": f"multipart/form-data; boundary={boundary}"},
+            )
+
+    response = asyncio.run(run())
+    assert response.status_code == 413
+    assert len(sent) < 5
+
+def test_large_uploads_are_written_off_the_event_loop(monkeypatch):
+    """Once the body outgrows the spool, parser writes run in the threadpool"""
+    import asyncio
+    import threading
+    import httpx
+    from main import app, IngestedFile
+
+    monkeypatch.setattr("main.UPLOAD_SPOOL_BYTES", 1024)
+    boundary = "testboundary"
+    loop_threads, write_threads = set(), []
+    write = IngestedFile.write
+
+    def recording_write(self, chunk):
+        write_threads.append(threading.get_ident())
+        write(self, chunk)
+
+    monkeypatch.setattr(IngestedFile, "write", recording_write)
+
+    async def body():
+        loop_threads.add(threading.get_ident())
+        yield (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="base"; filename="base.png"\r\n'
+            "Content-Type: image/png\r\n\r\n"
+        ).encode() + png_bytes()
+        for _ in range(4):
+            yield b"\0" * 1024
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await ac.post(
+                "/jobs/submit",
+                content=body(),
+                headers={"content-type": f"multipart/form-data; boundary={boundary}"},
+            )
+
+    response = asyncio.run(run())
+    assert response.status_code == 400  # a generate job with an image is refused after parsing
+    assert write_threads[0] in loop_threads
+    assert any(ident not in loop_threads for ident in write_threads[1:])
+
+def test_ingested_upload_is_hashed():
+    """Files are hashed while they stream in"""
+    import hashlib
+    from main import IngestedFile
+
+    data = png_bytes()
+    upload = IngestedFile("base", "base.png", "image/png")
+    for i in range(0, len(data), 7):
+        upload.write(data[i:i + 7])
+    upload.finish()
+    assert upload.kind == "png"
+    assert upload.sha256 == hashlib.sha256(data).hexdigest()
+    assert upload.read() == data
+    upload.close()
+
+def encode_image(img, fmt="PNG"):
+    out = io.BytesIO()
+    img.save(out, format=fmt)
+    return out.getvalue()
+
+def provider_ok_response():
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"choices": [{"message": {"images": [{"image_url": {
+        "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+    }}]}}]}
+    return mock_response
+
+def test_edit_preprocesses_inputs_before_sending(client, temp_image_dir):
+    """Inputs are downscaled to the target size and forwarded to the provider"""
+    base = encode_image(Image.effect_noise((2048, 1024), 64).convert("RGB"))
+    mask = Image.new("RGBA", (2048, 1024), (0, 0, 0, 0))
+    mask.paste((0, 0, 0, 255), (0, 0, 1024, 1024))
+
+    with patch('main.provider_transport.post', return_value=provider_ok_response()) as post:
+        response = client.post("/images/edit",
+            data={"prompt": "test prompt", "width": 256, "height": 256},
+            files=[
+                ("base", ("base.png", base, "image/png")),
+                ("mask", ("mask.png", encode_image(mask), "image/png")),
+                ("refs", ("ref.png", base, "image/png")),
+            ]
+        )
+    assert response.status_code == 200
+    content = post.call_args.kwargs["json"]["messages"][0]["content"]
+    urls = [part["image_url"]["url"] for part in content if part["type"] == "image_url"]
+    assert len(urls) == 3
+
+    sent = [Image.open(io.BytesIO(base64.b64decode(url.split(",", 1)[1]))) for url in urls]
+    assert sent[0].format == "JPEG" and sent[0].size == (256, 128)
+    assert sent[1].mode == "1" and sent[1].size == (256, 128)
+    assert sent[1].getpixel((10, 10)) == 255 and sent[1].getpixel((200, 10)) == 0
+    assert sum(len(url) for url in urls) < len(base)
+
+def test_edit_rejects_unreadable_image(client):
+    """A file with an image signature that does not decode is a 422"""
+    response = client.post("/images/edit",
+        data={"prompt": "test prompt"},
+        files={"base": ("base.png", b"\x89PNG\r\n\x1a\n" + b"\0" * 64, "image/png")}
+    )
+    assert response.status_code == 422
+
+@pytest.mark.parametrize("width,height", [(0, 512), (512, -1), (512, 100000)])
+def test_edit_rejects_out_of_range_size(client, width, height):
+    """The output size bounds the preprocessing, so 0 or huge sizes are a 422"""
+    with patch('main.provider_transport.post') as post:
+        response = client.post("/images/edit",
+            data={"prompt": "test prompt", "width": width, "height": height},
+            files={"base": ("base.png", png_bytes(), "image/png")}
+        )
+    assert response.status_code == 422
+    assert "between 1 and" in response.json()["detail"]
+    post.assert_not_called()
+
+def test_preprocess_keeps_transparency_as_png():
+    from main import preprocess_image
+
+    img = Image.new("RGBA", (100, 100), (255, 0, 0, 0))
+    result = preprocess_image(encode_image(img), "ref", 50, 50)
+    assert result["mime_type"] == "image/png"
+    assert (result["width"], result["height"]) == (50, 50)
+
+def test_repeated_refs_skip_preprocessing(client, temp_image_dir):
+    """A ref already prepared for this size is served from the cache"""
+    import main
+
+    ref = encode_image(Image.effect_noise((300, 300), 32).convert("RGB"))
+    files = [
+        ("base", ("base.png", png_bytes(), "image/png")),
+        ("refs", ("ref.png", ref, "image/png")),
+    ]
+    before = main.preprocess_cache.metrics()
+    with patch('main.provider_transport.post', return_value=provider_ok_response()) as post:
+        first = client.post("/images/edit", data={"prompt": "a", "width": 200, "height": 200}, files=files)
+        with patch('main.preprocess_image', wraps=main.preprocess_image) as preprocess:
+            second = client.post("/images/edit", data={"prompt": "b", "width": 200, "height": 200}, files=files)
+    assert first.status_code == 200 and second.status_code == 200
+    # Only the base is prepared on the second call
+    assert [c.args[1] for c in preprocess.call_args_list] == ["base"]
+    sent = [c.kwargs["json"]["messages"][0]["content"][2] for c in post.call_args_list]
+    assert sent[0] == sent[1]
+
+    after = client.get("/metrics").json()["preprocess_cache"]
+    assert after["hits"] == before["hits"] + 1
+    assert after["bytes_saved"] == before["bytes_saved"] + len(ref)
+
+def test_preprocess_cache_disk_tier_and_eviction(tmp_path):
+    from main import PreprocessCache
+
+    cache = PreprocessCache(tmp_path, memory_bytes=0, disk_bytes=250)
+    made = []
+
+    def create(tag):
+        def build():
+            made.append(tag)
+            return {"mime_type": "image/jpeg", "b64": tag * 100, "width": 10, "height": 10}
+        return build
+
+    assert cache.get_or_create("a", 5, 10, 10, create("a"))["b64"] == "a" * 100
+    assert cache.get_or_create("a", 5, 10, 10, create("a"))["b64"] == "a" * 100
+    assert made == ["a"]
+    assert cache.metrics()["disk_hits"] == 1
+
+    # A different target size is a different entry
+    cache.get_or_create("a", 5, 20, 20, create("b"))
+    cache.get_or_create("c", 5, 10, 10, create("c"))
+    assert cache.metrics()["disk_bytes"] <= 250
+    cache.get_or_create("a", 5, 10, 10, create("a"))
+    assert made == ["a", "b", "c", "a"]
+
+    # The disk tier survives a restart
+    reopened = PreprocessCache(tmp_path, memory_bytes=1024, disk_bytes=250)
+    reopened.get_or_create("c", 5, 10, 10, create("x"))
+    assert "x" not in made
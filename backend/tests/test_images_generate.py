@@ -31,7 +31,7 @@ def test_generate_image_with_mock_provider(client, temp_image_dir):
         }]
     }
     
-    with patch('main.requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         response = client.post("/images/generate", data={
             "prompt": "test prompt",
             "width": 512,
@@ -62,7 +62,7 @@ def test_generate_image_validation(client):
         }]
     }
     
-    with patch('main.requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         # Test with invalid width
         response = client.post("/images/generate", data={
             "prompt": "test",
@@ -99,7 +99,7 @@ def test_generate_image_multiple_outputs(client, temp_image_dir):
         }]
     }
     
-    with patch('main.requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         response = client.post("/images/generate", data={
             "prompt": "test prompt",
             "width": 512,
@@ -109,4 +109,180 @@ def test_generate_image_multiple_outputs(client, temp_image_dir):
         })
         assert response.status_code == 200
         data = response.json()
-        assert len(data) == 2
\ No newline at end of file
+        assert len(data) == 2
+
+def test_generate_requests_run_concurrently(temp_image_dir):
+    """Slow provider calls overlap instead of blocking the event loop"""
+    import asyncio
+    import time
+    import httpx
+    from main import app
+
+    in_flight = {"now": 0, "max": 0}
+
+    async def slow_post(*args, **kwargs):
+        in_flight["now"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        await asyncio.sleep(0.3)
+        in_flight["now"] -= 1
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "choices": [{
+                "message": {
+                    "images": [{
+                        "image_url": {
+                            "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                        }
+                    }]
+                }
+            }]
+        }
+        return mock_response
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            started = time.monotonic()
+            responses = await asyncio.gather(*[
+                ac.post("/images/generate", data={"prompt": f"test prompt {i}", "n": 1})
+                for i in range(4)
+            ])
+            return responses, time.monotonic() - started
+
+    with patch('main.provider_transport.post', side_effect=slow_post):
+        responses, elapsed = asyncio.run(run())
+
+    assert all(r.status_code == 200 for r in responses)
+    assert in_flight["max"] == 4
+    assert elapsed < 0.3 * 4
+
+def test_generate_result_cache(client, temp_image_dir, monkeypatch):
+    """With RESULT_CACHE=1, a repeated request is served from the saved images"""
+    from uuid import uuid4
+    monkeypatch.setenv("RESULT_CACHE", "1")
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {
+        "choices": [{
+            "message": {
+                "images": [{
+                    "image_url": {
+                        "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                    }
+                }]
+            }
+        }]
+    }
+    prompt = f"cached prompt {uuid4().hex}"
+
+    with patch('main.provider_transport.post', return_value=mock_response) as mock_post:
+        first = client.post("/images/generate", data={"prompt": prompt, "n": 1})
+        assert first.status_code == 200
+        assert first.headers["x-cache"] == "MISS"
+
+        # Whitespace differences normalize to the same key
+        second = client.post("/images/generate", data={"prompt": f"  {prompt} ", "n": 1})
+        assert second.status_code == 200
+        assert second.headers["x-cache"] == "HIT"
+        assert second.json() == first.json()
+        assert mock_post.call_count == 1
+
+        other = client.post("/images/generate", data={"prompt": prompt, "n": 1, "width": 256})
+        assert other.headers["x-cache"] == "MISS"
+        assert mock_post.call_count == 2
+
+        # A deleted image invalidates the entry that pointed at it
+        client.delete(f"/images/{first.json()[0]['filename']}")
+        third = client.post("/images/generate", data={"prompt": prompt, "n": 1})
+        assert third.headers["x-cache"] == "MISS"
+        assert mock_post.call_count == 3
+
+def test_generate_without_result_cache(client, temp_image_dir, monkeypatch):
+    """The cache is opt-in: by default every request reaches the provider"""
+    monkeypatch.delenv("RESULT_CACHE", raising=False)
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"choices": []}
+    with patch('main.provider_transport.post', return_value=mock_response) as mock_post:
+        for _ in range(2):
+            response = client.post("/images/generate", data={"prompt": "uncached", "n": 1})
+            assert "x-cache" not in response.headers
+        assert mock_post.call_count == 2
+
+def test_identical_concurrent_generates_share_one_call(temp_image_dir, monkeypatch):
+    """Identical in-flight requests coalesce onto one provider call and its saved images"""
+    import asyncio
+    import httpx
+    from main import app, provider_flights
+
+    monkeypatch.delenv("RESULT_CACHE", raising=False)
+    calls = []
+
+    async def slow_post(*args, **kwargs):
+        calls.append(kwargs["json"]["prompt"])
+        await asyncio.sleep(0.3)
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {
+            "choices": [{
+                "message": {
+                    "images": [{
+                        "image_url": {
+                            "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                        }
+                    }]
+                }
+            }]
+        }
+        return mock_response
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            prompts = ["same prompt"] * 3 + ["other prompt"]
+            return await asyncio.gather(*[
+                ac.post("/images/generate", data={"prompt": p, "n": 1}) for p in prompts
+            ])
+
+    coalesced_before = provider_flights.metrics()["coalesced_waiters"]
+    with patch('main.provider_transport.post', side_effect=slow_post):
+        responses = asyncio.run(run())
+
+    assert all(r.status_code == 200 for r in responses)
+    assert sorted(calls) == ["other prompt", "same prompt"]
+    same = [r.json() for r in responses[:3]]
+    assert same[0] == same[1] == same[2]
+    assert responses[3].json() != same[0]
+    assert provider_flights.metrics()["coalesced_waiters"] - coalesced_before == 2
+
+def test_webp_output_is_served(client, temp_image_dir):
+    """Every format generate can save under is one the image route serves"""
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {
+        "choices": [{
+            "message": {
+                "images": [{
+                    "image_url": {
+                        "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                    }
+                }]
+            }
+        }]
+    }
+
+    with patch('main.provider_transport.post', return_value=mock_response):
+        response = client.post("/images/generate", data={"prompt": "test prompt", "fmt": "WEBP"})
+    assert response.status_code == 200
+    url = response.json()[0]["url"]
+    assert url.endswith(".webp")
+    assert client.get(url).status_code == 200
+
+def test_generate_rejects_unservable_format(client):
+    with patch('main.provider_transport.post') as post:
+        response = client.post("/images/generate", data={"prompt": "test prompt", "fmt": "gif"})
+    assert response.status_code == 422
+    assert "Invalid fmt" in response.json()["detail"]
+    post.assert_not_called()
+    assert client.post("/jobs/submit", data={"prompt": "test prompt", "fmt": "tiff"}).status_code == 422
@@ -0,0 +1,92 @@
+import pytest
+import asyncio
+import json
+import threading
+import time
+
+import main
+from main import JobStore, JobEvents
+
+class _Connected:
+    async def is_disconnected(self):
+        return False
+
+@pytest.fixture
+def events_store(tmp_path, monkeypatch):
+    events = JobEvents()
+    store = JobStore(tmp_path / "jobs.db", events)
+    monkeypatch.setattr(main, "job_events", events)
+    monkeypatch.setattr(main, "job_store", store)
+    return store
+
+def parse(chunk):
+    assert chunk.startswith("data: ")
+    return json.loads(chunk[len("data: "):])
+
+def test_stream_pushes_state_changes(events_store, monkeypatch):
+    """Changes arrive as they happen, not on the re-check timer"""
+    monkeypatch.setattr(main, "JOB_EVENTS_POLL_SEC", 30.0)
+    job = events_store.create("generate", {"prompt": "x"})
+
+    def worker():
+        time.sleep(0.1)
+        assert events_store.claim() == job["id"]
+        time.sleep(0.1)
+        events_store.finish(job["id"], result=[{"filename": "a.png"}])
+
+    async def consume():
+        received = []
+        async for chunk in main.job_event_stream(_Connected(), [job["id"]]):
+            received.append((time.monotonic(), parse(chunk)))
+        return received
+
+    thread = threading.Thread(target=worker)
+    start = time.monotonic()
+    thread.start()
+    received = asyncio.run(consume())
+    thread.join()
+
+    assert [event["status"] for _, event in received] == ["queued", "running", "done"]
+    assert received[-1][1]["result"] == [{"filename": "a.png"}]
+    assert received[-1][0] - start < 5
+    assert main.job_events.metrics()["streams"] == 0
+
+def test_stream_rechecks_without_wakeup(events_store, monkeypatch):
+    """Process workers cannot publish; the timer still catches their updates"""
+    monkeypatch.setattr(main, "JOB_EVENTS_POLL_SEC", 0.05)
+    job = events_store.create("generate", {"prompt": "x"})
+    silent = JobStore(events_store.db_path)
+
+    async def consume():
+        statuses = []
+        async for chunk in main.job_event_stream(_Connected(), [job["id"]]):
+            statuses.append(parse(chunk)["status"])
+            if len(statuses) == 1:
+                threading.Timer(0.1, silent.finish, args=(job["id"],), kwargs={"error": "boom"}).start()
+        return statuses
+
+    assert asyncio.run(consume()) == ["queued", "error"]
+
+def test_sse_endpoint_multiplexes_jobs(client, events_store):
+    first = events_store.create("generate", {"prompt": "a"})
+    second = events_store.create("generate", {"prompt": "b"})
+    events_store.finish(first["id"], result=[])
+    events_store.finish(second["id"], error="failed")
+
+    with client.stream("GET", f"/jobs/events?ids={first['id']},{second['id']}") as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        events = [json.loads(line[len("data: "):]) for line in response.iter_lines() if line.startswith("data: ")]
+    assert {(e["id"], e["status"]) for e in events} == {(first["id"], "done"), (second["id"], "error")}
+
+def test_sse_endpoint_single_job(client, events_store):
+    job = events_store.create("generate", {"prompt": "a"})
+    events_store.finish(job["id"], result=[{"filename": "x.png"}])
+    with client.stream("GET", f"/jobs/{job['id']}/events") as response:
+        lines = [line for line in response.iter_lines() if line.startswith("data: ")]
+    assert len(lines) == 1
+    assert json.loads(lines[0][len("data: "):])["result"] == [{"filename": "x.png"}]
+
+def test_sse_unknown_job_is_404(client, events_store):
+    assert client.get("/jobs/nope/events").status_code == 404
+    assert client.get("/jobs/events?ids=nope").status_code == 404
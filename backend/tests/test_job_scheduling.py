@@ -0,0 +1,125 @@
+import pytest
+import sqlite3
+from main import JobStore
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(tmp_path / "jobs.db")
+
+def drain(store):
+    order = []
+    while True:
+        job_id = store.claim()
+        if job_id is None:
+            return order
+        order.append(job_id)
+        store.finish(job_id, result=[])
+
+def test_skewed_load_is_shared_fairly(store):
+    """One tenant's backlog of 1000 jobs does not delay three light tenants"""
+    tenant_of = {}
+    for job in store.create_many([("generate", {"prompt": f"flood {i}"}) for i in range(1000)], "flood"):
+        tenant_of[job["id"]] = "flood"
+    for tenant in ("a", "b", "c"):
+        for i in range(10):
+            tenant_of[store.create("generate", {"prompt": f"{tenant} {i}"}, tenant=tenant)["id"]] = tenant
+
+    order = [tenant_of[job_id] for job_id in drain(store)]
+    assert len(order) == 1030
+
+    # Light tenants are interleaved with the flood, not queued behind it
+    for tenant in ("a", "b", "c"):
+        positions = [i for i, t in enumerate(order) if t == tenant]
+        assert len(positions) == 10
+        assert max(positions) < 40
+    # While everyone has work, each tenant gets one claim per round
+    first_round = order[:40]
+    assert all(first_round.count(t) == 10 for t in ("flood", "a", "b", "c"))
+
+def test_bounded_wait_for_late_arrival(store):
+    """A tenant arriving behind a long queue waits at most one round"""
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(200)], "flood")
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(200)], "bulk")
+    for _ in range(50):
+        store.finish(store.claim(), result=[])
+    late = store.create("generate", {"prompt": "late"}, tenant="late")
+    waited = 0
+    while True:
+        job_id = store.claim()
+        store.finish(job_id, result=[])
+        if job_id == late["id"]:
+            break
+        waited += 1
+    assert waited <= 2
+
+def test_priority_runs_first(store):
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(5)], "a")
+    urgent = store.create("generate", {"prompt": "urgent"}, priority=5, tenant="a")
+    other = store.create("generate", {"prompt": "other"}, priority=1, tenant="b")
+    assert store.claim() == urgent["id"]
+    assert store.claim() == other["id"]
+    assert store.get(urgent["id"])["priority"] == 5
+
+def test_high_priority_flood_does_not_starve_other_tenants(store):
+    """Priority orders turns within a round; it doesn't buy a tenant extra turns"""
+    store.create_many([("generate", {"prompt": f"flood {i}"}, 9) for i in range(100)], "flood")
+    light = [store.create("generate", {"prompt": f"light {i}"}, tenant="light")["id"] for i in range(3)]
+
+    order = [store.claim() for _ in range(6)]
+    assert all(job_id in order for job_id in light)
+    assert store.get(order[0])["priority"] == 9  # the flood still goes first within each round
+
+def test_new_tenant_joins_the_current_round(store):
+    """A tenant arriving late (or after a long idle spell) gets one turn per round, not a burst"""
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(20)], "a")
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(20)], "b")
+    for _ in range(10):
+        store.finish(store.claim(), result=[])
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(20)], "late")
+
+    tenants = [store._conn().execute("SELECT tenant FROM jobs WHERE id = ?", (store.claim(),)).fetchone()[0]
+               for _ in range(9)]
+    assert tenants.count("late") <= 4
+
+def test_queue_depth(store):
+    store.create_many([("generate", {"prompt": str(i)}) for i in range(3)], "a")
+    store.create("generate", {"prompt": "b"}, tenant="b")
+    assert store.queued() == 4
+    assert store.queued("a") == 3
+    store.claim()
+    assert store.queued() == 3
+
+def test_migrates_old_schema(tmp_path):
+    """A jobs.db from before priorities/tenants keeps working"""
+    path = tmp_path / "jobs.db"
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE jobs (id TEXT PRIMARY KEY, op TEXT NOT NULL, params TEXT NOT NULL,
+        status TEXT NOT NULL, result TEXT, error TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)""")
+    conn.execute("INSERT INTO jobs VALUES ('old', 'generate', '{}', 'queued', NULL, NULL, 1, 1)")
+    conn.commit()
+    conn.close()
+    store = JobStore(path)
+    assert store.get("old")["priority"] == 0
+    assert store.claim() == "old"
+
+@pytest.mark.no_workers
+def test_submit_rejects_when_queue_full(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "QUEUE_MAX_DEPTH", main.job_store.queued() + 1)
+    assert client.post("/jobs/submit", json={"prompt": "fits"}).status_code == 200
+    response = client.post("/jobs/submit", json={"prompt": "overflow"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+    assert client.post("/jobs/batch", json=[{"prompt": "x"}]).status_code == 429
+
+@pytest.mark.no_workers
+def test_submit_per_tenant_limit_and_priority(client, monkeypatch):
+    import main
+    monkeypatch.setattr(main, "QUEUE_MAX_PER_TENANT", 1)
+    first = client.post("/jobs/submit", json={"prompt": "x", "priority": 3}, headers={"X-Client-Key": "tenant-x"})
+    assert first.status_code == 200
+    assert first.json()["priority"] == 3
+    assert client.post("/jobs/submit", json={"prompt": "y"}, headers={"X-Client-Key": "tenant-x"}).status_code == 429
+    assert client.post("/jobs/submit", json={"prompt": "z"}, headers={"X-Client-Key": "tenant-y"}).status_code == 200
+    assert client.post("/jobs/submit", json={"prompt": "p", "priority": 42},
+                       headers={"X-Client-Key": "tenant-z"}).status_code == 400
@@ -0,0 +1,107 @@
+import pytest
+import sqlite3
+import threading
+from main import JobStore
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(tmp_path / "jobs.db")
+
+def test_jobs_survive_reopen(tmp_path):
+    """Jobs and their results are persisted, not held in memory"""
+    store = JobStore(tmp_path / "jobs.db")
+    job = store.create("generate", {"prompt": "test"})
+    store.finish(job["id"], result=[{"filename": "a.png"}])
+
+    reopened = JobStore(tmp_path / "jobs.db")
+    saved = reopened.get(job["id"])
+    assert saved["status"] == "done"
+    assert saved["op"] == "generate"
+    assert saved["result"] == [{"filename": "a.png"}]
+    assert saved["updated_at"] >= saved["created_at"]
+    assert reopened.params(job["id"]) == {"op": "generate", "prompt": "test"}
+
+def test_claim_is_atomic_across_threads(store):
+    """Concurrent claimers each get a distinct job and every job is claimed once"""
+    job_ids = {store.create("generate", {"prompt": f"p{i}"})["id"] for i in range(50)}
+    claimed = []
+    lock = threading.Lock()
+
+    def claimer():
+        while True:
+            job_id = store.claim()
+            if job_id is None:
+                return
+            with lock:
+                claimed.append(job_id)
+
+    threads = [threading.Thread(target=claimer) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(claimed) == sorted(job_ids)
+    assert all(job["status"] == "running" for job in store.get_many(list(job_ids)).values())
+
+def test_get_many_and_errors(store):
+    """Batched reads return only known ids; failures record the error"""
+    ok = store.create("generate", {})
+    bad = store.create("edit", {})
+    store.finish(bad["id"], error="Provider error")
+
+    jobs = store.get_many([ok["id"], bad["id"], "missing"])
+    assert set(jobs) == {ok["id"], bad["id"]}
+    assert jobs[ok["id"]]["status"] == "queued"
+    assert jobs[bad["id"]]["status"] == "error"
+    assert jobs[bad["id"]]["error"] == "Provider error"
+
+def test_requeue_running(store):
+    """Jobs left running by a crash go back to the queue once their lease lapses"""
+    job = store.create("generate", {})
+    assert store.claim() == job["id"]
+    assert store.requeue_running(lease_sec=0) == 1
+    assert store.get(job["id"])["status"] == "queued"
+
+def test_requeue_leaves_leased_jobs_alone(store):
+    """Another server process's live jobs are not duplicated"""
+    import time
+
+    job = store.create("generate", {})
+    assert store.claim() == job["id"]
+    assert store.requeue_running(lease_sec=0.2) == 0
+    with store.lease(job["id"], lease_sec=0.2):
+        time.sleep(0.4)
+        assert store.requeue_running(lease_sec=0.2) == 0
+    assert store.get(job["id"])["status"] == "running"
+    time.sleep(0.3)
+    assert store.requeue_running(lease_sec=0.2) == 1
+
+def test_long_lost_jobs_are_failed_and_old_jobs_pruned(store):
+    job = store.create("generate", {})
+    done = store.create("generate", {})
+    fresh = store.create("generate", {})
+    assert store.claim() == job["id"]
+    store.finish(done["id"], result=[])
+    store._conn().execute("UPDATE jobs SET updated_at = 1 WHERE id IN (?, ?)", (job["id"], done["id"]))
+
+    assert store.requeue_running(lease_sec=300, abandon_after_sec=3600) == 0
+    lost = store.get(job["id"])
+    assert (lost["status"], lost["error"]) == ("error", "interrupted and not resumed")
+
+    assert store.prune(retention_sec=3600) == 1
+    assert store.get(done["id"]) is None
+    assert store.get(job["id"])["status"] == "error"
+    assert store.get(fresh["id"])["status"] == "queued"
+    assert store.prune(retention_sec=0) == 0
+
+def test_create_many_in_one_transaction(store):
+    jobs = store.create_many([("generate", {"prompt": str(i)}) for i in range(10)])
+    assert len({job["id"] for job in jobs}) == 10
+    found = store.get_many([job["id"] for job in jobs])
+    assert all(found[job["id"]]["status"] == "queued" for job in jobs)
+
+    # A failing insert rolls the whole batch back
+    with pytest.raises(sqlite3.IntegrityError):
+        store.create_many([("generate", {"prompt": "ok"}), (None, {"prompt": "no op"})])
+    assert len(store.recent(100)) == 10
@@ -40,9 +40,8 @@ def test_submit_job_edit(client, temp_image_dir):
         "width": 512,
         "height": 512,
         "fmt": "png",
-        "n": 1,
-        "base": ("base.png", base64.b64decode(base_img_data), "image/png")
-    })
+        "n": 1
+    }, files={"base": ("base.png", base64.b64decode(base_img_data), "image/png")})
     assert response.status_code == 200
     
     data = response.json()
@@ -62,6 +61,22 @@ def test_submit_job_edit_without_base(client):
     })
     assert response.status_code == 400
 
+def test_submit_generate_job_refuses_images(client):
+    """Images only make sense on an edit job; a generate job must not drop them silently"""
+    response = client.post("/jobs/submit", data={
+        "op": "generate",
+        "prompt": "test prompt"
+    }, files={"refs": ("ref.png", b"\x89PNG\r\n\x1a\n" + b"\0" * 64, "image/png")})
+    assert response.status_code == 400
+    assert "base image" in response.json()["detail"]
+
+def test_submit_job_rejects_out_of_range_size(client):
+    response = client.post("/jobs/submit", data={"prompt": "test prompt", "width": 0})
+    assert response.status_code == 422
+    response = client.post("/jobs/batch", json=[{"prompt": "test prompt", "height": 5000}])
+    assert response.status_code == 422
+    assert response.json()["detail"].startswith("jobs[0]: height must be between 1 and")
+
 def test_get_job(client, temp_image_dir):
     """Test getting a job by ID"""
     # First submit a job
@@ -134,7 +149,7 @@ def test_job_processing_with_mock_provider(client, temp_image_dir):
         }]
     }
     
-    with patch('requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         # Submit a job
         submit_response = client.post("/jobs/submit", data={
             "op": "generate",
@@ -171,7 +186,7 @@ def test_job_processing_with_mock_provider(client, temp_image_dir):
 def test_job_processing_with_error(client, temp_image_dir):
     """Test that job errors are handled correctly"""
     # Mock the provider to raise an exception
-    with patch('requests.post', side_effect=Exception("Provider error")):
+    with patch('main.provider_transport.post', side_effect=Exception("Provider error")):
         # Submit a job
         submit_response = client.post("/jobs/submit", data={
             "op": "generate",
@@ -204,6 +219,7 @@ def test_job_processing_with_error(client, temp_image_dir):
         assert job_data["error"] is not None
         assert "Provider error" in job_data["error"]
 
+@pytest.mark.no_workers
 def test_get_job_after_submit(client):
     """Test submitting a job then GET it, checking statuses"""
     # Submit a job
@@ -223,4 +239,65 @@ def test_get_job_after_submit(client):
 def test_get_nonexistent_job_404(client):
     """Test GET a non-existent job returns 404"""
     response = client.get("/jobs/invalid-job-id")
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+def test_submit_job_invalid_params(client):
+    """Bad numbers or providers are rejected at submit time, not in the worker"""
+    response = client.post("/jobs/submit", json={"op": "generate", "prompt": "x", "width": "wide"})
+    assert response.status_code == 400
+    response = client.post("/jobs/submit", json={"op": "generate", "prompt": "x", "provider": "nope"})
+    assert response.status_code == 400
+    response = client.post("/jobs/submit", json={"op": "upscale", "prompt": "x"})
+    assert response.status_code == 400
+
+def test_batch_submit_and_bulk_status(client):
+    """A batch is enqueued at once and read back in one round-trip"""
+    response = client.post("/jobs/batch", json={"jobs": [
+        {"op": "generate", "prompt": f"catalog item {i}", "width": 256, "height": 256}
+        for i in range(25)
+    ]})
+    assert response.status_code == 200
+    jobs = response.json()
+    assert len(jobs) == 25
+    assert all(job["status"] == "queued" for job in jobs)
+    ids = [job["id"] for job in jobs]
+
+    response = client.get("/jobs", params={"ids": ",".join(ids[:3] + ["missing"])})
+    assert response.status_code == 200
+    assert [job["id"] for job in response.json()] == ids[:3]
+
+    response = client.post("/jobs/status", json={"ids": list(reversed(ids))})
+    assert response.status_code == 200
+    assert [job["id"] for job in response.json()] == list(reversed(ids))
+
+def test_batch_is_all_or_nothing(client):
+    from main import job_store
+
+    before = len(job_store.recent(500))
+    response = client.post("/jobs/batch", json=[
+        {"op": "generate", "prompt": "fine"},
+        {"op": "generate", "prompt": "bad size", "width": "wide"},
+    ])
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("jobs[1]:")
+    assert len(job_store.recent(500)) == before
+
+def test_batch_rejects_edit_jobs(client):
+    """Edit jobs need uploaded images, which a JSON batch can't carry"""
+    from main import job_store
+
+    before = len(job_store.recent(500))
+    response = client.post("/jobs/batch", json=[
+        {"op": "generate", "prompt": "fine"},
+        {"op": "edit", "prompt": "touch up", "base": "base.png"},
+    ])
+    assert response.status_code == 400
+    assert response.json()["detail"].startswith("jobs[1]: edit jobs can't be batched")
+    assert len(job_store.recent(500)) == before
+
+def test_batch_limits(client, monkeypatch):
+    monkeypatch.setattr("main.JOBS_BATCH_MAX", 2)
+    assert client.post("/jobs/batch", json=[]).status_code == 400
+    assert client.post("/jobs/batch", json=[{"prompt": "x"}] * 3).status_code == 400
+    assert client.post("/jobs/status", json={"ids": ["a", "b", "c"]}).status_code == 400
+    assert client.post("/jobs/status", json={"ids": "a"}).status_code == 400
@@ -25,7 +25,7 @@ def test_server_logging_on_exception(client, temp_image_dir):
     
     try:
         # Mock the provider to raise an exception
-        with patch('requests.post', side_effect=Exception("Test exception")):
+        with patch('main.provider_transport.post', side_effect=Exception("Test exception")):
             response = client.post("/images/generate", data={
                 "prompt": "test prompt",
                 "width": 512,
@@ -167,7 +167,7 @@ def test_server_logging_on_job_processing_failure(client, temp_image_dir):
 
     try:
         # Mock the provider to raise an exception during job processing
-        with patch('requests.post', side_effect=Exception("Job processing exception")):
+        with patch('main.provider_transport.post', side_effect=Exception("Job processing exception")):
             # Submit a job
             response = client.post("/jobs/submit", json={
                 "op": "generate",
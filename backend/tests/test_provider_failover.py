@@ -0,0 +1,195 @@
+import pytest
+import time
+from unittest.mock import patch, AsyncMock
+
+from main import CircuitBreaker, HTTPException
+
+PNG_RESPONSE = {
+    "choices": [{
+        "message": {
+            "images": [{
+                "image_url": {
+                    "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                }
+            }]
+        }
+    }]
+}
+
+@pytest.fixture
+def breakers(monkeypatch):
+    import main
+    fresh = {name: CircuitBreaker(name, window=4, min_calls=2, error_rate=0.5, open_sec=60)
+             for name in main.PROVIDERS}
+    monkeypatch.setattr(main, "provider_breakers", fresh)
+    monkeypatch.setattr(main, "provider_retry", main.RetryPolicy(attempts=1))
+    monkeypatch.setattr(main, "provider_router", main.ProviderRouter())
+    return fresh
+
+def test_breaker_opens_on_errors_and_probes_after_cooldown():
+    breaker = CircuitBreaker("test", window=4, min_calls=2, error_rate=0.5, open_sec=0.05)
+    breaker.record(True, 0.1)
+    breaker.record(False, 0.1)
+    assert breaker.status()["state"] == "open"
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    probe = breaker.allow()
+    assert probe
+    # Only one probe at a time
+    assert not breaker.allow()
+    breaker.record(False, 0.1, probe)
+    assert breaker.status()["state"] == "open"
+
+    time.sleep(0.06)
+    probe = breaker.allow()
+    assert probe
+    breaker.record(True, 0.1, probe)
+    assert breaker.status()["state"] == "closed"
+    assert breaker.status()["trips"] == 2
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker("test", window=4, min_calls=2, error_rate=0.5, slow_sec=1)
+    breaker.record(True, 5)
+    breaker.record(True, 5)
+    assert breaker.status()["state"] == "open"
+
+def test_auto_fails_over_to_healthy_provider(client, temp_image_dir, breakers, monkeypatch):
+    # Keep latency ranking from reordering the providers
+    monkeypatch.setenv("GEMINI_COST_WEIGHT", "1000000")
+    failing = AsyncMock(side_effect=HTTPException(status_code=500, detail="OpenRouter API error"))
+    with patch('main.call_openrouter_api', failing), \
+         patch('main.call_gemini', new_callable=AsyncMock, return_value=PNG_RESPONSE) as gemini:
+        for i in range(3):
+            response = client.post("/images/generate", data={"prompt": f"prompt {i}", "provider": "auto"})
+            assert response.status_code == 200
+    # Two failures open the openrouter breaker; the third request goes straight to gemini
+    assert failing.call_count == 2
+    assert gemini.call_count == 3
+
+    status = client.get("/providers/status").json()
+    assert status["providers"]["openrouter"]["state"] == "open"
+    assert status["providers"]["gemini"]["state"] == "closed"
+
+def test_auto_fails_over_before_retrying_with_default_policy(client, temp_image_dir, breakers, monkeypatch):
+    """Auto mode moves on at once while a healthy provider is left, and retries only the last one"""
+    import main
+    from main import ProviderUnavailable
+    monkeypatch.setattr(main, "provider_retry", main.RetryPolicy())
+    monkeypatch.setenv("GEMINI_COST_WEIGHT", "1000000")
+    failing = AsyncMock(side_effect=ProviderUnavailable("OpenRouter API error", "502"))
+    with patch('main.call_openrouter_api', failing), \
+         patch('main.call_gemini', new_callable=AsyncMock, return_value=PNG_RESPONSE) as gemini:
+        response = client.post("/images/generate", data={"prompt": "test prompt", "provider": "auto"})
+    assert response.status_code == 200
+    assert failing.call_count == 1
+    assert gemini.call_count == 1
+    assert "openrouter" not in main.provider_retry.metrics()
+
+    breakers["gemini"].record(False, 0.1)
+    breakers["gemini"].record(False, 0.1)
+    flaky = AsyncMock(side_effect=[ProviderUnavailable("OpenRouter API error", "502"), PNG_RESPONSE])
+    with patch('main.call_openrouter_api', flaky):
+        response = client.post("/images/generate", data={"prompt": "test prompt", "provider": "auto"})
+    assert response.status_code == 200
+    assert flaky.call_count == 2
+
+def test_auto_returns_503_when_every_breaker_is_open(client, breakers):
+    for breaker in breakers.values():
+        breaker.record(False, 0.1)
+        breaker.record(False, 0.1)
+    with patch('main.call_openrouter_api', new_callable=AsyncMock) as openrouter, \
+         patch('main.call_gemini', new_callable=AsyncMock) as gemini:
+        response = client.post("/images/generate", data={"prompt": "test prompt", "provider": "auto"})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    openrouter.assert_not_called()
+    gemini.assert_not_called()
+
+def test_auto_from_env(client, temp_image_dir, breakers, monkeypatch):
+    monkeypatch.setenv("PROVIDER", "auto")
+    monkeypatch.setenv("PROVIDER_AUTO_ORDER", "gemini,openrouter")
+    with patch('main.call_openrouter_api', new_callable=AsyncMock) as openrouter, \
+         patch('main.call_gemini', new_callable=AsyncMock, return_value=PNG_RESPONSE) as gemini:
+        response = client.post("/images/generate", data={"prompt": "test prompt"})
+    assert response.status_code == 200
+    gemini.assert_called_once()
+    openrouter.assert_not_called()
+
+def _half_open(breaker):
+    breaker.open_sec = 0
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+    probe = breaker.allow()
+    assert probe
+    assert breaker.status()["state"] == "half_open" and not breaker.allow()
+    return probe
+
+def test_probe_is_released_when_no_slot_is_free(breakers, monkeypatch):
+    """A probe refused by the provider's limiter doesn't wedge the breaker half-open"""
+    import asyncio
+    import main
+    from main import ProviderBusy, ProviderLimiter
+
+    limiter = ProviderLimiter("openrouter", 1, max_queue=0)
+    limiter.active = 1
+    monkeypatch.setitem(main.provider_limiters, "openrouter", limiter)
+    breaker = breakers["openrouter"]
+    probe = _half_open(breaker)
+
+    with pytest.raises(ProviderBusy):
+        asyncio.run(main._call_one("openrouter", "prompt", 64, 64, 1, None, probe=probe))
+    assert breaker.allow()
+
+def test_probe_is_released_when_cancelled_waiting_for_a_slot(breakers, monkeypatch):
+    import asyncio
+    import main
+    from main import ProviderLimiter
+
+    limiter = ProviderLimiter("openrouter", 1)
+    limiter.active = 1
+    monkeypatch.setitem(main.provider_limiters, "openrouter", limiter)
+    breaker = breakers["openrouter"]
+    probe = _half_open(breaker)
+
+    async def run():
+        task = asyncio.ensure_future(main._call_one("openrouter", "prompt", 64, 64, 1, None, probe=probe))
+        await asyncio.sleep(0.05)
+        assert limiter.load() == 2
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert limiter.load() == 1
+    assert breaker.allow()
+
+def test_probe_survives_an_overlapping_explicit_call(breakers, monkeypatch):
+    """Only the probe's holder can give it back; an explicit call ending early leaves it claimed"""
+    import asyncio
+    import main
+    from main import ProviderBusy, ProviderLimiter
+
+    monkeypatch.setitem(main.provider_limiters, "openrouter", ProviderLimiter("openrouter", 1, max_queue=0))
+    breaker = breakers["openrouter"]
+    probe = _half_open(breaker)
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def slow(*args, **kwargs):
+            await gate.wait()
+            return PNG_RESPONSE
+
+        with patch('main.call_openrouter_api', new_callable=AsyncMock, side_effect=slow):
+            probe_call = asyncio.ensure_future(main._call_one("openrouter", "prompt", 64, 64, 1, None, probe=probe))
+            await asyncio.sleep(0.02)
+            # The probe holds the only slot, so this call is refused without a verdict
+            with pytest.raises(ProviderBusy):
+                await main._call_one("openrouter", "prompt", 64, 64, 1, None)
+            assert not breaker.allow()
+            gate.set()
+            await probe_call
+
+    asyncio.run(run())
+    assert breaker.status()["state"] == "closed"
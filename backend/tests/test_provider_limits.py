@@ -0,0 +1,158 @@
+import pytest
+import asyncio
+import threading
+import time
+from unittest.mock import patch, AsyncMock, MagicMock
+
+from main import ProviderLimiter, ProviderBusy
+
+PNG_RESPONSE = {
+    "choices": [{
+        "message": {
+            "images": [{
+                "image_url": {
+                    "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                }
+            }]
+        }
+    }]
+}
+
+def test_limiter_caps_concurrency_and_queues():
+    """Calls over the cap wait their turn instead of running at once"""
+    limiter = ProviderLimiter("test", max_concurrency=2, max_wait=5)
+    running = []
+    peak = []
+
+    async def call():
+        async with limiter.slot():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+
+    async def run():
+        await asyncio.gather(*(call() for _ in range(6)))
+
+    asyncio.run(run())
+    assert max(peak) == 2
+    metrics = limiter.metrics()
+    assert metrics["admitted"] == 6
+    assert metrics["in_flight"] == 0 and metrics["queued"] == 0
+
+def test_limiter_shares_slots_across_event_loops():
+    """Worker threads and request handlers run on different loops but share the cap"""
+    limiter = ProviderLimiter("test", max_concurrency=1, max_wait=5)
+    active = []
+    overlaps = []
+
+    async def call():
+        async with limiter.slot():
+            active.append(1)
+            overlaps.append(len(active))
+            await asyncio.sleep(0.05)
+            active.pop()
+
+    threads = [threading.Thread(target=asyncio.run, args=(call(),)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert overlaps == [1, 1, 1, 1]
+
+def test_limiter_rejects_when_queue_wait_expires():
+    limiter = ProviderLimiter("test", max_concurrency=1, max_wait=0.05)
+
+    async def run():
+        async with limiter.slot():
+            with pytest.raises(ProviderBusy) as exc:
+                await limiter.acquire()
+        return exc.value
+
+    error = asyncio.run(run())
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "1"
+    assert limiter.metrics()["rejected_saturated"] == 1
+    assert limiter.metrics()["in_flight"] == 0
+
+def test_limiter_refunds_token_when_queue_wait_expires():
+    """A caller that gives up in the queue must not leave its token reserved"""
+    limiter = ProviderLimiter("test", max_concurrency=1, rate=2, burst=2, max_wait=0.2)
+
+    async def run():
+        async with limiter.slot():
+            with pytest.raises(ProviderBusy):
+                await limiter.acquire()
+        # Without the refund the bucket sits near 0.4 tokens and this call is refused
+        start = time.monotonic()
+        async with limiter.slot():
+            return time.monotonic() - start
+
+    assert asyncio.run(run()) < 0.05
+    assert limiter.metrics()["rejected_rate_limited"] == 0
+
+def test_limiter_token_bucket_paces_and_rejects():
+    """Within the wait budget calls are paced; beyond it they get 429"""
+    limiter = ProviderLimiter("test", max_concurrency=10, rate=20, burst=1, max_wait=0.2)
+
+    async def run():
+        start = time.monotonic()
+        for _ in range(3):
+            await limiter.acquire()
+            limiter.release()
+        return time.monotonic() - start
+
+    elapsed = asyncio.run(run())
+    assert elapsed >= 0.09
+
+    slow = ProviderLimiter("test", max_concurrency=10, rate=1, burst=1, max_wait=0.2)
+
+    async def burst():
+        await slow.acquire()
+        slow.release()
+        await slow.acquire()
+
+    with pytest.raises(ProviderBusy) as exc:
+        asyncio.run(burst())
+    assert exc.value.status_code == 429
+    assert int(exc.value.headers["Retry-After"]) >= 1
+
+def test_generate_returns_503_when_provider_saturated(client, monkeypatch):
+    import main
+
+    monkeypatch.setitem(main.provider_limiters, "openrouter",
+                        ProviderLimiter("openrouter", max_concurrency=1, max_queue=0))
+
+    async def busy():
+        await main.provider_limiters["openrouter"].acquire()
+
+    asyncio.run(busy())
+    with patch('main.call_openrouter_api', new_callable=AsyncMock, return_value=PNG_RESPONSE) as mocked:
+        response = client.post("/images/generate", data={"prompt": "test prompt", "provider": "openrouter"})
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    mocked.assert_not_called()
+
+def test_upstream_429_passes_through_and_pauses(client, monkeypatch, temp_image_dir):
+    """A provider 429 keeps its Retry-After and holds back the next call"""
+    import main
+
+    limiter = ProviderLimiter("openrouter", max_concurrency=2, max_wait=0.5)
+    monkeypatch.setitem(main.provider_limiters, "openrouter", limiter)
+    monkeypatch.setattr(main, "provider_retry", main.RetryPolicy(attempts=1))
+    limited = MagicMock()
+    limited.status_code = 429
+    limited.text = "slow down"
+    limited.headers = {"retry-after": "7"}
+
+    with patch('main.provider_transport.post', return_value=limited):
+        response = client.post("/images/generate", data={"prompt": "test prompt", "provider": "openrouter"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "7"
+
+    # The pause is longer than the wait budget, so the next call is refused locally
+    with patch('main.call_openrouter_api', new_callable=AsyncMock, return_value=PNG_RESPONSE) as mocked:
+        response = client.post("/images/generate", data={"prompt": "another prompt", "provider": "openrouter"})
+    assert response.status_code == 429
+    mocked.assert_not_called()
+    assert client.get("/metrics").json()["provider_limits"]["openrouter"]["upstream_rate_limited"] == 1
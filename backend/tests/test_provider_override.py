@@ -1,5 +1,5 @@
 import pytest
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock
 import base64
 import io
 from PIL import Image
@@ -27,7 +27,7 @@ fake_response = {
 
 def test_generate_openrouter(client, temp_image_dir, monkeypatch):
     """POST /images/generate with provider="openrouter" -> call_openrouter_api called"""
-    mock_or = MagicMock(return_value=fake_response)
+    mock_or = AsyncMock(return_value=fake_response)
     monkeypatch.setattr('main.call_openrouter_api', mock_or)
     response = client.post("/images/generate", data={
         "prompt": "test prompt",
@@ -42,7 +42,7 @@ def test_generate_openrouter(client, temp_image_dir, monkeypatch):
 
 def test_generate_gemini(client, temp_image_dir, monkeypatch):
     """POST /images/generate with provider="gemini" -> call_gemini called"""
-    mock_gemini = MagicMock(return_value=fake_response)
+    mock_gemini = AsyncMock(return_value=fake_response)
     monkeypatch.setattr('main.call_gemini', mock_gemini)
     response = client.post("/images/generate", data={
         "prompt": "test prompt",
@@ -57,7 +57,7 @@ def test_generate_gemini(client, temp_image_dir, monkeypatch):
 
 def test_edit_openrouter(client, temp_image_dir, monkeypatch):
     """POST /images/edit with provider="openrouter" -> call_openrouter_api called"""
-    mock_or = MagicMock(return_value=fake_response)
+    mock_or = AsyncMock(return_value=fake_response)
     monkeypatch.setattr('main.call_openrouter_api', mock_or)
     base_img_data = create_test_image_data()
     response = client.post("/images/edit", data={
@@ -76,7 +76,7 @@ def test_edit_openrouter(client, temp_image_dir, monkeypatch):
 
 def test_edit_gemini(client, temp_image_dir, monkeypatch):
     """POST /images/edit with provider="gemini" -> call_gemini called"""
-    mock_gemini = MagicMock(return_value=fake_response)
+    mock_gemini = AsyncMock(return_value=fake_response)
     monkeypatch.setattr('main.call_gemini', mock_gemini)
     base_img_data = create_test_image_data()
     response = client.post("/images/edit", data={
@@ -96,9 +96,9 @@ def test_edit_gemini(client, temp_image_dir, monkeypatch):
 def test_generate_fallback(client, temp_image_dir, monkeypatch):
     """Omit provider -> fallback to env PROVIDER="gemini" -> call_gemini called"""
     monkeypatch.setenv("PROVIDER", "gemini")
-    mock_gemini = MagicMock(return_value=fake_response)
+    mock_gemini = AsyncMock(return_value=fake_response)
     monkeypatch.setattr('main.call_gemini', mock_gemini)
-    mock_or = MagicMock()
+    mock_or = AsyncMock()
     monkeypatch.setattr('main.call_openrouter_api', mock_or)
     response = client.post("/images/generate", data={
         "prompt": "test prompt",
@@ -0,0 +1,98 @@
+import pytest
+import asyncio
+import time
+import httpx
+from unittest.mock import patch, MagicMock
+
+from main import RetryPolicy, ProviderBusy, ProviderUnavailable
+
+PNG_RESPONSE = {
+    "choices": [{
+        "message": {
+            "images": [{
+                "image_url": {
+                    "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                }
+            }]
+        }
+    }]
+}
+
+def make_response(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.text = "error"
+    response.headers = headers or {}
+    response.json.return_value = PNG_RESPONSE
+    return response
+
+@pytest.fixture
+def fast_retry(monkeypatch):
+    import main
+    policy = RetryPolicy(attempts=3, base_delay=0.01, max_delay=0.02, deadline=5)
+    monkeypatch.setattr(main, "provider_retry", policy)
+    return policy
+
+def test_transient_5xx_is_retried(client, temp_image_dir, fast_retry):
+    """A 502 followed by a 200 succeeds without the client seeing an error"""
+    with patch('main.provider_transport.post', side_effect=[make_response(502), make_response(200)]) as post:
+        response = client.post("/images/generate", data={"prompt": "retry me", "provider": "openrouter"})
+    assert response.status_code == 200
+    assert post.call_count == 2
+    stats = fast_retry.metrics()["openrouter"]
+    assert stats["retries"] == 1 and stats["recovered"] == 1
+    assert stats["reasons"] == {"502": 1}
+
+def test_network_errors_are_retried_until_exhausted(client, fast_retry):
+    error = httpx.ConnectError("connection refused")
+    with patch('main.provider_transport.post', side_effect=error) as post:
+        response = client.post("/images/generate", data={"prompt": "never works", "provider": "openrouter"})
+    assert response.status_code == 500
+    assert post.call_count == 3
+    stats = fast_retry.metrics()["openrouter"]
+    assert stats["retries"] == 2 and stats["exhausted"] == 1
+    assert stats["reasons"] == {"ConnectError": 2}
+
+def test_client_errors_are_not_retried(client, fast_retry):
+    with patch('main.provider_transport.post', return_value=make_response(400)) as post:
+        response = client.post("/images/generate", data={"prompt": "bad request", "provider": "openrouter"})
+    assert response.status_code == 500
+    assert post.call_count == 1
+    assert fast_retry.metrics() == {}
+
+def test_backoff_honors_retry_after():
+    policy = RetryPolicy(base_delay=0.1, max_delay=1)
+    busy = ProviderBusy(429, "slow down", 3, upstream=True)
+    assert all(policy.backoff(0, busy) >= 3 for _ in range(20))
+    plain = ProviderUnavailable("boom", "500")
+    delays = [policy.backoff(5, plain) for _ in range(50)]
+    assert all(0 <= d <= 1 for d in delays)
+
+def test_retry_stops_at_deadline():
+    """A Retry-After longer than the remaining budget fails fast"""
+    policy = RetryPolicy(attempts=5, base_delay=0.01, deadline=1)
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        raise ProviderBusy(503, "overloaded", 10, upstream=True)
+
+    start = time.monotonic()
+    with pytest.raises(ProviderBusy):
+        asyncio.run(policy.run("gemini", flaky))
+    assert time.monotonic() - start < 0.5
+    assert len(calls) == 1
+    assert policy.metrics()["gemini"]["deadline_exceeded"] == 1
+
+def test_local_rejections_are_not_retried():
+    """Our own limiter already spent the wait budget; retrying would double it"""
+    policy = RetryPolicy(attempts=3, base_delay=0.01)
+    calls = []
+
+    async def rejected():
+        calls.append(1)
+        raise ProviderBusy(503, "saturated", 1)
+
+    with pytest.raises(ProviderBusy):
+        asyncio.run(policy.run("openrouter", rejected))
+    assert len(calls) == 1
@@ -0,0 +1,116 @@
+import pytest
+import asyncio
+import time
+from collections import deque
+from unittest.mock import patch
+
+import main
+from main import ProviderRouter, CircuitBreaker, ProviderLimiter
+
+PNG_RESPONSE = {"choices": [{"message": {"images": [{"image_url": {"url": "data:image/png;base64,"}}]}}]}
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(main, "provider_breakers", {name: CircuitBreaker(name) for name in main.PROVIDERS})
+    monkeypatch.setattr(main, "provider_limiters", {name: ProviderLimiter(name, 4) for name in main.PROVIDERS})
+    monkeypatch.setattr(main, "provider_retry", main.RetryPolicy(attempts=1))
+
+def test_router_prefers_lower_latency(fresh_state):
+    router = ProviderRouter(alpha=0.5)
+    # Unmeasured providers rank first, in preference order
+    assert router.order() == ["openrouter", "gemini"]
+    router.observe("openrouter", 2.0)
+    router.observe("gemini", 0.5)
+    assert router.order() == ["gemini", "openrouter"]
+    router.observe("gemini", 4.5)
+    assert router.ewma["gemini"] == pytest.approx(2.5)
+    assert router.order() == ["openrouter", "gemini"]
+
+def test_router_accounts_for_load_and_cost(fresh_state, monkeypatch):
+    router = ProviderRouter()
+    router.observe("openrouter", 1.0)
+    router.observe("gemini", 1.5)
+    assert router.order()[0] == "openrouter"
+
+    # A full limiter doubles the expected latency
+    main.provider_limiters["openrouter"].active = 4
+    assert router.order()[0] == "gemini"
+    main.provider_limiters["openrouter"].active = 0
+
+    monkeypatch.setenv("OPENROUTER_COST_WEIGHT", "2")
+    assert router.order()[0] == "gemini"
+
+def test_failures_penalize_instead_of_looking_fast(fresh_state):
+    """A provider that fails in milliseconds must not outrank a slower healthy one"""
+    router = ProviderRouter(alpha=0.5, error_penalty=30)
+    router.observe("gemini", 3.0)
+    for _ in range(3):
+        router.observe("openrouter", 0.01, ok=False)
+    assert "openrouter" not in router.ewma
+    assert router.p95("openrouter") is None
+    assert router.order() == ["gemini", "openrouter"]
+
+    # Recovering brings it back as its error rate decays
+    for _ in range(6):
+        router.observe("openrouter", 1.0)
+    assert router.order() == ["openrouter", "gemini"]
+    assert router.status()["providers"]["openrouter"]["error_rate"] < 0.05
+
+def test_failed_calls_feed_the_error_rate_not_latency(fresh_state, monkeypatch):
+    router = ProviderRouter()
+    monkeypatch.setattr(main, "provider_router", router)
+    with patch('main.call_openrouter_api', side_effect=RuntimeError("boom")):
+        with pytest.raises(RuntimeError):
+            asyncio.run(main.call_provider("openrouter", "prompt", 512, 512, 1))
+    assert router.error_ewma["openrouter"] == 1.0
+    assert router.recent["openrouter"] == deque()
+
+def test_hedge_fires_second_provider_past_threshold(fresh_state, monkeypatch):
+    router = ProviderRouter(hedge=True, hedge_after=0.05)
+    monkeypatch.setattr(main, "provider_router", router)
+    cancelled = []
+
+    async def slow(*args, **kwargs):
+        try:
+            await asyncio.sleep(2)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+        return PNG_RESPONSE
+
+    async def fast(*args, **kwargs):
+        return {"from": "gemini"}
+
+    with patch('main.call_openrouter_api', side_effect=slow), patch('main.call_gemini', side_effect=fast):
+        start = time.monotonic()
+        result = asyncio.run(main.call_provider("auto", "prompt", 512, 512, 1))
+    assert result == {"from": "gemini"}
+    assert time.monotonic() - start < 1
+    assert cancelled == [True]
+    status = router.status()
+    assert status["hedges"] == 1 and status["hedge_wins"] == 1
+    assert main.provider_limiters["openrouter"].metrics()["in_flight"] == 0
+    assert main.provider_breakers["openrouter"].status()["calls"] == 0
+
+def test_hedge_uses_p95_once_warmed_up(fresh_state):
+    router = ProviderRouter(hedge=True, hedge_min_samples=20)
+    for i in range(19):
+        router.observe("gemini", 0.1)
+    assert router.hedge_delay("gemini") is None
+    router.observe("gemini", 0.9)
+    assert router.hedge_delay("gemini") == pytest.approx(0.9)
+    assert ProviderRouter(hedge=False).hedge_delay("gemini") is None
+
+def test_no_hedge_when_disabled(fresh_state, monkeypatch):
+    router = ProviderRouter(hedge=False)
+    monkeypatch.setattr(main, "provider_router", router)
+
+    async def slowish(*args, **kwargs):
+        await asyncio.sleep(0.1)
+        return {"from": "openrouter"}
+
+    with patch('main.call_openrouter_api', side_effect=slowish), patch('main.call_gemini') as gemini:
+        result = asyncio.run(main.call_provider("auto", "prompt", 512, 512, 1))
+    assert result == {"from": "openrouter"}
+    gemini.assert_not_called()
+    assert router.status()["providers"]["openrouter"]["picks"] == 1
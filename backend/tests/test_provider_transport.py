@@ -0,0 +1,69 @@
+import pytest
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from main import ProviderTransport
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        body = json.dumps({"ok": True}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def test_transport_reuses_connections(local_server):
+    """Sequential calls to one host share a single keep-alive connection"""
+    transport = ProviderTransport()
+
+    async def run():
+        try:
+            for _ in range(3):
+                response = await transport.post(f"{local_server}/generate", json={"prompt": "x"})
+                assert response.status_code == 200
+                assert response.json() == {"ok": True}
+
+            metrics = transport.metrics()["127.0.0.1"]
+            assert metrics["requests"] == 3
+            assert metrics["new_connections"] == 1
+            assert metrics["reuse_ratio"] == pytest.approx(0.667, abs=0.001)
+            assert metrics["open_connections"] == 1
+            assert metrics["avg_wait_ms"] >= 0
+        finally:
+            await transport.aclose()
+
+    asyncio.run(run())
+
+def test_transport_counts_errors(monkeypatch):
+    """Connection failures are raised as httpx errors and counted per host"""
+    import httpx
+    monkeypatch.setenv("PROVIDER_CONNECT_TIMEOUT", "0.5")
+    transport = ProviderTransport()
+
+    async def run():
+        try:
+            with pytest.raises(httpx.HTTPError):
+                await transport.post("http://127.0.0.1:9/unreachable", json={})
+            assert transport.metrics()["127.0.0.1"]["errors"] == 1
+        finally:
+            await transport.aclose()
+
+    asyncio.run(run())
@@ -3,6 +3,7 @@ import os
 import tempfile
 from PIL import Image
 import io
+from unittest.mock import patch
 
 def test_list_images_empty(client, temp_image_dir):
     """Test that GET /images returns empty list when no images exist"""
@@ -57,4 +58,280 @@ def test_static_image_serve(client_with_temp_dir, temp_image_dir):
 def test_static_image_not_found(client):
     """Test that 404 is returned for non-existent static images"""
     response = client.get("/static/images/nonexistent.png")
-    assert response.status_code == 404
\ No newline at end of file
+    assert response.status_code == 404
+
+def test_list_images_pagination(client, temp_image_dir):
+    """Test that GET /images pages through the catalog with limit/cursor"""
+    from main import save_base64_image
+    b64 = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+    names = {save_base64_image(b64, "png") for _ in range(3)}
+
+    response = client.get("/images", params={"limit": 2})
+    assert response.status_code == 200
+    first = response.json()
+    assert len(first) == 2
+    assert first[0]["created_at"] >= first[1]["created_at"]
+    cursor = response.headers["x-next-cursor"]
+
+    response = client.get("/images", params={"limit": 2, "cursor": cursor})
+    assert response.status_code == 200
+    second = response.json()
+    assert len(second) == 1
+    assert "x-next-cursor" not in response.headers
+    assert {img["filename"] for img in first + second} == names
+
+    # Extension filter only matches the catalog's ext column
+    response = client.get("/images", params={"ext": "jpg"})
+    assert response.json() == []
+
+def test_list_images_invalid_cursor(client):
+    """Test that a malformed cursor is rejected"""
+    response = client.get("/images", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+def test_save_base64_image_streams_large_payload(temp_image_dir):
+    """Large, line-wrapped payloads decode byte-for-byte and leave no temp files"""
+    import base64
+    import main
+    from main import save_base64_image, image_catalog, OBJECTS_DIR
+
+    raw = os.urandom(main.B64_CHUNK_CHARS + 12345)
+    encoded = base64.encodebytes(raw).decode()  # wrapped every 76 chars
+    filename = save_base64_image("data:image/png;base64," + encoded, "png")
+
+    path, size_bytes, _ = image_catalog.resolve(filename)
+    with open(path, "rb") as f:
+        assert f.read() == raw
+    assert size_bytes == len(raw)
+    assert not list(OBJECTS_DIR.glob("*.part"))
+
+def test_save_base64_image_invalid_payload(temp_image_dir):
+    """A corrupt payload raises without leaving a partial file behind"""
+    import binascii
+    from main import save_base64_image, OBJECTS_DIR
+
+    before = set(os.listdir(OBJECTS_DIR))
+    with pytest.raises(binascii.Error):
+        save_base64_image("data:image/png;base64,abcde", "png")
+    assert set(os.listdir(OBJECTS_DIR)) == before
+
+def test_identical_images_are_stored_once(client, temp_image_dir):
+    """Same bytes share one sharded blob; aliases keep their own URLs and refcount it"""
+    import base64
+    from main import save_base64_image, image_catalog, object_path
+
+    b64 = base64.b64encode(os.urandom(256)).decode()
+    first = save_base64_image(b64, "png")
+    second = save_base64_image(b64, "png")
+    assert first != second
+
+    path1, _, content_hash = image_catalog.resolve(first)
+    path2, _, _ = image_catalog.resolve(second)
+    assert path1 == path2 == object_path(content_hash)
+    assert path1.parent.parent.parent.name == "objects"
+
+    for name in (first, second):
+        response = client.get(f"/static/images/{name}")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "image/png"
+        assert response.content == base64.b64decode(b64)
+
+    # Removing one alias keeps the blob; removing the last one deletes it
+    assert client.delete(f"/images/{first}").status_code == 200
+    assert client.get(f"/images/{first}").status_code == 404
+    assert client.get(f"/images/{second}").status_code == 200
+    assert path1.exists()
+    assert client.delete(f"/images/{second}").status_code == 200
+    assert not path1.exists()
+
+def _saved_photo(width=600, height=400):
+    import base64
+    from main import save_base64_image, image_pipeline
+    img = Image.effect_noise((width, height), 40).convert("RGB")
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    filename = save_base64_image(base64.b64encode(out.getvalue()).decode(), "png")
+    image_pipeline.join()  # keep post-save work out of the render counts below
+    return filename, len(out.getvalue())
+
+def test_image_derivative_is_resized_and_cached(client, temp_image_dir):
+    """?w=&fmt= serves a smaller transcoded variant, rendered once"""
+    import main
+    filename, original_size = _saved_photo()
+
+    before = main.derivative_cache.metrics()
+    with patch("main.render_derivative", wraps=main.render_derivative) as render:
+        first = client.get(f"/images/{filename}", params={"w": 150, "fmt": "webp"})
+        second = client.get(f"/static/images/{filename}", params={"w": 150, "fmt": "webp"})
+    assert first.status_code == second.status_code == 200
+    assert first.headers["content-type"] == "image/webp"
+    assert first.content == second.content
+    assert render.call_count == 1
+    assert len(first.content) < original_size / 4
+    assert Image.open(io.BytesIO(first.content)).size == (150, 100)
+
+    after = main.derivative_cache.metrics()
+    assert after["hits"] == before["hits"] + 1
+    assert after["misses"] == before["misses"] + 1
+
+    # Never upscaled; other formats and heights are separate variants
+    big = client.get(f"/images/{filename}", params={"w": 2000, "fmt": "jpeg"})
+    assert big.headers["content-type"] == "image/jpeg"
+    assert Image.open(io.BytesIO(big.content)).size == (600, 400)
+    tall = client.get(f"/images/{filename}", params={"h": 40})
+    assert Image.open(io.BytesIO(tall.content)).size == (60, 40)
+
+def test_image_derivative_validation(client, temp_image_dir):
+    filename, _ = _saved_photo(20, 20)
+    assert client.get(f"/images/{filename}", params={"fmt": "gif"}).status_code == 400
+    assert client.get(f"/images/{filename}", params={"w": 0}).status_code == 422
+    assert client.get("/images/missing.png", params={"w": 10}).status_code == 404
+
+def test_list_images_includes_thumbnail_url(client, temp_image_dir):
+    filename, _ = _saved_photo(40, 40)
+    item = client.get("/images").json()[0]
+    assert item["thumbnail_url"].startswith(f"/static/images/{filename}?w=")
+    response = client.get(item["thumbnail_url"])
+    assert response.headers["content-type"] == "image/webp"
+
+def test_derivative_cache_evicts_least_recently_used(tmp_path):
+    from main import DerivativeCache
+
+    cache = DerivativeCache(tmp_path, max_bytes=250)
+
+    def add(key):
+        tmp = cache.temp_path()
+        tmp.write_bytes(b"x" * 100)
+        cache.put(key, tmp)
+
+    add("a")
+    add("b")
+    assert cache.get("a") is not None  # a is now most recently used
+    add("c")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.metrics()["evictions"] == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a", "c"]
+
+def test_saved_image_is_processed_off_the_request_path(client, temp_image_dir):
+    """The pipeline records metadata and warms the gallery thumbnail"""
+    import main
+    filename, _ = _saved_photo(600, 400)
+
+    item = client.get("/images").json()[0]
+    assert (item["width"], item["height"]) == (600, 400)
+    content_hash = main.image_catalog.resolve(filename)[2]
+    row = main.image_catalog.conn.execute(
+        "SELECT format, phash FROM objects WHERE content_hash = ?", (content_hash,)).fetchone()
+    assert row[0] == "PNG" and len(row[1]) == 16
+
+    before = main.derivative_cache.metrics()
+    with patch("main.render_derivative") as render:
+        response = client.get(item["thumbnail_url"])
+    assert response.status_code == 200
+    assert render.call_count == 0
+    assert main.derivative_cache.metrics()["hits"] == before["hits"] + 1
+    assert Image.open(io.BytesIO(response.content)).width == main.THUMBNAIL_WIDTH
+
+def test_perceptual_hash_tolerates_resizing():
+    from main import perceptual_hash
+
+    def distance(a, b):
+        return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+    photo = Image.linear_gradient("L").rotate(30).convert("RGB")
+    other = Image.effect_noise((256, 256), 80).convert("RGB")
+    assert distance(perceptual_hash(photo), perceptual_hash(photo.resize((97, 61)))) <= 6
+    assert distance(perceptual_hash(photo), perceptual_hash(other)) > 12
+
+def test_image_pipeline_drops_events_when_full():
+    from main import ImagePipeline
+
+    pipeline = ImagePipeline(workers=1, maxsize=1, derivatives=[])
+    with patch.object(pipeline, "_ensure_started"):
+        pipeline.publish("a.png", "a" * 64)
+        pipeline.publish("b.png", "b" * 64)
+    metrics = pipeline.metrics()
+    assert (metrics["queued"], metrics["published"], metrics["dropped"]) == (1, 1, 1)
+
+def test_image_responses_are_immutable_and_revalidate(client, temp_image_dir):
+    """Strong ETag from the content hash; revalidation costs no body"""
+    import main
+    filename, _ = _saved_photo(60, 40)
+    content_hash = main.image_catalog.resolve(filename)[2]
+
+    response = client.get(f"/images/{filename}")
+    assert response.headers["etag"] == f'"{content_hash}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert "last-modified" in response.headers
+
+    again = client.get(f"/static/images/{filename}", headers={"If-None-Match": response.headers["etag"]})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["etag"] == response.headers["etag"]
+    assert client.get(f"/images/{filename}", headers={"If-None-Match": '"other"'}).status_code == 200
+
+    since = client.get(f"/images/{filename}", headers={"If-Modified-Since": response.headers["last-modified"]})
+    assert since.status_code == 304
+    old = client.get(f"/images/{filename}", headers={"If-Modified-Since": "Mon, 01 Jan 2001 00:00:00 GMT"})
+    assert old.status_code == 200
+
+def test_image_head_requests(client, temp_image_dir):
+    """HEAD answers with the GET headers and no body, for caches and link checkers"""
+    import main
+    filename, size_bytes = _saved_photo(60, 40)
+    content_hash = main.image_catalog.resolve(filename)[2]
+
+    for url in (f"/static/images/{filename}", f"/images/{filename}"):
+        response = client.head(url)
+        assert response.status_code == 200
+        assert response.content == b""
+        assert response.headers["etag"] == f'"{content_hash}"'
+        assert response.headers["content-length"] == str(size_bytes)
+    assert client.head("/static/images/missing.png").status_code == 404
+
+def test_image_variant_revalidates_without_rendering(client, temp_image_dir):
+    import main
+    filename, _ = _saved_photo(60, 40)
+    first = client.get(f"/images/{filename}", params={"w": 30, "fmt": "png"})
+    assert first.headers["etag"] != client.get(f"/images/{filename}").headers["etag"]
+
+    with patch("main.derivative_for") as derivative_for:
+        again = client.get(f"/images/{filename}", params={"w": 30, "fmt": "png"},
+                           headers={"If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
+    assert derivative_for.call_count == 0
+
+def test_image_range_request(client, temp_image_dir):
+    filename, _ = _saved_photo(60, 40)
+    full = client.get(f"/images/{filename}").content
+    response = client.get(f"/images/{filename}", headers={"Range": "bytes=0-99"})
+    assert response.status_code == 206
+    assert response.headers["content-range"] == f"bytes 0-99/{len(full)}"
+    assert response.content == full[:100]
+    # A stale If-Range falls back to the whole image
+    stale = client.get(f"/images/{filename}", headers={"Range": "bytes=0-99", "If-Range": '"other"'})
+    assert stale.status_code == 200 and stale.content == full
+
+@pytest.mark.parametrize("name", ["..%5C..%5Cmain.py", ".hidden.png", "notes.txt", "a%00.png", "x" * 300 + ".png"])
+def test_image_names_are_validated_before_any_lookup(client, name):
+    with patch("main.image_catalog.resolve") as resolve, patch("main.image_catalog.sync") as sync:
+        assert client.get(f"/images/{name}").status_code == 404
+    assert resolve.call_count == sync.call_count == 0
+
+def test_image_is_served_from_one_open_and_fstat(client, temp_image_dir):
+    import main
+    filename, _ = _saved_photo(60, 40)
+    expected = main.image_catalog.resolve(filename)[0].read_bytes()
+
+    with patch("main.os.stat", wraps=os.stat) as stat, patch("main.os.fstat", wraps=os.fstat) as fstat:
+        response = client.get(f"/images/{filename}")
+    assert response.content == expected
+    assert int(response.headers["content-length"]) == len(expected)
+    assert stat.call_count == 0 and fstat.call_count == 1
+
+    # A matching ETag is answered from the catalog without touching the file
+    with patch("main._open_stored") as open_stored:
+        again = client.get(f"/images/{filename}", headers={"If-None-Match": response.headers["etag"]})
+    assert again.status_code == 304
+    assert open_stored.call_count == 0
@@ -5,6 +5,7 @@ import json
 from unittest.mock import patch, MagicMock
 from main import _claim_one_job, _process_job
 
+@pytest.mark.no_workers
 def test_claim_one_job(client, temp_image_dir):
     """Test that _claim_one_job claims a queued job"""
     # Submit a job
@@ -32,6 +33,7 @@ def test_claim_one_job_no_jobs():
     claimed_job_id = _claim_one_job()
     assert claimed_job_id is None
 
+@pytest.mark.no_workers
 def test_process_job_generate(client, temp_image_dir):
     """Test that _process_job processes a generate job correctly"""
     # Submit a job
@@ -61,7 +63,7 @@ def test_process_job_generate(client, temp_image_dir):
         }]
     }
     
-    with patch('requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         # Process the job
         _process_job(job_id)
         
@@ -73,6 +75,7 @@ def test_process_job_generate(client, temp_image_dir):
         assert job_data["result"] is not None
         assert len(job_data["result"]) == 1
 
+@pytest.mark.no_workers
 def test_process_job_edit(client, temp_image_dir):
     """Test that _process_job processes an edit job correctly"""
     import base64
@@ -93,9 +96,8 @@ def test_process_job_edit(client, temp_image_dir):
         "width": 512,
         "height": 512,
         "fmt": "png",
-        "n": 1,
-        "base": ("base.png", base64.b64decode(base_img_data), "image/png")
-    })
+        "n": 1
+    }, files={"base": ("base.png", base64.b64decode(base_img_data), "image/png")})
     assert response.status_code == 200
     job_id = response.json()["id"]
     
@@ -114,7 +116,7 @@ def test_process_job_edit(client, temp_image_dir):
         }]
     }
     
-    with patch('requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         # Process the job
         _process_job(job_id)
         
@@ -126,6 +128,63 @@ def test_process_job_edit(client, temp_image_dir):
         assert job_data["result"] is not None
         assert len(job_data["result"]) == 1
 
+@pytest.mark.no_workers
+def test_edit_job_sends_its_images_to_the_provider(client, temp_image_dir):
+    """Uploads submitted with an edit job reach the provider and are dropped afterwards"""
+    import io
+    from PIL import Image
+    import main
+
+    def png(color):
+        out = io.BytesIO()
+        Image.new("RGB", (40, 40), color=color).save(out, format="PNG")
+        return out.getvalue()
+
+    response = client.post("/jobs/submit", data={
+        "op": "edit",
+        "prompt": "test prompt",
+        "width": 256,
+        "height": 256,
+        "fmt": "png",
+        "n": 1
+    }, files=[
+        ("base", ("base.png", png("red"), "image/png")),
+        ("mask", ("mask.png", png("white"), "image/png")),
+        ("refs", ("ref1.png", png("green"), "image/png")),
+        ("refs", ("ref2.png", png("blue"), "image/png")),
+    ])
+    assert response.status_code == 200
+    job_id = response.json()["id"]
+    params = main.job_store.params(job_id)
+    keys = [params["base_path"], params["mask_path"], *params["ref_paths"]]
+    assert len(keys) == 4
+    assert all(main.object_storage.stat(key) is not None for key in keys)
+
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {
+        "choices": [{
+            "message": {
+                "images": [{
+                    "image_url": {
+                        "url": "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+                    }
+                }]
+            }
+        }]
+    }
+
+    with patch('main.provider_transport.post', return_value=mock_response) as post:
+        _process_job(job_id)
+
+    content = post.call_args.kwargs["json"]["messages"][0]["content"]
+    images = [part for part in content if part["type"] == "image_url"]
+    assert len(images) == 4
+    assert all(part["image_url"]["url"].startswith("data:image/") for part in images)
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "done"
+    assert all(main.object_storage.stat(key) is None for key in keys)
+
+@pytest.mark.no_workers
 def test_process_job_with_error(client, temp_image_dir):
     """Test that _process_job handles errors correctly"""
     # Submit a job
@@ -141,7 +200,7 @@ def test_process_job_with_error(client, temp_image_dir):
     job_id = response.json()["id"]
     
     # Mock the provider to raise an exception
-    with patch('requests.post', side_effect=Exception("Provider error")):
+    with patch('main.provider_transport.post', side_effect=Exception("Provider error")):
         # Process the job
         _process_job(job_id)
         
@@ -170,7 +229,7 @@ def test_worker_thread_processing(client, temp_image_dir):
         }]
     }
     
-    with patch('requests.post', return_value=mock_response):
+    with patch('main.provider_transport.post', return_value=mock_response):
         # Submit multiple jobs
         job_ids = []
         for i in range(3):
@@ -220,7 +279,7 @@ def test_worker_thread_processing(client, temp_image_dir):
 
 def test_normal_flow(client, temp_image_dir):
     """Test normal flow: submit → queued → running → done"""
-    with patch('requests.post') as mock_post:
+    with patch('main.provider_transport.post') as mock_post:
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {"dummy": "success"}
@@ -230,8 +289,7 @@ def test_normal_flow(client, temp_image_dir):
         assert response.status_code == 200
         job_id = response.json()["id"]
 
-        # Check queued
-        response = client.get(f"/jobs/{job_id}")
+        # Check queued; the submit wakes a worker, so a follow-up GET may already see it running
         assert response.json()["status"] == "queued"
 
         # Wait for worker to process
@@ -247,7 +305,7 @@ def test_normal_flow(client, temp_image_dir):
 
 def test_error_path(client, temp_image_dir):
     """Test error path: simulate error during processing → 'error' status"""
-    with patch('requests.post', side_effect=Exception("Simulated error")):
+    with patch('main.provider_transport.post', side_effect=Exception("Simulated error")):
         response = client.post("/jobs/submit", json={"op": "generate", "prompt": "test"})
         assert response.status_code == 200
         job_id = response.json()["id"]
@@ -265,7 +323,7 @@ def test_error_path(client, temp_image_dir):
 
 def test_no_shared_state_leak(client, temp_image_dir):
     """Test no shared state leak between jobs: run multiple jobs sequentially"""
-    with patch('requests.post') as mock_post:
+    with patch('main.provider_transport.post') as mock_post:
         mock_response = MagicMock()
         mock_response.status_code = 200
         mock_response.json.return_value = {"dummy": "success"}
@@ -313,7 +371,7 @@ def test_worker_thread_with_multiple_workers(client, temp_image_dir):
         }
         return mock_response
     
-    with patch('requests.post', side_effect=delayed_post):
+    with patch('main.provider_transport.post', side_effect=delayed_post):
         # Submit multiple jobs
         job_ids = []
         for i in range(5):
@@ -369,4 +427,62 @@ def test_worker_thread_with_multiple_workers(client, temp_image_dir):
             response = client.get(f"/jobs/{job_id}")
             assert response.status_code == 200
             job_data = response.json()
-            assert job_data["status"] in ["done", "error"]
\ No newline at end of file
+            assert job_data["status"] in ["done", "error"]
+
+def test_worker_pool_runs_jobs_concurrently(tmp_path, monkeypatch):
+    """QUEUE_WORKERS threads process jobs in parallel and report utilization"""
+    from main import JobStore, WorkerPool
+    store = JobStore(tmp_path / "jobs.db")
+    job_ids = [store.create("generate", {"prompt": f"p{i}"})["id"] for i in range(6)]
+    active = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def slow_process(job_id):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.2)
+        with lock:
+            active["now"] -= 1
+        store.finish(job_id, result=[])
+        return True
+
+    monkeypatch.setattr("main._process_job", slow_process)
+    pool = WorkerPool(3, "thread", store)
+    pool.start()
+    try:
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            if all(job["status"] == "done" for job in store.get_many(job_ids).values()):
+                break
+            time.sleep(0.05)
+        metrics = pool.metrics()
+    finally:
+        pool.stop(5)
+
+    assert active["max"] == 3
+    assert len(metrics) == 3
+    assert sum(w["jobs_done"] for w in metrics) == 6
+    assert all(w["alive"] and w["utilization"] > 0 for w in metrics)
+
+def test_worker_pool_drains_in_flight_jobs(tmp_path, monkeypatch):
+    """Stopping the pool waits for the running job instead of abandoning it"""
+    from main import JobStore, WorkerPool
+    store = JobStore(tmp_path / "jobs.db")
+    job_id = store.create("generate", {})["id"]
+    started = threading.Event()
+
+    def slow_process(jid):
+        started.set()
+        time.sleep(0.5)
+        store.finish(jid, result=[])
+        return True
+
+    monkeypatch.setattr("main._process_job", slow_process)
+    pool = WorkerPool(1, "thread", store)
+    pool.start()
+    assert started.wait(5)
+    pool.stop(5)
+
+    assert store.get(job_id)["status"] == "done"
+    assert pool.metrics() == []
@@ -38,7 +38,7 @@ const schema = z.object({
 });
 
 type FormValues = z.infer<typeof schema>;
-type ImageItem = { filename: string; url: string; size_bytes: number; created_at: number };
+type ImageItem = { filename: string; url: string; thumbnail_url?: string; size_bytes: number; created_at: number };
 type JobItem = { id: string; status: string; result?: ImageItem[]; error?: string };
 
 export default function EditPage() {
@@ -98,6 +98,36 @@ export default function EditPage() {
     throw new Error("Timeout waiting for job");
   }
 
+  // Pushed job updates over SSE; falls back to polling if the stream can't be used
+  function watchJob(id: string): Promise<any[]> {
+    if (typeof EventSource === "undefined") return pollJob(id);
+    return new Promise((resolve, reject) => {
+      const es = new EventSource(`${API}/jobs/${id}/events`);
+      const timer = setTimeout(() => {
+        es.close();
+        reject(new Error("Timeout waiting for job"));
+      }, 240_000);
+      const stop = () => {
+        clearTimeout(timer);
+        es.close();
+      };
+      es.onmessage = (e) => {
+        const j: JobItem = JSON.parse(e.data);
+        if (j.status === "done") {
+          stop();
+          resolve(j.result || []);
+        } else if (j.status === "error") {
+          stop();
+          reject(new Error(j.error || "Job error"));
+        }
+      };
+      es.onerror = () => {
+        stop();
+        pollJob(id).then(resolve, reject);
+      };
+    });
+  }
+
   async function onSubmit(values: FormValues) {
     setBusy(true);
     setProgress(5);
@@ -118,9 +148,11 @@ export default function EditPage() {
 
       if (useQueue) {
         // Jobs flow
-        if (values.base) fd.append("base", values.base);
-        if (values.mask) fd.append("mask", values.mask);
-        for (const r of values.refs) fd.append("refs", r);
+        if (values.base) {
+          fd.append("base", values.base);
+          if (values.mask) fd.append("mask", values.mask);
+          for (const r of values.refs) fd.append("refs", r);
+        }
 
         const op = values.base ? "edit" : "generate";
         fd.append("op", op);
@@ -129,7 +161,7 @@ export default function EditPage() {
         if (res.status >= 200 && res.status < 300) {
           const jobId = res.data.id as string;
           toast.info("Submitted to queue", { description: `Job #${jobId.slice(0, 8)}` });
-          const result = await pollJob(jobId);
+          const result = await watchJob(jobId);
           toast.success("Image ready");
           await refresh();
           return;
@@ -390,7 +422,7 @@ export default function EditPage() {
         {items.map((it) => (
           <figure key={it.filename} className="border rounded-2xl p-3 shadow-sm">
             <div className="relative w-full aspect-square">
-              <Image src={`${API}${it.url}`} alt={it.filename} fill sizes="33vw" style={{ objectFit: "cover" }} />
+              <Image src={`${API}${it.thumbnail_url || it.url}`} alt={it.filename} fill sizes="33vw" style={{ objectFit: "cover" }} />
             </div>
             <div className="mt-2 text-sm flex items-center justify-between">
               <span className="text-muted-foreground">{(it.size_bytes / 1024).toFixed(1)} KB</span>